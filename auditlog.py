@@ -3,95 +3,32 @@
 #   2) log audit information to that file in JSON-format
 #
 #   For available settings, see CallbackModule below
+#
+#   Install it together with the auditlog_common directory next to it,
+#   which holds the code it shares with auditlog2.py
 
 import os
-import tempfile
-import errno
-import datetime
-import socket
-import json
-import uuid
+import atexit
+import math
 import re
 import sys
 
-from subprocess import Popen, PIPE
 from ansible import utils
 
+try:
+    import auditlog_common  # noqa: F401
+except ImportError:
+    # Ansible loads callback plugins from their file, without adding their
+    # directory, where auditlog_common is installed too, to sys.path
+    sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 
-def get_dotted_val_in_dict(d, keys):
-    """Searches dict d for element in keys.
-
-    Args:
-        d (dict): Dictionary to search
-        keys (str): String containing element to search for
-
-    Returns:
-        Value found at the specified element if found, else None
-
-    Examples:
-
-        Search for the value of foo['bar'] in {'foo': {'bar': 1}}
-        >>> get_dotted_val_in_dict({'foo': {'bar': 1}}, 'foo.bar')
-        1
-
-        Search for the value of foo['baz'] in {'foo': {'bar': 1}}
-        >>> get_dotted_val_in_dict({'foo': {'bar': 1}}, 'foo.baz')
-    """
-
-    if "." in keys:
-        key, rest = keys.split(".", 1)
-        dval = d.get(key, {})
-        if isinstance(dval, dict):
-            return get_dotted_val_in_dict(dval, rest)
-    else:
-        if d.get(keys):
-            return d[keys]
-
-
-def truthy_string(s):
-    """Determines if a string has a truthy value"""
-    return str(s).lower() in ['true', '1', 'y', 'yes']
-
-
-class JsonAuditLogger(object):
-    """Writes auditlog entries to a file in JSON format.
-
-    All log entries are marked with the same UUID and have timestamps.
-    """
-
-    def __init__(self, logdir='/var/log/ansible'):
-        self.uuid = str(uuid.uuid4())
-        self.hostname = socket.gethostname()
-
-        try:
-            if not self.isWritable(logdir):
-                raise Exception("Access denied to {}".format(logdir))
-        except Exception:
-            raise
-
-        self.logfile = os.path.join(logdir, "{}.log".format(self.uuid))
-
-    def isWritable(self, path):
-        try:
-            testfile = tempfile.TemporaryFile(dir=path)
-            testfile.close()
-        except OSError as e:
-            if e.errno == errno.EACCES:  # 13
-                return False
-            e.filename = path
-            raise
-        return True
-
-    def log(self, event_id, log_entry={}):
-        log_entry['event'] = event_id
-        log_entry['timestamp'] = datetime.datetime.now().isoformat()
-        log_entry['controlhost'] = self.hostname
-        log_entry['uuid'] = self.uuid
-
-        data = json.dumps(log_entry, sort_keys=True)
-
-        with open(self.logfile, 'a') as f:
-            f.write(data+'\n')
+from auditlog_common import (
+    AuditVarPaths, CallbackProfiler, HOSTS_FORMATS, JsonAuditLogger,
+    RunCatalog, RunMetrics, RunTimer, STATS_LAYOUTS, TaskAggregator,
+    format_hosts, get_logname, parse_events, stats_chunks, summarize_stats,
+    truthy_string)
+# Part of the plugin's API from before it was shared
+from auditlog_common import get_dotted_val_in_dict  # noqa: F401
 
 
 class CallbackModule(object):
@@ -99,6 +36,13 @@ class CallbackModule(object):
 
     Throws a warning if logging fails.
 
+    With more than one fork, ansible 1 calls the runner hooks in forked
+    worker processes, which exit without flushing buffers or running atexit
+    handlers. Their entries are written to the sink right away instead of
+    being buffered, queued for the background writer or aggregated, and
+    they are not counted in task_summary entries, latency percentiles or
+    metrics, which the workers cannot pass back to ansible.
+
     Settings (environment variables):
 
         ANSIBLE_AUDITLOG_DISABLED:
@@ -124,48 +68,527 @@ class CallbackModule(object):
         ANSIBLE_AUDITLOG_AUDIT_VARS:
             - sets a list of variables that should have their values logged
             - format: comma-separated list of variable names. For dicts use dots
-              in the names to indicate the dict level.
+              in the names to indicate the dict level. List items can be
+              addressed by index, e.g. apps[0].version, or all at once, e.g.
+              apps[*].version, which logs a list. Variables that are not
+              defined are logged as null. Invalid names are left out with a
+              warning.
             - default: None
+
+        ANSIBLE_AUDITLOG_BUFFER_SIZE:
+            - number of bytes to buffer in memory before writing to the
+              logfile. The buffer is also flushed at task boundaries, at the
+              end of the playbook and when ansible exits.
+            - values: 0 writes every line immediately
+            - default: 65536
+
+        ANSIBLE_AUDITLOG_BUFFER_LINES:
+            - number of lines to buffer in memory before writing to the
+              logfile, regardless of their size
+            - values: 0 disables the line limit
+            - default: 1000
+
+        ANSIBLE_AUDITLOG_ASYNC:
+            - writes the logfile from a background thread, so slow storage
+              does not slow down the playbook. If the writer fails,
+              ANSIBLE_AUDITLOG_FAILMODE decides wether to warn or fail.
+            - values: true|false
+            - default: false
+
+        ANSIBLE_AUDITLOG_QUEUE_SIZE:
+            - number of entries the background writer can have queued
+            - default: 10000
+
+        ANSIBLE_AUDITLOG_QUEUE_POLICY:
+            - what to do when the background writer queue is full
+            - values: block (wait for the writer), drop (discard the entry,
+              the number of discarded entries is logged in
+              playbook_on_stats), spill (queue the entry in a temporary file)
+            - default: block
+
+        ANSIBLE_AUDITLOG_SINK:
+            - where to send log entries. Remote sinks keep one connection
+              open, send entries in batches of ANSIBLE_AUDITLOG_BUFFER_SIZE
+              bytes or ANSIBLE_AUDITLOG_BUFFER_LINES lines and write to the
+              logfile in ANSIBLE_AUDITLOG_LOGDIR while the remote end is down.
+            - values: file, tcp://host:port (newline-delimited JSON),
+              syslog+udp://host[:port], syslog+tcp://host[:port] (RFC5424),
+              http[s]://host[:port]/path (POST of newline-delimited JSON),
+              unix:///path/to/socket (a stream to auditlogd.py),
+              unixgram:///path/to/socket (datagrams to auditlogd.py)
+            - default: file
+
+        ANSIBLE_AUDITLOG_STORAGE:
+            - how entries are stored in ANSIBLE_AUDITLOG_LOGDIR. 'file' writes
+              one <uuid>.log per run. 'segmented' appends all runs to shared
+              segment-<period>.log files, with a segment-<period>.idx index
+              of where the entries of each run are.
+            - values: file|segmented
+            - default: file
+
+        ANSIBLE_AUDITLOG_SEGMENT_PERIOD:
+            - how often a new segment is started when using segmented storage
+            - values: hourly|daily
+            - default: daily
+
+        ANSIBLE_AUDITLOG_HOSTS_FORMAT:
+            - how the hosts of the playbook are logged in playbook_on_start.
+              'list' logs every host name, 'hash' logs the number of hosts
+              and a sha256 of their sorted names, and 'summary' logs the
+              number of hosts and their names as range patterns such as
+              web[01:20].
+            - values: list|hash|summary
+            - default: list
+
+        ANSIBLE_AUDITLOG_BLOBS:
+            - stores the options, inventory and hosts of playbook_on_start
+              and the details of playbook_on_stats once in
+              ANSIBLE_AUDITLOG_LOGDIR/blobs, named by their sha256, and logs
+              a {"$blob": "sha256:<sha256>"} reference instead. Runs with the
+              same values share the blob.
+            - values: true|false
+            - default: false
+
+        ANSIBLE_AUDITLOG_BLOB_MIN_SIZE:
+            - values smaller than this number of bytes are always logged
+              inline
+            - default: 1024
+
+        ANSIBLE_AUDITLOG_SORT_KEYS:
+            - sorts the keys of logged entries. Without sorting, entries are
+              cheaper to encode and start with controlhost, uuid, event and
+              timestamp.
+            - values: true|false
+            - default: true
+
+        ANSIBLE_AUDITLOG_COMPACT_JSON:
+            - writes JSON lines without spaces after separators, which are
+              smaller and, with orjson installed, cheaper to encode. On
+              Python 2, which ansible 1 runs on, non-ASCII characters are
+              still escaped. By default, lines are written like older
+              versions did.
+            - values: true|false
+            - default: false
+
+        ANSIBLE_AUDITLOG_FORMAT:
+            - format of the logfile. 'json' writes a line of JSON per
+              entry, see ANSIBLE_AUDITLOG_COMPACT_JSON. The 'msgpack' format
+              of auditlog2.py
+              is not available, as its key dictionary per file cannot be
+              shared with the forked workers that log the runner events.
+            - values: json
+            - default: json
+
+        ANSIBLE_AUDITLOG_AGGREGATE:
+            - logs one task_summary entry per task instead of one entry per
+              host. Runner events with the same outcome are counted, and the
+              hosts are listed for every outcome except ok, so changes and
+              failures can still be traced to their hosts. The summary is
+              logged when the next task starts and before playbook_on_stats.
+            - values: true|false
+            - default: false
+
+        ANSIBLE_AUDITLOG_AGGREGATE_MAX_HOSTS:
+            - number of hosts a task summary lists before the outcomes so
+              far are logged as a summary with "partial": true, which bounds
+              the memory used per task
+            - default: 10000
+
+        ANSIBLE_AUDITLOG_TIMING:
+            - logs how long tasks take, using a monotonic clock. Runner events
+              get the "latency" of the host in seconds since the task
+              started. The start, duration and latency percentiles of each
+              task are logged in its task_summary, or in a task_end entry
+              when not aggregating, and those of the whole run in
+              playbook_on_stats.
+            - values: true|false
+            - default: false
+
+        ANSIBLE_AUDITLOG_PROFILE:
+            - measures the overhead of the callback itself and logs it in a
+              callback_overhead entry after playbook_on_stats: the calls,
+              wall clock and CPU time of every hook that ran before it, the
+              time spent serializing entries and passing them to the sink,
+              the bytes logged, the number of flushes and the number of
+              writes the sink made
+            - values: true|false
+            - default: false
+
+        ANSIBLE_AUDITLOG_STATS_LAYOUT:
+            - how playbook_on_stats logs the counters of each host. 'legacy'
+              logs them all in its details. 'chunked' and 'columnar' log
+              only the totals there, with the number of hosts and chunks,
+              followed by playbook_on_stats_hosts entries of at most
+              ANSIBLE_AUDITLOG_STATS_CHUNK_HOSTS hosts each. 'chunked' maps
+              each host to its non-zero counters, 'columnar' lists the hosts
+              with a list of values per counter.
+            - values: legacy|chunked|columnar
+            - default: legacy
+
+        ANSIBLE_AUDITLOG_STATS_CHUNK_HOSTS:
+            - number of hosts per playbook_on_stats_hosts entry
+            - default: 1000
+
+        ANSIBLE_AUDITLOG_DURABILITY:
+            - when lines written to the logfile are synced to disk with
+              fdatasync, so they survive a crash of the controller. 'none'
+              leaves it to the OS. 'interval' syncs at most every
+              ANSIBLE_AUDITLOG_SYNC_INTERVAL milliseconds and when the log
+              is closed. 'group' syncs every write of buffered lines, so a
+              task's lines share one sync. 'always' writes and syncs every
+              line before the next one is logged. With segmented storage,
+              a partial line left by a crash is terminated before new lines
+              are appended to the segment.
+            - values: none|interval|group|always
+            - default: none
+
+        ANSIBLE_AUDITLOG_SYNC_INTERVAL:
+            - milliseconds between syncs with ANSIBLE_AUDITLOG_DURABILITY=
+              interval
+            - default: 1000
+
+        ANSIBLE_AUDITLOG_COMPRESSION:
+            - compresses the logfile. Every write of buffered lines is
+              compressed on its own, as a gzip member or zstd frame, so the
+              file can be read up to the last complete write after a crash.
+              The logfile is named <uuid>.log.gz or <uuid>.log.zst, which
+              gunzip, zstd -d and auditlog_query.py read. zstd needs the
+              zstandard module. Needs ANSIBLE_AUDITLOG_STORAGE=file.
+            - values: none|gzip|zstd
+            - default: none
+
+        ANSIBLE_AUDITLOG_ROTATE_SIZE:
+            - starts a new logfile once the logfile has this many bytes on
+              disk. The files of a run are <uuid>.log, <uuid>.1.log,
+              <uuid>.2.log and so on, followed by .gz or .zst when
+              compressed, and each is readable on its own. Needs
+              ANSIBLE_AUDITLOG_STORAGE=file.
+            - values: 0 never rotates by size
+            - default: 0
+
+        ANSIBLE_AUDITLOG_ROTATE_AGE:
+            - starts a new logfile once the logfile is this many seconds
+              old. Files are only rotated after a write, so a file can be a
+              little older than this.
+            - values: 0 never rotates by age
+            - default: 0
+
+        ANSIBLE_AUDITLOG_CATALOG:
+            - keeps a row per run in the SQLite database
+              ANSIBLE_AUDITLOG_LOGDIR/catalog.db, with the playbook, the
+              start and end time, the users, the check mode and the
+              counters of playbook_on_stats, and maps the run to the hosts
+              of its inventory and the hosts it processed.
+              auditlog_query.py uses it to skip the logs of runs that
+              cannot match, and can rebuild it from the logs.
+              The row is written by the playbook_on_start and
+              playbook_on_stats hooks, so those events have to be logged.
+              If the catalog cannot be updated, it is given up with a
+              warning, or the error is raised with
+              ANSIBLE_AUDITLOG_FAILMODE=fail.
+            - values: true|false
+            - default: false
+
+        ANSIBLE_AUDITLOG_METRICS:
+            - path of a Prometheus textfile, e.g. for the textfile
+              collector of node_exporter, with the progress of the run: the
+              results per status and module, the unreachable hosts, the
+              completed tasks, the entries logged and dropped, the bytes
+              written and the depth of the writer queue. It is rewritten
+              atomically every ANSIBLE_AUDITLOG_METRICS_INTERVAL
+              milliseconds by a background thread, and once more at the
+              end of the run. Results of events that are not logged are
+              not counted. Concurrent runs need a file each.
+            - default: None
+
+        ANSIBLE_AUDITLOG_METRICS_INTERVAL:
+            - milliseconds between rewrites of ANSIBLE_AUDITLOG_METRICS
+            - default: 5000
+
+        ANSIBLE_AUDITLOG_EVENTS:
+            - which events are logged. The hooks of the other events do
+              nothing, except keep track of the plays and tasks and flush
+              the log at task boundaries and the end of the run. Runner
+              events that are not logged are not counted in task_summary
+              either.
+            - format: comma-separated list of events to log, of events
+              prefixed with + to log as well and of events prefixed with !
+              to leave out, e.g.
+              runner_on_failed,runner_on_unreachable,playbook_on_start or
+              !runner_on_ok
+            - values: runner_on_ok, runner_on_failed, runner_on_error,
+              runner_on_unreachable, runner_on_async_ok,
+              runner_on_async_failed, playbook_on_start,
+              playbook_on_play_start, playbook_on_task_start,
+              playbook_on_stats
+            - default: all events
     """
 
+    # The hook that logs each event, and the method that does the
+    # bookkeeping of the hook when the event is not logged
+    EVENT_HOOKS = {
+        'runner_on_ok': ('runner_on_ok', None),
+        'runner_on_failed': ('runner_on_failed', None),
+        'runner_on_error': ('runner_on_error', None),
+        'runner_on_unreachable': ('runner_on_unreachable', None),
+        'runner_on_async_ok': ('runner_on_async_ok', None),
+        'runner_on_async_failed': ('runner_on_async_failed', None),
+        'playbook_on_start': ('playbook_on_start', '_start_playbook'),
+        'playbook_on_play_start': ('playbook_on_play_start', '_start_play'),
+        'playbook_on_task_start': ('playbook_on_task_start', '_next_task'),
+        'playbook_on_stats': ('playbook_on_stats', '_end_playbook'),
+    }
+    # Events that are only logged when asked for
+    OPT_IN_EVENTS = ()
+
     def __init__(self):
         self.disabled = truthy_string(os.getenv('ANSIBLE_AUDITLOG_DISABLED', 0))
+        if self.disabled:
+            utils.warning('Auditlog has been disabled!')
+            self._filter_events(())
+            return None
+
         self.log_logname = truthy_string(
             os.getenv('ANSIBLE_AUDITLOG_LOGNAME_ENABLED', 1))
         logdir = os.getenv('ANSIBLE_AUDITLOG_LOGDIR', '/var/log/ansible')
         audit_vars = os.getenv('ANSIBLE_AUDITLOG_AUDIT_VARS', None)
         fail_mode = os.getenv('ANSIBLE_AUDITLOG_FAILMODE', 'warn')
-
-        if self.disabled:
-            utils.warning('Auditlog has been disabled!')
-            return None
-
-        # Example: version,my.nested.var
+        buffer_size = os.getenv('ANSIBLE_AUDITLOG_BUFFER_SIZE', 65536)
+        buffer_lines = os.getenv('ANSIBLE_AUDITLOG_BUFFER_LINES', 1000)
+        async_writes = truthy_string(os.getenv('ANSIBLE_AUDITLOG_ASYNC', 0))
+        queue_size = os.getenv('ANSIBLE_AUDITLOG_QUEUE_SIZE', 10000)
+        queue_policy = os.getenv('ANSIBLE_AUDITLOG_QUEUE_POLICY', 'block')
+        sink = os.getenv('ANSIBLE_AUDITLOG_SINK', 'file')
+        storage = os.getenv('ANSIBLE_AUDITLOG_STORAGE', 'file')
+        segment_period = os.getenv('ANSIBLE_AUDITLOG_SEGMENT_PERIOD', 'daily')
+        self.hosts_format = os.getenv('ANSIBLE_AUDITLOG_HOSTS_FORMAT', 'list')
+        blobs = truthy_string(os.getenv('ANSIBLE_AUDITLOG_BLOBS', 0))
+        blob_min_size = os.getenv('ANSIBLE_AUDITLOG_BLOB_MIN_SIZE', 1024)
+        sort_keys = truthy_string(os.getenv('ANSIBLE_AUDITLOG_SORT_KEYS', 1))
+        compact_json = truthy_string(
+            os.getenv('ANSIBLE_AUDITLOG_COMPACT_JSON', 0))
+        record_format = os.getenv('ANSIBLE_AUDITLOG_FORMAT', 'json')
+        aggregate = truthy_string(os.getenv('ANSIBLE_AUDITLOG_AGGREGATE', 0))
+        aggregate_max_hosts = os.getenv(
+            'ANSIBLE_AUDITLOG_AGGREGATE_MAX_HOSTS', 10000)
+        timing = truthy_string(os.getenv('ANSIBLE_AUDITLOG_TIMING', 0))
+        profile = truthy_string(os.getenv('ANSIBLE_AUDITLOG_PROFILE', 0))
+        self.stats_layout = os.getenv('ANSIBLE_AUDITLOG_STATS_LAYOUT',
+                                      'legacy')
+        stats_chunk_hosts = os.getenv('ANSIBLE_AUDITLOG_STATS_CHUNK_HOSTS',
+                                      1000)
+        durability = os.getenv('ANSIBLE_AUDITLOG_DURABILITY', 'none')
+        sync_interval = os.getenv('ANSIBLE_AUDITLOG_SYNC_INTERVAL', 1000)
+        events = os.getenv('ANSIBLE_AUDITLOG_EVENTS', '')
+        catalog = truthy_string(os.getenv('ANSIBLE_AUDITLOG_CATALOG', 0))
+        metrics = os.getenv('ANSIBLE_AUDITLOG_METRICS', '')
+        metrics_interval = os.getenv('ANSIBLE_AUDITLOG_METRICS_INTERVAL',
+                                     5000)
+        compression = os.getenv('ANSIBLE_AUDITLOG_COMPRESSION', 'none')
+        rotate_size = os.getenv('ANSIBLE_AUDITLOG_ROTATE_SIZE', 0)
+        rotate_age = os.getenv('ANSIBLE_AUDITLOG_ROTATE_AGE', 0)
+        self.fail_mode = fail_mode
+
+        # Example: version,my.nested.var,apps[*].version
         if audit_vars:
-            # Only allow alphanumeric + _ + .
-            pattern = re.compile('[^\w.,]+', re.UNICODE)
-            self.audit_vars = pattern.sub('', audit_vars).split(',')
+            # Only allow alphanumeric + _ + . + list indexes
+            pattern = re.compile('[^\w.,\\[\\]*-]+', re.UNICODE)
+            self.audit_vars = [v for v in
+                               pattern.sub('', audit_vars).split(',') if v]
             # convert to dict
-            self.audit_vars = dict((el, 0) for el in self.audit_vars)
+            self.audit_vars = dict((el, None) for el in self.audit_vars)
         else:
             self.audit_vars = {}
 
         try:
-            self.logger = JsonAuditLogger(logdir=logdir)
+            self.audit_paths = AuditVarPaths(self.audit_vars)
+            for path in self.audit_paths.invalid:
+                utils.warning('Ignoring invalid audit var: {}'.format(path))
+                del self.audit_vars[path]
+            # Only these top-level variables are ever looked up
+            self.audit_var_roots = self.audit_paths.roots
+
+            if self.hosts_format not in HOSTS_FORMATS:
+                raise ValueError("Unknown hosts format: {}".format(
+                    self.hosts_format))
+            if self.stats_layout not in STATS_LAYOUTS:
+                raise ValueError("Unknown stats layout: {}".format(
+                    self.stats_layout))
+            self.stats_chunk_hosts = int(stats_chunk_hosts)
+            if self.stats_chunk_hosts < 1:
+                raise ValueError("Invalid stats chunk size: {}".format(
+                    stats_chunk_hosts))
+            events = parse_events(events, self.EVENT_HOOKS,
+                                  self.OPT_IN_EVENTS)
+            if record_format == 'msgpack':
+                # Forked workers would each extend their own copy of the key
+                # dictionary of the file
+                raise ValueError("The msgpack format needs ansible 2")
+            self.logger = JsonAuditLogger(logdir=logdir,
+                                          buffer_size=int(buffer_size),
+                                          buffer_lines=int(buffer_lines),
+                                          async_writes=async_writes,
+                                          queue_size=int(queue_size),
+                                          queue_policy=queue_policy,
+                                          error_handler=self._logging_failed,
+                                          sink=sink,
+                                          storage=storage,
+                                          segment_period=segment_period,
+                                          blobs=blobs,
+                                          blob_min_size=int(blob_min_size),
+                                          sort_keys=sort_keys,
+                                          record_format=record_format,
+                                          durability=durability,
+                                          sync_interval=int(
+                                              sync_interval) / 1000.0,
+                                          compression=compression,
+                                          rotate_size=int(rotate_size),
+                                          rotate_age=int(rotate_age),
+                                          compact_json=compact_json)
+
+            # Runner events are either logged or counted by the aggregator
+            self.aggregator = None
+            self.log_result = self.logger.log
+            if aggregate:
+                self.aggregator = TaskAggregator(
+                    self.logger, max_hosts=int(aggregate_max_hosts))
+                self.log_result = self.aggregator.add
+                # Runs after the logger is closed otherwise, as atexit
+                # handlers run in reverse order
+                self._at_exit(self.aggregator.flush)
+
+            self.timer = None
+            self.task_name = None
+            if timing:
+                self.timer = RunTimer()
+                self._log_untimed_result = self.log_result
+                self.log_result = self._log_timed_result
+
+            self.metrics = None
+            if metrics:
+                self.metrics = RunMetrics(
+                    metrics, self.logger,
+                    interval=int(metrics_interval) / 1000.0)
+                self._at_exit(self.metrics.close)
+                self._log_uncounted_result = self.log_result
+                self.log_result = self._log_counted_result
+
+            # Runner events of forked workers bypass all of the above
+            self.pid = os.getpid()
+            self._log_parent_result = self.log_result
+            self.log_result = self._log_result
+
+            self.catalog = None
+            if catalog:
+                self.catalog = RunCatalog(os.path.join(logdir, 'catalog.db'))
+                self._at_exit(self.catalog.close)
+
+            self._filter_events(events)
+
+            self.profiler = None
+            if profile:
+                self.profiler = CallbackProfiler()
+                self.profiler.instrument(self, self.logger)
         except Exception as e:
             msg = 'Unable to initialize audit logging: {}'.format(str(e))
             self.disabled = True
+            self._filter_events(())
             utils.warning(msg)
             if fail_mode == 'fail':
                 print(str(e))
                 sys.exit(1)
 
+    def _logging_failed(self, e):
+        msg = 'Audit logging failed: {}'.format(str(e))
+        utils.warning(msg)
+        if self.fail_mode == 'fail':
+            print(str(e))
+            sys.exit(1)
+
+    def _update_catalog(self, update, *args):
+        """Updates the run catalog, which is given up after an error. The
+        error is only raised in fail mode."""
+        try:
+            update(*args)
+        except Exception as e:
+            self.catalog = None
+            if self.fail_mode == 'fail':
+                raise
+            utils.warning('Updating the run catalog failed: {}'.format(str(e)))
+
+    def _at_exit(self, handler):
+        """Runs handler when ansible exits, but not when a forked worker
+        does, whose state is a copy of that of ansible"""
+        pid = os.getpid()
+
+        def run():
+            if os.getpid() == pid:
+                handler()
+        atexit.register(run)
+
+    def _log_result(self, event_id, log_entry):
+        if os.getpid() == self.pid:
+            self._log_parent_result(event_id, log_entry)
+            return
+
+        # A forked worker, whose aggregator, timer and metrics are copies
+        # that are thrown away when it exits
+        if self.timer is not None:
+            log_entry['latency'] = self.timer.result()
+        self.logger.log(event_id, log_entry)
+
+    def _log_counted_result(self, event_id, log_entry):
+        self.metrics.result(event_id, log_entry)
+        self._log_uncounted_result(event_id, log_entry)
+
+    def _log_timed_result(self, event_id, log_entry):
+        log_entry['latency'] = self.timer.result()
+        self._log_untimed_result(event_id, log_entry)
+
+    def _skip(self, *args, **kwargs):
+        pass
+
+    def _filter_events(self, events):
+        """Replaces the hooks of the events that are not logged.
+
+        The hooks are replaced by the bookkeeping they still have to do, or
+        by no-ops. When disabled, all of them become no-ops.
+        """
+        for event, (hook, bookkeeping) in self.EVENT_HOOKS.items():
+            if event in events:
+                continue
+            if bookkeeping is None or self.disabled:
+                setattr(self, hook, self._skip)
+            else:
+                setattr(self, hook, getattr(self, bookkeeping))
+
+    def _start_task(self, name):
+        """Logs the end of the previous task and starts timing this one"""
+        self._end_task()
+        self.task_name = name
+        if self.aggregator is not None:
+            self.aggregator.start(name)
+        if self.timer is not None:
+            self.timer.start_task()
+
+    def _end_task(self):
+        if self.metrics is not None and self.task_name is not None:
+            self.metrics.tasks_completed += 1
+        timing = self.timer.end_task() if self.timer is not None else None
+        if self.aggregator is not None:
+            self.aggregator.flush(timing)
+        elif timing is not None:
+            self.logger.log('task_end', {
+                'task': self.task_name,
+                'timing': timing,
+            })
+
     def on_any(self, *args, **kwargs):
         pass
 
     def runner_on_failed(self, host, res, ignore_errors=False):
         module_name = res.get('invocation', {}).get('module_name', '')
-        self.logger.log('runner_on_failed', {
+        self.log_result('runner_on_failed', {
             'inventory_host': host,
             'module_name': module_name,
             'ignore_errors': ignore_errors,
@@ -175,7 +598,7 @@ class CallbackModule(object):
     def runner_on_ok(self, host, res):
         changed = 'changed' if res.get('changed', False) else 'ok'
         module_name = res.get('invocation', {}).get('module_name', '')
-        self.logger.log('runner_on_ok', {
+        self.log_result('runner_on_ok', {
             'inventory_host': host,
             'status': changed,
             'module_name': module_name
@@ -185,13 +608,13 @@ class CallbackModule(object):
         pass
 
     def runner_on_error(self, host, msg):
-        self.logger.log('runner_on_error', {
+        self.log_result('runner_on_error', {
             'inventory_host': host,
             'msg': msg,
             })
 
     def runner_on_unreachable(self, host, res):
-        self.logger.log('runner_on_unreachable', {
+        self.log_result('runner_on_unreachable', {
             'inventory_host': host,
             })
 
@@ -203,14 +626,14 @@ class CallbackModule(object):
 
     def runner_on_async_ok(self, host, res, jid):
         module_name = res.get('invocation', {}).get('module_name', '')
-        self.logger.log('runner_on_async_ok', {
+        self.log_result('runner_on_async_ok', {
             'inventory_host': host,
             'module_name': module_name,
             })
 
     def runner_on_async_failed(self, host, res, jid):
         module_name = res.get('invocation', {}).get('module_name', '')
-        self.logger.log('runner_on_async_failed', {
+        self.log_result('runner_on_async_failed', {
             'inventory_host': host,
             'module_name': module_name,
             })
@@ -218,11 +641,19 @@ class CallbackModule(object):
     def runner_on_file_diff(self, host, diff):
         pass
 
-    def playbook_on_start(self):
-        # These are not used until `playbook_on_play_start`
-        self.my_vars = self.playbook.global_vars
+    def _audit_roots_in(self, variables):
+        return dict((k, variables[k]) for k in self.audit_var_roots
+                    if k in variables)
+
+    def _start_playbook(self):
+        # These are not used until `playbook_on_play_start`. Only the
+        # variables needed for the audit vars are kept.
         self.my_vars = utils.combine_vars(
-            self.my_vars, self.playbook.extra_vars)
+            self._audit_roots_in(self.playbook.global_vars),
+            self._audit_roots_in(self.playbook.extra_vars))
+
+    def playbook_on_start(self):
+        self._start_playbook()
 
         # This gets us the user that originally spawed the ansible process.
         # Watch out: On Linux, if you (yes, you) started some process that
@@ -230,16 +661,15 @@ class CallbackModule(object):
         # listed as the user running ansible, even though you started jenkins
         # indirectly (e.g. using "sudo service jenkins start").
         if self.log_logname:
-            p = Popen(['logname'], stdout=PIPE)
-            logname = p.stdout.readline().rstrip('\n')
-            p.terminate()
+            logname = get_logname() or ''
         else:
             logname = None
 
+        hosts = self.playbook.inventory.list_hosts()
         log_entry = {
             'playbook': self.playbook.filename,
-            'hosts': self.playbook.inventory.list_hosts(),
-            'inventory': self.playbook.inventory.host_list,
+            'hosts': self.logger.blob(format_hosts(hosts, self.hosts_format)),
+            'inventory': self.logger.blob(self.playbook.inventory.host_list),
             'only_tags': self.playbook.only_tags,
             'skip_tags': self.playbook.skip_tags,
             'check_mode': self.playbook.check,
@@ -258,7 +688,14 @@ class CallbackModule(object):
             'logname': logname,
         }
 
-        self.logger.log('playbook_on_start', log_entry)
+        timestamp = self.logger.log('playbook_on_start', log_entry)
+        if self.metrics is not None:
+            self.metrics.playbook = self.playbook.filename
+        if self.catalog is not None:
+            self._update_catalog(self.catalog.start_run, self.logger.uuid,
+                                 self.logger.hostname,
+                                 self.logger.run_logfile, timestamp,
+                                 log_entry, self.playbook.check, hosts)
 
     def playbook_on_notify(self, host, handler):
         pass
@@ -269,10 +706,18 @@ class CallbackModule(object):
     def playbook_on_no_hosts_remaining(self):
         pass
 
+    def _next_task(self, name, is_conditional):
+        self._start_task(name)
+        # Results of the previous task are written before the next one starts
+        self.logger.flush()
+
     def playbook_on_task_start(self, name, is_conditional):
+        self._next_task(name, is_conditional)
         self.logger.log('playbook_on_task_start', {
             'name': name,
             })
+        # Written before the forked workers write the results of the task
+        self.logger.flush()
 
     def playbook_on_vars_prompt(
             self, varname, private=True, prompt=None, encrypt=None,
@@ -288,21 +733,28 @@ class CallbackModule(object):
     def playbook_on_not_import_for_host(self, host, missing_file):
         pass
 
-    def playbook_on_play_start(self, pattern):
+    def _start_play(self, pattern):
+        """Collects the audit vars of the play. Returns False if it has no
+        hosts."""
         self.inventory = self.playbook.inventory
 
-        # Don't log empty plays
         hosts_in_play = self.inventory.list_hosts(self.play.hosts)
         if len(hosts_in_play) == 0:
-            return
+            return False
 
-        # Combine inventory vars, global vars and extra vars
-        self.my_vars = utils.combine_vars(self.my_vars, self.play.vars)
+        if self.audit_vars:
+            # Combine inventory vars, global vars and extra vars
+            self.my_vars = utils.combine_vars(
+                self.my_vars, self._audit_roots_in(self.play.vars))
 
-        # This are not used until `playbook_on_stats`
-        for myvar in self.audit_vars:
-            val = get_dotted_val_in_dict(self.my_vars, myvar)
-            self.audit_vars[myvar] = val
+            # This are not used until `playbook_on_stats`
+            self.audit_vars.update(self.audit_paths.evaluate(self.my_vars))
+        return True
+
+    def playbook_on_play_start(self, pattern):
+        # Don't log empty plays
+        if not self._start_play(pattern):
+            return
 
         self.logger.log('playbook_on_play_start', {
             'name': self.play.name,
@@ -318,27 +770,64 @@ class CallbackModule(object):
             'max_fail_percentage': self.play.max_fail_pct,
             'hosts': self.play.hosts,
             })
+        self.logger.flush()
 
     def playbook_on_stats(self, stats):
         stats_keys = ['processed', 'failures', 'ok', 'dark', 'changed',
                       'skipped']
-        summary_stats_keys = ['failures', 'ok', 'unreachable', 'changed',
-                              'skipped']
-        log_entry = {'stats': {'summary': {}, 'details': {}}}
+        log_entry = {'stats': {'summary': summarize_stats(stats)}}
 
-        for key in stats_keys:
-            log_entry['stats']['details'][key] = {}
-            log_entry['stats']['details'][key] = getattr(stats, key)
+        if self.stats_layout == 'legacy':
+            details = dict((key, getattr(stats, key)) for key in stats_keys)
+            log_entry['stats']['details'] = self.logger.blob(details)
+        else:
+            # The counters of the hosts follow in playbook_on_stats_hosts
+            # entries
+            hosts = len(stats.processed)
+            log_entry['stats']['layout'] = self.stats_layout
+            log_entry['stats']['hosts'] = hosts
+            log_entry['stats']['chunks'] = int(
+                math.ceil(hosts / float(self.stats_chunk_hosts)))
 
-        for key in summary_stats_keys:
-            log_entry['stats']['summary'][key] = 0
+        log_entry['audit_vars'] = self.audit_vars
 
-        hosts = sorted(stats.processed.keys())
-        for h in hosts:
-            s = stats.summarize(h)
-            for key in summary_stats_keys:
-                log_entry['stats']['summary'][key] += s[key]
+        self._end_task()
+        if self.timer is not None:
+            log_entry['timing'] = self.timer.summary()
 
-        log_entry['audit_vars'] = self.audit_vars
+        # Drain the writer first, so the stats are never dropped and include
+        # every entry discarded before them
+        self.logger.flush()
+        if self.logger.dropped:
+            log_entry['dropped_events'] = self.logger.dropped
 
         self.logger.log('playbook_on_stats', log_entry)
+        if self.stats_layout != 'legacy':
+            chunks = stats_chunks(stats, self.stats_layout,
+                                  self.stats_chunk_hosts)
+            for i, chunk in enumerate(chunks):
+                chunk['chunk'] = i
+                chunk['layout'] = self.stats_layout
+                self.logger.log('playbook_on_stats_hosts', chunk)
+        self._end_run()
+
+        if self.catalog is not None:
+            self._update_catalog(self.catalog.end_run, self.logger.uuid,
+                                 log_entry['stats']['summary'],
+                                 list(stats.processed))
+
+    def _end_playbook(self, stats):
+        """Ends the run without logging the stats"""
+        self._end_task()
+        self._end_run()
+
+    def _end_run(self):
+        self.logger.flush()
+        if self.profiler is not None:
+            self.logger.log('callback_overhead', self.profiler.report())
+            self.logger.flush()
+        if self.metrics is not None:
+            try:
+                self.metrics.finish()
+            except EnvironmentError as e:
+                self._logging_failed(e)
@@ -0,0 +1,2258 @@
+# Code shared by the auditlog callback plugins, auditlog.py for ansible 1
+# and auditlog2.py for ansible 2.1+, and the tools that use their sinks.
+#
+# Install this directory next to the plugin, e.g. in callback_plugins/. It is
+# a package, so ansible does not try to load it as a callback plugin itself.
+#
+# The plugins import it even when ANSIBLE_AUDITLOG_DISABLED is set. The
+# stdlib modules imported below are all imported by ansible-playbook before
+# it loads callback plugins, so they cost nothing. Modules only some settings
+# need, such as uuid, hashlib, sqlite3, http.client or orjson, are
+# imported where they are used. With ansible-core 2.19 on Python 3.11, a
+# disabled auditlog2.py took about 2.5ms to import, for the bytecode and
+# classes of this module, and 0.3ms to initialize.
+
+import os
+import sys
+import atexit
+import bisect
+import threading
+import errno
+import datetime
+import time
+import math
+import struct
+import socket
+import json
+import re
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+# time.monotonic is not available on Python 2
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class AuditVarPaths(object):
+    """Paths to audit vars, compiled once and evaluated in one pass.
+
+    A path is a dotted variable name, where list items can be addressed by
+    index (apps[0].version) or all at once (apps[*].version), which yields a
+    list with the value for each item that has it. Paths sharing a prefix
+    share the walk over the variables, so many paths cost little more than
+    one.
+
+    Examples:
+
+        >>> paths = AuditVarPaths(['a.b', 'a.c', 'apps[*].v', 'apps[1].v'])
+        >>> sorted(paths.evaluate({'a': {'b': 0}, 'apps': [{'v': 1}, {}]})
+        ...        .items())
+        [('a.b', 0), ('a.c', None), ('apps[*].v', [1]), ('apps[1].v', None)]
+    """
+
+    # Step addressing all items of a list
+    ALL = ('*',)
+    STEP = re.compile(r'([^.\[\]]+)|\[(-?\d+|\*)\]|(\.)')
+
+    def __init__(self, paths):
+        self.paths = []
+        # Paths that cannot be parsed, which are left out
+        self.invalid = []
+        # Each node is ({step: child node}, [paths ending at this node])
+        self._tree = ({}, [])
+        for path in paths:
+            try:
+                steps = self.parse(path)
+            except ValueError:
+                self.invalid.append(path)
+                continue
+            self.paths.append(path)
+            node = self._tree
+            for step in steps:
+                node = node[0].setdefault(step, ({}, []))
+            node[1].append(path)
+
+    @property
+    def roots(self):
+        """The top-level variable names used by the paths"""
+        return set(self._tree[0])
+
+    @classmethod
+    def parse(cls, path):
+        """Splits a path into its steps: keys, indexes and ALL"""
+        steps = []
+        pos = 0
+        expect_key = True
+        for m in cls.STEP.finditer(path):
+            if m.start() != pos:
+                break
+            key, index, dot = m.groups()
+            if key is not None and expect_key:
+                steps.append(key)
+                expect_key = False
+            elif index is not None and not expect_key:
+                steps.append(cls.ALL if index == '*' else int(index))
+            elif dot is not None and not expect_key:
+                expect_key = True
+            else:
+                break
+            pos = m.end()
+
+        if pos != len(path) or expect_key:
+            raise ValueError("Invalid audit var: {}".format(path))
+        return steps
+
+    def evaluate(self, variables):
+        """Returns the value of each path, or None where it is missing"""
+        found = {}
+        self._walk(self._tree, variables, found)
+        return dict((p, found.get(p)) for p in self.paths)
+
+    @classmethod
+    def _walk(cls, node, value, found):
+        children, ending = node
+        for path in ending:
+            found[path] = value
+
+        for step, child in children.items():
+            if step == cls.ALL:
+                if isinstance(value, list):
+                    cls._walk_all(child, value, found)
+                continue
+
+            if isinstance(step, int):
+                if not isinstance(value, list) or not (
+                        -len(value) <= step < len(value)):
+                    continue
+            elif not isinstance(value, dict) or step not in value:
+                continue
+            cls._walk(child, value[step], found)
+
+    @classmethod
+    def _walk_all(cls, node, items, found):
+        collected = {}
+        for item in items:
+            item_found = {}
+            cls._walk(node, item, item_found)
+            for path, value in item_found.items():
+                collected.setdefault(path, []).append(value)
+
+        for path in cls._paths_below(node):
+            found[path] = collected.get(path, [])
+
+    @classmethod
+    def _paths_below(cls, node):
+        children, ending = node
+        paths = list(ending)
+        for child in children.values():
+            paths.extend(cls._paths_below(child))
+        return paths
+
+
+# Compiled paths of get_dotted_val_in_dict, by key
+_dotted_paths = {}
+
+
+def get_dotted_val_in_dict(d, keys):
+    """Searches dict d for element in keys.
+
+    Keys can address list items like audit vars do. Keys that are no valid
+    audit var path, e.g. with spaces in them, are split at the dots and
+    looked up as dict keys.
+
+    Args:
+        d (dict): Dictionary to search
+        keys (str): String containing element to search for
+
+    Returns:
+        Value found at the specified element if found, else None
+
+    Examples:
+
+        Search for the value of foo['bar'] in {'foo': {'bar': 1}}
+        >>> get_dotted_val_in_dict({'foo': {'bar': 1}}, 'foo.bar')
+        1
+
+        Search for the value of foo['baz'] in {'foo': {'bar': 1}}
+        >>> get_dotted_val_in_dict({'foo': {'bar': 1}}, 'foo.baz')
+    """
+    paths = _dotted_paths.get(keys)
+    if paths is None:
+        if len(_dotted_paths) >= 1024:
+            _dotted_paths.clear()
+        paths = _dotted_paths[keys] = AuditVarPaths([keys])
+    if paths.paths:
+        return paths.evaluate(d)[keys]
+
+    for key in keys.split('.'):
+        if not isinstance(d, dict) or key not in d:
+            return None
+        d = d[key]
+    return d
+
+
+def truthy_string(s):
+    """Determines if a string has a truthy value"""
+    return str(s).lower() in ['true', '1', 'y', 'yes']
+
+
+def parse_events(spec, known, opt_in=()):
+    """Returns the events to log from a comma-separated list of events.
+
+    Without events that are not prefixed, all known events except the opt_in
+    events are logged. Events prefixed with + are logged as well, events
+    prefixed with ! are left out.
+    """
+    include = set()
+    extra = set()
+    exclude = set()
+    for name in spec.split(','):
+        name = name.strip()
+        if not name:
+            continue
+        events = {'!': exclude, '+': extra}.get(name[0], include)
+        name = name.lstrip('!+')
+        if name not in known:
+            raise ValueError("Unknown event: {}".format(name))
+        events.add(name)
+    if not include:
+        include = set(known) - set(opt_in)
+    return (include | extra) - exclude
+
+
+_logname = []
+
+
+def get_logname():
+    """Returns the name of the user logged in on the controlling terminal.
+
+    This is what `logname` prints, which stays the same through su and sudo.
+    Returns None if there is no such user, e.g. when run from cron. It is
+    looked up once per process.
+    """
+    if not _logname:
+        try:
+            _logname.append(os.getlogin())
+        except OSError:
+            _logname.append(None)
+    return _logname[0]
+
+
+HOSTS_FORMATS = ('list', 'hash', 'summary')
+HOST_NUMBER = re.compile(r'^(.*?)(\d+)(\D*)$')
+
+
+def summarize_hosts(hosts):
+    """Summarizes host names as ansible range patterns.
+
+    Names that only differ in a number are collapsed into ranges. Names
+    without a number, and numbers without neighbours, are kept as they are.
+
+    Examples:
+
+        >>> summarize_hosts(['web01', 'web02', 'web03', 'db1', 'lb'])
+        ['db1', 'lb', 'web[01:03]']
+    """
+    groups = {}
+    patterns = []
+    for host in hosts:
+        m = HOST_NUMBER.match(host)
+        if m:
+            prefix, number, suffix = m.groups()
+            key = (prefix, suffix, len(number))
+            groups.setdefault(key, []).append(int(number))
+        else:
+            patterns.append(host)
+
+    for (prefix, suffix, width), numbers in groups.items():
+        numbers.sort()
+        start = prev = numbers[0]
+        for n in numbers[1:] + [None]:
+            if n is not None and n <= prev + 1:
+                prev = n
+                continue
+            if start == prev:
+                patterns.append('{}{:0{w}d}{}'.format(prefix, start, suffix,
+                                                      w=width))
+            else:
+                patterns.append('{}[{:0{w}d}:{:0{w}d}]{}'.format(
+                    prefix, start, prev, suffix, w=width))
+            start = prev = n
+
+    return sorted(patterns)
+
+
+def format_hosts(hosts, style='list'):
+    """Formats a list of host names for the log.
+
+    Args:
+        hosts (list): Host names
+        style (str): 'list' logs the names as they are, 'hash' logs the
+            number of hosts and a sha256 of the sorted names, and 'summary'
+            logs the number of hosts and their names as range patterns
+    """
+    if style == 'list':
+        return hosts
+    if style == 'hash':
+        import hashlib
+        digest = hashlib.sha256('\n'.join(sorted(hosts)).encode('utf-8'))
+        return {'count': len(hosts), 'sha256': digest.hexdigest()}
+    if style == 'summary':
+        return {'count': len(hosts), 'patterns': summarize_hosts(hosts)}
+    raise ValueError("Unknown hosts format: {}".format(style))
+
+
+STATS_LAYOUTS = ('legacy', 'chunked', 'columnar')
+# Counters of the stats summary, and the AggregateStats dict they come from
+STATS_COUNTERS = (
+    ('failures', 'failures'),
+    ('ok', 'ok'),
+    ('unreachable', 'dark'),
+    ('changed', 'changed'),
+    ('skipped', 'skipped'),
+)
+
+
+def summarize_stats(stats):
+    """Returns the totals of the counters of all hosts.
+
+    This is the sum of stats.summarize() over all hosts, added up directly
+    from the counters instead of host by host.
+    """
+    return dict((name, sum(getattr(stats, attr).values()))
+                for name, attr in STATS_COUNTERS)
+
+
+def stats_chunks(stats, layout, chunk_hosts=1000):
+    """Yields the counters of the hosts in chunks of at most chunk_hosts hosts.
+
+    Args:
+        stats (AggregateStats): Stats of the run
+        layout (str): 'chunked' maps each host name to its non-zero counters,
+            'columnar' lists the host names under 'hosts' with a list of
+            values in the same order for each counter
+        chunk_hosts (int): Maximum number of hosts in a chunk
+    """
+    hosts = sorted(stats.processed)
+    counters = [(name, getattr(stats, attr)) for name, attr in STATS_COUNTERS]
+    for start in range(0, len(hosts), chunk_hosts):
+        chunk = hosts[start:start + chunk_hosts]
+        if layout == 'columnar':
+            columns = {'hosts': chunk}
+            for name, counts in counters:
+                columns[name] = [counts.get(h, 0) for h in chunk]
+            yield columns
+        else:
+            yield {'hosts': dict(
+                (h, dict((name, counts[h]) for name, counts in counters
+                         if counts.get(h)))
+                for h in chunk)}
+
+
+class AuditLogWriterError(Exception):
+    """Raised when the background writer was unable to write the logfile"""
+
+
+class AsyncLogWriter(object):
+    """Writes auditlog entries from a background thread.
+
+    Entries are put on a bounded queue and written in batches, so slow
+    storage does not hold up ansible. The policy decides what happens when
+    the queue is full:
+
+        block: wait for the writer to catch up
+        drop: discard the entry and count it in `dropped`
+        spill: pickle the entry to a temporary file, which the writer
+               replays once the queue has drained
+    """
+
+    POLICIES = ('block', 'drop', 'spill')
+    BATCH_SIZE = 500
+
+    _FLUSH = object()
+    _STOP = object()
+
+    def __init__(self, logger, queue_size=10000, policy='block'):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown queue policy: {}".format(policy))
+
+        self.logger = logger
+        self.policy = policy
+        self.dropped = 0
+        self.error = None
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._spill = None
+        self._spilling = False
+
+        self._thread = threading.Thread(target=self._run,
+                                        name='auditlog-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def depth(self):
+        """Number of entries waiting to be written"""
+        return self._queue.qsize()
+
+    def put(self, event_id, timestamp, log_entry):
+        if self.error is not None:
+            raise AuditLogWriterError(str(self.error))
+
+        item = (event_id, timestamp, log_entry)
+        if self.policy == 'block':
+            self._queue.put(item)
+            return
+
+        with self._lock:
+            if not self._spilling:
+                try:
+                    self._queue.put_nowait(item)
+                    return
+                except queue.Full:
+                    if self.policy == 'drop':
+                        self.dropped += 1
+                        return
+                    self._spilling = True
+
+            # Once spilling has started every entry goes to the spill file
+            # until the writer has replayed it, which keeps entries in order.
+            if self._spill is None:
+                import tempfile
+                self._spill = tempfile.TemporaryFile(mode='w+b')
+            import pickle
+            pickle.dump(item, self._spill, pickle.HIGHEST_PROTOCOL)
+
+    def flush(self):
+        """Waits until every queued entry has been written"""
+        self._wait(self._FLUSH)
+
+    def close(self):
+        """Drains the queue and stops the writer thread"""
+        if not self._thread.is_alive():
+            return
+        self._wait(self._STOP)
+        self._thread.join()
+
+    def _wait(self, command):
+        done = threading.Event()
+        # Commands always block, regardless of the queue policy
+        self._queue.put((command, done))
+        done.wait()
+        if self.error is not None:
+            raise AuditLogWriterError(str(self.error))
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self.BATCH_SIZE:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            stop = False
+            for item in batch:
+                if item[0] is self._FLUSH or item[0] is self._STOP:
+                    command, done = item
+                    self._write_batch()
+                    done.set()
+                    stop = stop or command is self._STOP
+                elif self.error is None:
+                    try:
+                        self.logger.append(*item)
+                    except Exception as e:
+                        self.error = e
+
+            self._write_batch()
+            if stop:
+                return
+
+    def _write_batch(self):
+        if self.error is not None:
+            return
+        try:
+            with self._lock:
+                if self._spilling and self._queue.empty():
+                    self._replay_spill()
+            self.logger.write_buffer()
+        except Exception as e:
+            self.error = e
+
+    def _replay_spill(self):
+        self._spill.seek(0)
+        while True:
+            try:
+                import pickle
+                item = pickle.load(self._spill)
+            except EOFError:
+                break
+            self.logger.append(*item)
+        self._spill.seek(0)
+        self._spill.truncate()
+        self._spilling = False
+
+
+DURABILITY = ('none', 'interval', 'group', 'always')
+
+# os.fdatasync is not available on every platform
+fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+
+class SyncPolicy(object):
+    """Decides when written lines are synced to disk.
+
+    none: never, the OS writes them back when it sees fit
+    interval: at most every interval seconds, and when the log is closed
+    group: after every write of buffered lines, so all lines of a batch
+        share one sync
+    always: like group, with every line written on its own
+    """
+
+    def __init__(self, durability='none', interval=1.0):
+        if durability not in DURABILITY:
+            raise ValueError("Unknown durability: {}".format(durability))
+        self.durability = durability
+        self.interval = interval
+        self.pending = False
+        self._synced = monotonic()
+
+    def due(self):
+        """Returns whether the data just written has to be synced now"""
+        if self.durability == 'none':
+            return False
+        if self.durability == 'interval':
+            now = monotonic()
+            if now - self._synced < self.interval:
+                self.pending = True
+                return False
+            self._synced = now
+        self.pending = False
+        return True
+
+
+def sync_dir(path):
+    """Syncs a directory, so the files created in it survive a crash"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def ends_with_newline(path):
+    """Returns False if the file at path ends with a partial line"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            return True
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+
+COMPRESSION = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+def frame_compressor(compression):
+    """Returns a function that compresses data into a gzip member or zstd
+    frame of its own, or None for no compression.
+
+    Files of concatenated members or frames are valid gzip and zstd files,
+    and every flush of a file can be decompressed without the ones before.
+    """
+    if compression not in COMPRESSION:
+        raise ValueError("Unknown compression: {}".format(compression))
+    if compression == 'gzip':
+        import zlib
+
+        def compress(data):
+            # wbits=31 writes a gzip header and trailer
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            return compressor.compress(data) + compressor.flush()
+        return compress
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("zstd compression needs the zstandard module")
+        return zstandard.ZstdCompressor().compress
+    return None
+
+
+class FileSink(object):
+    """Appends auditlog lines to a local file.
+
+    Lines are collected in memory and written to a single handle that stays
+    open for the whole run. A buffer_size of 0 writes every line as soon as
+    it is logged. Writes are synced to disk as the SyncPolicy sync says.
+
+    Every write can be compressed on its own, see frame_compressor. Once the
+    file has grown to rotate_size bytes or is rotate_age seconds old, later
+    lines go to a new file, <name>.1.log, <name>.2.log and so on, after
+    on_rotate is called.
+    """
+
+    def __init__(self, path, buffer_size=65536, buffer_lines=1000,
+                 sync=None, compression='none', rotate_size=0, rotate_age=0,
+                 on_rotate=None):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.buffer_lines = buffer_lines
+        self.sync = sync or SyncPolicy()
+        self.compress = frame_compressor(compression)
+        self.rotate_size = rotate_size
+        self.rotate_age = rotate_age
+        self.on_rotate = on_rotate
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._fh = None
+        self._part = 0
+        self._size = 0
+        self._opened = 0
+        # Number of times buffered lines were written
+        self.writes = 0
+
+    def part_path(self, part):
+        """Returns the path of the part'th file of a rotated log"""
+        if not part:
+            return self.path
+        directory, name = os.path.split(self.path)
+        head, sep, tail = name.rpartition('.log')
+        if sep:
+            name = '{}.{}.log{}'.format(head, part, tail)
+        else:
+            name = '{}.{}'.format(name, part)
+        return os.path.join(directory, name)
+
+    @property
+    def current_path(self):
+        """Path of the file lines are appended to"""
+        return self.part_path(self._part)
+
+    def append(self, data):
+        self._buffer.append(data)
+        self._buffered_bytes += len(data)
+
+        if (self._buffered_bytes >= self.buffer_size or
+                (self.buffer_lines and
+                 len(self._buffer) >= self.buffer_lines)):
+            self.flush()
+
+    def flush(self):
+        """Writes buffered lines to the file"""
+        if not self._buffer:
+            return
+
+        if self._fh is None:
+            path = self.current_path
+            self._fh = open(path, 'ab')
+            self._size = os.fstat(self._fh.fileno()).st_size
+            self._opened = monotonic()
+            if self.sync.durability != 'none':
+                sync_dir(os.path.dirname(path) or '.')
+
+        data = b''.join(self._buffer)
+        if self.compress is not None:
+            data = self.compress(data)
+        self._fh.write(data)
+        self._fh.flush()
+        self._size += len(data)
+        self.writes += 1
+        if self.sync.due():
+            fdatasync(self._fh.fileno())
+
+        del self._buffer[:]
+        self._buffered_bytes = 0
+
+        if ((self.rotate_size and self._size >= self.rotate_size) or
+                (self.rotate_age and
+                 monotonic() - self._opened >= self.rotate_age)):
+            self._close_file()
+            self._part += 1
+            if self.on_rotate is not None:
+                self.on_rotate()
+
+    def discard(self):
+        del self._buffer[:]
+        self._buffered_bytes = 0
+
+    def close(self):
+        self.flush()
+        self._close_file()
+
+    def _close_file(self):
+        if self._fh is not None:
+            if self.sync.pending:
+                fdatasync(self._fh.fileno())
+            self._fh.close()
+            self._fh = None
+
+
+class SegmentSink(object):
+    """Appends auditlog lines of all runs to shared, time-bucketed segments.
+
+    Every flush is a single O_APPEND write, so concurrent runs never
+    interleave within each other's lines. For each write an index record of
+    (run uuid, offset, length) is appended to the segment's sidecar index,
+    which is how auditlog_query.py finds the lines of one run again without
+    scanning the segments.
+    """
+
+    PERIODS = {
+        'hourly': '%Y%m%d%H',
+        'daily': '%Y%m%d',
+    }
+    INDEX_RECORD = struct.Struct('<16sQI')
+
+    def __init__(self, logdir, run_uuid, period='daily', buffer_size=65536,
+                 buffer_lines=1000, sync=None):
+        if period not in self.PERIODS:
+            raise ValueError("Unknown segment period: {}".format(period))
+
+        self.logdir = logdir
+        import uuid
+        self.run_id = uuid.UUID(run_uuid).bytes
+        self.period = period
+        self.buffer_size = buffer_size
+        self.buffer_lines = buffer_lines
+        self.sync = sync or SyncPolicy()
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._bucket = None
+        self._fd = None
+        self._index_fd = None
+        self.writes = 0
+
+    @classmethod
+    def segment_paths(cls, logdir, bucket):
+        base = os.path.join(logdir, 'segment-{}'.format(bucket))
+        return base + '.log', base + '.idx'
+
+    def append(self, data):
+        self._buffer.append(data)
+        self._buffered_bytes += len(data)
+
+        if (self._buffered_bytes >= self.buffer_size or
+                (self.buffer_lines and
+                 len(self._buffer) >= self.buffer_lines)):
+            self.flush()
+
+    def flush(self):
+        """Writes buffered lines to the current segment"""
+        if not self._buffer:
+            return
+
+        data = b''.join(self._buffer)
+        self._open(time.strftime(self.PERIODS[self.period], time.gmtime()))
+
+        written = os.write(self._fd, data)
+        if written != len(data):
+            raise IOError("Short write to segment {}".format(self._bucket))
+
+        # With O_APPEND the file offset ends up right after our own write,
+        # even if other runs have appended to the segment since.
+        offset = os.lseek(self._fd, 0, os.SEEK_CUR) - written
+        # The lines are synced before the index points to them
+        sync = self.sync.due()
+        if sync:
+            fdatasync(self._fd)
+        os.write(self._index_fd,
+                 self.INDEX_RECORD.pack(self.run_id, offset, written))
+        if sync:
+            fdatasync(self._index_fd)
+        self.writes += 1
+
+        del self._buffer[:]
+        self._buffered_bytes = 0
+
+    def discard(self):
+        del self._buffer[:]
+        self._buffered_bytes = 0
+
+    def close(self):
+        self.flush()
+        if self.sync.pending and self._fd is not None:
+            fdatasync(self._fd)
+            fdatasync(self._index_fd)
+        self._close_segment()
+
+    def _open(self, bucket):
+        if bucket == self._bucket:
+            return
+
+        self._close_segment()
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+        segment, index = self.segment_paths(self.logdir, bucket)
+        self._fd = os.open(segment, flags, 0o644)
+        self._index_fd = os.open(index, flags, 0o644)
+        self._bucket = bucket
+        if self.sync.durability != 'none':
+            sync_dir(self.logdir)
+
+        # A run that crashed while writing may have left a partial line at
+        # the end. It is terminated, so our lines are never joined to it.
+        if not ends_with_newline(segment):
+            os.write(self._fd, b'\n')
+        # Likewise a partial index record is padded to a record of zeros,
+        # which belongs to no run, so the records after it stay aligned
+        partial = os.fstat(self._index_fd).st_size % self.INDEX_RECORD.size
+        if partial:
+            os.write(self._index_fd,
+                     b'\0' * (self.INDEX_RECORD.size - partial))
+
+    def _close_segment(self):
+        for fd in (self._fd, self._index_fd):
+            if fd is not None:
+                os.close(fd)
+        self._fd = self._index_fd = None
+        self._bucket = None
+
+
+class NetworkSink(object):
+    """Ships auditlog lines to a remote collector in batches.
+
+    A batch is sent when buffer_size bytes or buffer_lines lines are pending,
+    or when the sink is flushed, so memory use is bounded by the batch size.
+    The connection is kept open between batches. If a batch cannot be
+    delivered, it is written to the fallback sink and the remote end is not
+    tried again for RETRY_INTERVAL seconds, so a host that is down delays
+    the run by at most one TIMEOUT per RETRY_INTERVAL. Only a batch that
+    fails on a connection kept open from an earlier batch, which the remote
+    end may have closed meanwhile, is sent once more on a new connection.
+    """
+
+    DEFAULT_PORT = None
+    # Errors after which the connection is given up
+    ERRORS = (EnvironmentError,)
+    RETRY_INTERVAL = 30
+    TIMEOUT = 5
+
+    def __init__(self, url, fallback, buffer_size=65536, buffer_lines=1000):
+        self.url = url
+        self.address = self.parse_address(url)
+        self.fallback = fallback
+        self.buffer_size = buffer_size
+        self.buffer_lines = buffer_lines
+        self._pending = []
+        self._pending_bytes = 0
+        self._conn = None
+        self._down_until = 0
+        # Number of batches sent
+        self.writes = 0
+
+    def parse_address(self, url):
+        address = (url.hostname, url.port or self.DEFAULT_PORT)
+        if address[1] is None:
+            raise ValueError("No port given in {}".format(url.geturl()))
+        return address
+
+    def append(self, data):
+        self._pending.append(data)
+        self._pending_bytes += len(data)
+
+        if (self._pending_bytes >= self.buffer_size or
+                (self.buffer_lines and
+                 len(self._pending) >= self.buffer_lines)):
+            self.flush()
+
+    def flush(self):
+        """Sends pending lines, falling back to the fallback sink"""
+        if self._pending:
+            lines = self._pending
+            self._pending = []
+            self._pending_bytes = 0
+
+            if not self._send_batch(lines):
+                for line in lines:
+                    self.fallback.append(line)
+
+        self.fallback.flush()
+
+    def discard(self):
+        self._pending = []
+        self._pending_bytes = 0
+        self.fallback.discard()
+
+    def close(self):
+        self.flush()
+        self._disconnect()
+        self.fallback.close()
+
+    def _send_batch(self, lines):
+        if time.time() < self._down_until:
+            return False
+
+        if self._conn is not None and self.closed_by_remote():
+            self._disconnect()
+        reused = self._conn is not None
+        while True:
+            try:
+                if self._conn is None:
+                    self._conn = self.connect()
+                self.send(lines)
+                self.writes += 1
+                return True
+            except socket.timeout:
+                # The remote end is there, but does not answer in time
+                self._disconnect()
+                break
+            except self.ERRORS:
+                self._disconnect()
+                if not reused:
+                    break
+                reused = False
+
+        self._down_until = time.time() + self.RETRY_INTERVAL
+        return False
+
+    def _disconnect(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except self.ERRORS:
+                pass
+            self._conn = None
+
+    def closed_by_remote(self):
+        """Returns whether the remote end has closed the connection"""
+        return False
+
+    def connect(self):
+        raise NotImplementedError
+
+    def send(self, lines):
+        raise NotImplementedError
+
+
+def stream_closed(conn):
+    """Returns whether the remote end of a stream socket has closed it.
+
+    Lines sent on such a socket would be lost without an error, which only
+    the send after them gets.
+    """
+    import select
+    if not select.select([conn], [], [], 0)[0]:
+        return False
+    try:
+        return not conn.recv(1, socket.MSG_PEEK)
+    except EnvironmentError:
+        return True
+
+
+class TcpJsonSink(NetworkSink):
+    """Sends newline-delimited JSON over TCP (tcp://host:port)"""
+
+    def closed_by_remote(self):
+        return stream_closed(self._conn)
+
+    def connect(self):
+        return socket.create_connection(self.address, timeout=self.TIMEOUT)
+
+    def send(self, lines):
+        self._conn.sendall(b''.join(lines))
+
+
+class SyslogSink(NetworkSink):
+    """Sends each line as the message of an RFC5424 syslog message"""
+
+    DEFAULT_PORT = 514
+    # facility local0, severity informational
+    PRI = 16 * 8 + 6
+    APP_NAME = 'ansible-auditlog'
+
+    def format(self, line):
+        header = '<{}>1 {}Z {} {} {} - - '.format(
+            self.PRI, datetime.datetime.utcnow().isoformat(),
+            socket.gethostname(), self.APP_NAME, os.getpid())
+        return header.encode('utf-8') + line.rstrip(b'\n')
+
+
+class UdpSyslogSink(SyslogSink):
+    """Sends one syslog datagram per line (syslog+udp://host[:port]).
+
+    Lines too large for a datagram are written to the fallback sink.
+    """
+
+    def connect(self):
+        family, socktype, proto, _, addr = socket.getaddrinfo(
+            self.address[0], self.address[1], 0, socket.SOCK_DGRAM)[0]
+        conn = socket.socket(family, socktype, proto)
+        conn.connect(addr)
+        return conn
+
+    def send(self, lines):
+        # Lines are removed once sent, so only the rest is retried or
+        # written to the fallback sink if sending fails
+        sent = 0
+        try:
+            for line in lines:
+                try:
+                    self._conn.send(self.format(line))
+                except EnvironmentError as e:
+                    if e.errno != errno.EMSGSIZE:
+                        raise
+                    self.fallback.append(line)
+                sent += 1
+        finally:
+            del lines[:sent]
+
+
+class TcpSyslogSink(SyslogSink):
+    """Sends octet-counted syslog messages (syslog+tcp://host[:port])"""
+
+    def closed_by_remote(self):
+        return stream_closed(self._conn)
+
+    def connect(self):
+        return socket.create_connection(self.address, timeout=self.TIMEOUT)
+
+    def send(self, lines):
+        frames = []
+        for line in lines:
+            msg = self.format(line)
+            frames.append('{} '.format(len(msg)).encode('utf-8') + msg)
+        self._conn.sendall(b''.join(frames))
+
+
+class HttpSink(NetworkSink):
+    """POSTs batches of newline-delimited JSON (http[s]://host[:port]/path)"""
+
+    DEFAULT_PORT = 80
+    HTTPS_PORT = 443
+
+    def __init__(self, url, fallback, buffer_size=65536, buffer_lines=1000):
+        # Only imported when needed, as it is slow to import
+        try:
+            import http.client as httplib
+        except ImportError:
+            import httplib
+        self.httplib = httplib
+        super(HttpSink, self).__init__(url, fallback, buffer_size,
+                                       buffer_lines)
+
+    def parse_address(self, url):
+        if url.scheme == 'https' and not url.port:
+            return (url.hostname, self.HTTPS_PORT)
+        return super(HttpSink, self).parse_address(url)
+
+    def connect(self):
+        if self.url.scheme == 'https':
+            cls = self.httplib.HTTPSConnection
+        else:
+            cls = self.httplib.HTTPConnection
+        return cls(self.address[0], self.address[1], timeout=self.TIMEOUT)
+
+    def send(self, lines):
+        try:
+            self._conn.request('POST', self.url.path or '/',
+                               b''.join(lines),
+                               {'Content-Type': 'application/x-ndjson'})
+            response = self._conn.getresponse()
+            # The body has to be read before the connection can be reused
+            response.read()
+        except self.httplib.HTTPException as e:
+            # Such as a malformed response, raised as one of ERRORS
+            raise IOError("{}: {!r}".format(self.url.geturl(), e))
+        if not 200 <= response.status < 300:
+            raise IOError("{} returned HTTP {}".format(
+                self.url.geturl(), response.status))
+
+
+class CollectorSink(NetworkSink):
+    """Sends lines to a local auditlogd (unix:///path or unixgram:///path).
+
+    Lines are sent in frames of the run uuid, the payload length and whole
+    lines, over one stream connection (unix) or as datagrams (unixgram). An
+    empty frame tells auditlogd that the run has ended. Lines too large for
+    a datagram are written to the fallback sink.
+    """
+
+    FRAME = struct.Struct('>16sI')
+    MAX_DATAGRAM = 65536
+    MAX_FRAME = 1048576
+
+    def __init__(self, url, fallback, buffer_size=65536, buffer_lines=1000,
+                 run_uuid=None):
+        import uuid
+        self.run_id = uuid.UUID(run_uuid).bytes
+        self.datagram = url.scheme == 'unixgram'
+        super(CollectorSink, self).__init__(url, fallback, buffer_size,
+                                            buffer_lines)
+
+    def parse_address(self, url):
+        if not url.path:
+            raise ValueError("No socket given in {}".format(url.geturl()))
+        return url.path
+
+    def closed_by_remote(self):
+        return not self.datagram and stream_closed(self._conn)
+
+    def connect(self):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM
+                             if self.datagram else socket.SOCK_STREAM)
+        try:
+            conn.settimeout(self.TIMEOUT)
+            conn.connect(self.address)
+        except EnvironmentError:
+            conn.close()
+            raise
+        return conn
+
+    def send(self, lines):
+        max_size = self.MAX_DATAGRAM if self.datagram else self.MAX_FRAME
+        # Lines are removed once sent, so only the rest is retried or
+        # written to the fallback sink if sending fails
+        while lines:
+            n = size = 0
+            for line in lines:
+                if n and size + len(line) > max_size:
+                    break
+                n += 1
+                size += len(line)
+
+            if self.datagram and size > max_size:
+                self.fallback.append(lines.pop(0))
+                continue
+
+            frame = self.FRAME.pack(self.run_id, size) + b''.join(lines[:n])
+            if self.datagram:
+                self._conn.send(frame)
+            else:
+                self._conn.sendall(frame)
+            del lines[:n]
+
+    def close(self):
+        self.flush()
+        if self._conn is not None:
+            try:
+                self._conn.send(self.FRAME.pack(self.run_id, 0))
+            except self.ERRORS:
+                pass
+        self._disconnect()
+        self.fallback.close()
+
+
+SINKS = {
+    'tcp': TcpJsonSink,
+    'syslog+udp': UdpSyslogSink,
+    'syslog+tcp': TcpSyslogSink,
+    'http': HttpSink,
+    'https': HttpSink,
+    'unix': CollectorSink,
+    'unixgram': CollectorSink,
+}
+
+
+def open_sink(url, fallback, buffer_size=65536, buffer_lines=1000,
+              run_uuid=None):
+    """Returns the sink for url, which falls back to the fallback sink"""
+    if url == 'file':
+        return fallback
+
+    try:
+        from urllib.parse import urlparse
+    except ImportError:
+        from urlparse import urlparse
+
+    parsed = urlparse(url)
+    if parsed.scheme not in SINKS:
+        raise ValueError("Unknown sink: {}".format(url))
+
+    kwargs = {}
+    if SINKS[parsed.scheme] is CollectorSink:
+        # auditlogd writes many runs, so it is told which run lines are of
+        kwargs['run_uuid'] = run_uuid
+    return SINKS[parsed.scheme](parsed, fallback, buffer_size=buffer_size,
+                                buffer_lines=buffer_lines, **kwargs)
+
+
+class JsonEncoder(object):
+    """Serializes auditlog entries to JSON lines.
+
+    By default, lines are the bytes json.dumps(entry, sort_keys=True) writes,
+    as in older versions. Compact lines have no spaces after separators, and
+    keep non-ASCII characters in UTF-8 instead of escaping them, except on
+    Python 2, where strings may be UTF-8 encoded str as well as unicode. The
+    fields that are the same for every entry of a run are encoded once.
+    Unless keys have to be sorted, the entry is encoded on its own and
+    spliced in after them.
+
+    Compact lines are encoded with orjson when it is installed, and the
+    stdlib json module otherwise. Both produce the same bytes, or both raise
+    TypeError: entries that orjson would encode differently, such as floats
+    in another notation or NaN, which orjson logs as null, are encoded with
+    json instead, and values json cannot encode, such as dates, are passed
+    on to json too.
+    """
+
+    # Numbers that orjson would write with a different exponent notation
+    # than json, and nulls, which may have been NaN or infinity. This may
+    # also match inside strings, which only means that json is used for that
+    # entry.
+    ORJSON_MISMATCH = re.compile(
+        br'[:,\[]-?(?:\d+(?:\.\d+)?[eE]|0\.0000)|null')
+
+    def __init__(self, hostname, run_uuid, sort_keys=True, compact=False):
+        self.sort_keys = sort_keys
+        self.compact = compact
+        self.envelope = {'controlhost': hostname, 'uuid': run_uuid}
+
+        if compact:
+            self._separators = (',', ':')
+            self._ensure_ascii = sys.version_info[0] < 3
+        else:
+            self._separators = (', ', ': ')
+            self._ensure_ascii = True
+        item_sep, key_sep = (sep.encode('ascii') for sep in self._separators)
+        self._item_sep = item_sep
+
+        orjson = None
+        if compact and not self._ensure_ascii:
+            try:
+                import orjson
+            except ImportError:
+                pass
+        self._orjson = orjson
+
+        # Entries orjson cannot encode, such as dicts with non-string keys,
+        # are encoded with json. Without a default, orjson raises TypeError
+        # for the dates and dataclasses it passes through, so json, which
+        # cannot encode them either, raises the error.
+        self._orjson_options = 0
+        if orjson is not None:
+            self._orjson_options = (orjson.OPT_PASSTHROUGH_DATETIME |
+                                    orjson.OPT_PASSTHROUGH_DATACLASS)
+            if sort_keys:
+                self._orjson_options |= orjson.OPT_SORT_KEYS
+
+        # {"controlhost": "...", "uuid": "...",
+        self._prefix = self._json_dumps(self.envelope)[:-1] + item_sep
+        self._event_key = b'"event"' + key_sep
+        self._timestamp_key = item_sep + b'"timestamp"' + key_sep
+        # Envelope up to the timestamp value, by event
+        self._heads = {}
+
+    def _json_dumps(self, value):
+        data = json.dumps(value, sort_keys=self.sort_keys,
+                          separators=self._separators,
+                          ensure_ascii=self._ensure_ascii)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return data
+
+    def dumps(self, value):
+        """Encodes value as UTF-8 JSON"""
+        if self._orjson is not None:
+            try:
+                data = self._orjson.dumps(value, option=self._orjson_options)
+                if not self.ORJSON_MISMATCH.search(data):
+                    return data
+            except TypeError:
+                pass
+        return self._json_dumps(value)
+
+    def encode(self, event_id, timestamp, log_entry):
+        """Returns the JSON line for an entry"""
+        if self.sort_keys:
+            entry = dict(log_entry)
+            entry.update(self.envelope)
+            entry['event'] = event_id
+            entry['timestamp'] = timestamp
+            return self.dumps(entry) + b'\n'
+
+        head = self._heads.get(event_id)
+        if head is None:
+            head = self._heads[event_id] = b''.join((
+                self._prefix, self._event_key, self.dumps(event_id),
+                self._timestamp_key))
+
+        body = self.dumps(log_entry)
+        return b''.join((
+            head, self.dumps(timestamp),
+            b'}' if body == b'{}' else self._item_sep + body[1:],
+            b'\n',
+        ))
+
+
+class MsgpackEncoder(object):
+    """Serializes auditlog entries to length-prefixed MessagePack records.
+
+    A file starts with MAGIC, followed by records of a one byte type, a four
+    byte big-endian payload length and the payload:
+
+        K: a MessagePack array of new dictionary keys. Keys are numbered
+           from 0 in the order they are added, across all K records.
+        E: an entry, as a MessagePack map whose keys are the numbers of
+           dictionary keys.
+
+    Every key is added before the first entry that uses it, so the file can
+    be read as a stream, and any record boundary can be seeked to once the
+    K records before it are known. Entries decode to the same JSON lines
+    a compact JsonEncoder writes.
+
+    Integers that do not fit in 64 bits are stored as ext type 1 holding
+    their decimal digits. Other keys than strings are converted the way
+    json converts them.
+    """
+
+    MAGIC = b'ALOGMP\x01\n'
+    RECORD = struct.Struct('>cI')
+    KEYS = b'K'
+    ENTRY = b'E'
+    EXT_BIGINT = 1
+
+    def __init__(self, hostname, run_uuid, sort_keys=True):
+        self.sort_keys = sort_keys
+        self.envelope = [('controlhost', hostname), ('uuid', run_uuid)]
+        self._keys = {}
+        self._new_keys = []
+        self._started = False
+
+    def reset(self):
+        """Starts a new file, with a new key dictionary"""
+        self._keys = {}
+        self._started = False
+
+    def encode(self, event_id, timestamp, log_entry):
+        """Returns the records for an entry"""
+        entry = dict(self.envelope) if self.sort_keys else None
+        if self.sort_keys:
+            entry.update(log_entry)
+            entry['event'] = event_id
+            entry['timestamp'] = timestamp
+            items = sorted(entry.items())
+        else:
+            items = self.envelope + [('event', event_id),
+                                     ('timestamp', timestamp)]
+            items.extend(log_entry.items())
+
+        out = []
+        self._pack_map(items, out)
+        payload = b''.join(out)
+
+        records = []
+        if not self._started:
+            records.append(self.MAGIC)
+            self._started = True
+        if self._new_keys:
+            keys = []
+            self._pack(self._new_keys, keys)
+            keys = b''.join(keys)
+            records.append(self.RECORD.pack(self.KEYS, len(keys)) + keys)
+            self._new_keys = []
+        records.append(self.RECORD.pack(self.ENTRY, len(payload)) + payload)
+        return b''.join(records)
+
+    def _key(self, key):
+        if isinstance(key, bool):
+            key = 'true' if key else 'false'
+        elif key is None:
+            key = 'null'
+        elif isinstance(key, (int, float)):
+            key = repr(key)
+
+        number = self._keys.get(key)
+        if number is None:
+            number = self._keys[key] = len(self._keys)
+            self._new_keys.append(key)
+        return number
+
+    def _pack_map(self, items, out):
+        n = len(items)
+        if n < 16:
+            out.append(struct.pack('B', 0x80 | n))
+        elif n < 0x10000:
+            out.append(struct.pack('>BH', 0xde, n))
+        else:
+            out.append(struct.pack('>BI', 0xdf, n))
+        for key, value in items:
+            self._pack(self._key(key), out)
+            self._pack(value, out)
+
+    def _pack(self, value, out):
+        if value is None:
+            out.append(b'\xc0')
+        elif value is True:
+            out.append(b'\xc3')
+        elif value is False:
+            out.append(b'\xc2')
+        elif isinstance(value, (int, type(2 ** 64))):
+            self._pack_int(value, out)
+        elif isinstance(value, float):
+            out.append(struct.pack('>Bd', 0xcb, value))
+        elif isinstance(value, (str, type(u''))):
+            if not isinstance(value, bytes):
+                value = value.encode('utf-8')
+            n = len(value)
+            if n < 32:
+                out.append(struct.pack('B', 0xa0 | n))
+            elif n < 0x100:
+                out.append(struct.pack('BB', 0xd9, n))
+            elif n < 0x10000:
+                out.append(struct.pack('>BH', 0xda, n))
+            else:
+                out.append(struct.pack('>BI', 0xdb, n))
+            out.append(value)
+        elif isinstance(value, (list, tuple)):
+            n = len(value)
+            if n < 16:
+                out.append(struct.pack('B', 0x90 | n))
+            elif n < 0x10000:
+                out.append(struct.pack('>BH', 0xdc, n))
+            else:
+                out.append(struct.pack('>BI', 0xdd, n))
+            for item in value:
+                self._pack(item, out)
+        elif isinstance(value, dict):
+            items = list(value.items())
+            if self.sort_keys:
+                items.sort()
+            self._pack_map(items, out)
+        else:
+            raise TypeError("{!r} is not serializable".format(value))
+
+    def _pack_int(self, value, out):
+        if 0 <= value < 0x80:
+            out.append(struct.pack('B', value))
+        elif -32 <= value < 0:
+            out.append(struct.pack('b', value))
+        elif 0 <= value < 0x10000000000000000:
+            out.append(struct.pack('>BQ', 0xcf, value))
+        elif -0x8000000000000000 <= value < 0:
+            out.append(struct.pack('>Bq', 0xd3, value))
+        else:
+            digits = str(value).encode('ascii')
+            if len(digits) < 0x100:
+                out.append(struct.pack('BBb', 0xc7, len(digits),
+                                       self.EXT_BIGINT))
+            else:
+                out.append(struct.pack('>BHb', 0xc8, len(digits),
+                                       self.EXT_BIGINT))
+            out.append(digits)
+
+
+class BlobStore(object):
+    """Stores large values once, as content-addressed blobs.
+
+    Values are stored as canonical JSON in <path>/<xx>/<sha256>.json, and
+    replaced by a reference of the form {"$blob": "sha256:<sha256>"}.
+    Values that serialize to less than min_size bytes are kept inline.
+    """
+
+    def __init__(self, path, min_size=1024):
+        self.path = path
+        self.min_size = min_size
+        self._known = set()
+
+    def ref(self, value):
+        """Stores value if it is large enough, and returns its reference"""
+        data = json.dumps(value, sort_keys=True, separators=(',', ':'))
+        if len(data) < self.min_size:
+            return value
+
+        import hashlib
+        digest = hashlib.sha256(data.encode('utf-8')).hexdigest()
+        if digest not in self._known:
+            self._write(digest, data)
+            self._known.add(digest)
+
+        return {'$blob': 'sha256:' + digest}
+
+    def _write(self, digest, data):
+        directory = os.path.join(self.path, digest[:2])
+        path = os.path.join(directory, digest + '.json')
+        if os.path.exists(path):
+            return
+
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Renaming is atomic, so concurrent runs storing the same blob never
+        # see a partial file
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+
+class RunCatalog(object):
+    """Keeps one row per run in a SQLite database, to find runs without
+    scanning every log.
+
+    The row is inserted when a run starts and completed with its end, its
+    counters and the hosts it processed when it ends, each in one short
+    transaction. The database is in WAL mode, so concurrent runs and readers
+    do not block each other. It is opened on first use.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS runs ('
+        ' uuid TEXT PRIMARY KEY, controlhost TEXT, logfile TEXT,'
+        ' playbook TEXT, start_time TEXT, end_time TEXT, user TEXT,'
+        ' sudo_user TEXT, realuser TEXT, logname TEXT,'
+        ' automation_on_behalf_of TEXT, check_mode INTEGER,'
+        ' ok INTEGER, changed INTEGER, failures INTEGER,'
+        ' unreachable INTEGER, skipped INTEGER)',
+        'CREATE INDEX IF NOT EXISTS runs_start_time ON runs (start_time)',
+        'CREATE INDEX IF NOT EXISTS runs_user ON runs (user)',
+        'CREATE INDEX IF NOT EXISTS runs_sudo_user ON runs (sudo_user)',
+        'CREATE INDEX IF NOT EXISTS runs_realuser ON runs (realuser)',
+        'CREATE INDEX IF NOT EXISTS runs_logname ON runs (logname)',
+        'CREATE TABLE IF NOT EXISTS run_hosts ('
+        ' host TEXT, uuid TEXT, PRIMARY KEY (host, uuid)) WITHOUT ROWID',
+    )
+    # Seconds to wait for other runs holding the write lock
+    TIMEOUT = 30
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+
+    def start_run(self, run_uuid, controlhost, logfile, timestamp, log_entry,
+                  check_mode, hosts=()):
+        """Inserts the row of a run from its playbook_on_start entry, and
+        maps the run to the hosts of its inventory, which that entry lists.
+
+        logfile is None if the run is not logged to a file of its own.
+        """
+        self._execute([
+            ('INSERT OR REPLACE INTO runs (uuid, controlhost, logfile,'
+             ' playbook, start_time, user, sudo_user, realuser, logname,'
+             ' automation_on_behalf_of, check_mode)'
+             ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+             [(run_uuid, controlhost, logfile and os.path.abspath(logfile),
+               log_entry.get('playbook'),
+               timestamp, log_entry.get('USER'),
+               log_entry.get('SUDO_USER'), log_entry.get('realuser'),
+               log_entry.get('logname'),
+               log_entry.get('automation_on_behalf_of'),
+               None if check_mode is None else bool(check_mode))]),
+            ('INSERT OR IGNORE INTO run_hosts (host, uuid) VALUES (?, ?)',
+             [(host, run_uuid) for host in hosts]),
+        ])
+
+    def end_run(self, run_uuid, summary, hosts):
+        """Completes the row of a run with the totals of its stats.
+
+        The end time is taken after the run's last entry was logged.
+        """
+        self._execute([
+            ('UPDATE runs SET end_time = ?, ok = ?, changed = ?,'
+             ' failures = ?, unreachable = ?, skipped = ? WHERE uuid = ?',
+             [(datetime.datetime.now().isoformat(), summary['ok'],
+               summary['changed'], summary['failures'],
+               summary['unreachable'], summary['skipped'], run_uuid)]),
+            ('INSERT OR IGNORE INTO run_hosts (host, uuid) VALUES (?, ?)',
+             [(host, run_uuid) for host in hosts]),
+        ])
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _execute(self, statements):
+        if self._db is None:
+            self._db = self._connect()
+        # IMMEDIATE takes the write lock up front, so concurrent runs wait
+        # for each other instead of failing to upgrade a read lock
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            for sql, rows in statements:
+                self._db.executemany(sql, rows)
+        except Exception:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def _connect(self):
+        import sqlite3
+        db = sqlite3.connect(self.path, timeout=self.TIMEOUT,
+                             isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        # Commits are durable at the next checkpoint, which is enough for
+        # an index that can be rebuilt from the logs
+        db.execute('PRAGMA synchronous=NORMAL')
+        for sql in self.SCHEMA:
+            db.execute(sql)
+        return db
+
+
+class JsonAuditLogger(object):
+    """Writes auditlog entries to a file in JSON format.
+
+    All log entries are marked with the same UUID and have timestamps.
+    Entries can be shipped to a remote sink instead, in which case the file
+    is only written when the remote end is unavailable.
+    """
+
+    def __init__(self, logdir='/var/log/ansible', buffer_size=65536,
+                 buffer_lines=1000, async_writes=False, queue_size=10000,
+                 queue_policy='block', error_handler=None, sink='file',
+                 storage='file', segment_period='daily', blobs=False,
+                 blob_min_size=1024, sort_keys=True, record_format='json',
+                 durability='none', sync_interval=1.0, compression='none',
+                 rotate_size=0, rotate_age=0, compact_json=False):
+        import uuid
+        self.uuid = str(uuid.uuid4())
+        self.hostname = socket.gethostname()
+
+        try:
+            if not self.isWritable(logdir):
+                raise Exception("Access denied to {}".format(logdir))
+        except Exception:
+            raise
+
+        if durability == 'always':
+            # Every line is written and synced as soon as it is logged
+            buffer_size = 0
+
+        on_rotate = None
+        if record_format == 'json':
+            self.encoder = JsonEncoder(self.hostname, self.uuid,
+                                       sort_keys=sort_keys,
+                                       compact=compact_json)
+        elif record_format == 'msgpack':
+            # The key dictionary is per file, so records cannot be shared
+            # with other runs or shipped line by line
+            if storage != 'file' or sink != 'file':
+                raise ValueError("The msgpack format needs file storage "
+                                 "and the file sink")
+            self.encoder = MsgpackEncoder(self.hostname, self.uuid,
+                                          sort_keys=sort_keys)
+            # Every rotated file starts with its own key dictionary
+            on_rotate = self.encoder.reset
+        else:
+            raise ValueError("Unknown format: {}".format(record_format))
+
+        if storage == 'segmented':
+            # The segment index points into the uncompressed segments
+            if compression != 'none' or rotate_size or rotate_age:
+                raise ValueError("Compression and rotation need file "
+                                 "storage")
+            self.logfile = None
+        elif storage == 'file':
+            if compression not in COMPRESSION:
+                raise ValueError("Unknown compression: {}".format(
+                    compression))
+            self.logfile = os.path.join(logdir, "{}.log{}".format(
+                self.uuid, COMPRESSION[compression]))
+        else:
+            raise ValueError("Unknown storage mode: {}".format(storage))
+
+        self._sink_options = {
+            'sink': sink,
+            'logdir': logdir,
+            'storage': storage,
+            'segment_period': segment_period,
+            'buffer_lines': buffer_lines,
+            'durability': durability,
+            'sync_interval': sync_interval,
+            'compression': compression,
+        }
+        self.sink = self._open_sink(self.logfile, buffer_size,
+                                    rotate_size=rotate_size,
+                                    rotate_age=rotate_age,
+                                    on_rotate=on_rotate)
+        # Forked processes, such as the workers of ansible 1, write through
+        # a sink of their own, see log()
+        self._pid = os.getpid()
+        self._worker_sink = None
+
+        self.blobs = None
+        if blobs:
+            self.blobs = BlobStore(os.path.join(logdir, 'blobs'),
+                                   min_size=blob_min_size)
+
+        self.error_handler = error_handler
+        # Set once the background writer failed, see _writer_failed()
+        self.failed = False
+        # Number of entries logged, and bytes passed to the sink
+        self.events = 0
+        self.bytes = 0
+        self.writer = None
+        if async_writes:
+            self.writer = AsyncLogWriter(self, queue_size=queue_size,
+                                         policy=queue_policy)
+
+        atexit.register(self.close)
+
+    def _open_sink(self, logfile, buffer_size, rotate_size=0, rotate_age=0,
+                   on_rotate=None):
+        options = self._sink_options
+        sync = SyncPolicy(options['durability'],
+                          interval=options['sync_interval'])
+        if options['storage'] == 'segmented':
+            local = SegmentSink(options['logdir'], self.uuid,
+                                period=options['segment_period'],
+                                buffer_size=buffer_size,
+                                buffer_lines=options['buffer_lines'],
+                                sync=sync)
+        else:
+            local = FileSink(logfile, buffer_size=buffer_size,
+                             buffer_lines=options['buffer_lines'], sync=sync,
+                             compression=options['compression'],
+                             rotate_size=rotate_size, rotate_age=rotate_age,
+                             on_rotate=on_rotate)
+
+        return open_sink(options['sink'], local, run_uuid=self.uuid,
+                         buffer_size=buffer_size,
+                         buffer_lines=options['buffer_lines'])
+
+    @property
+    def run_logfile(self):
+        """The file the run is logged to, or None if it is logged to
+        segments or sent to a remote sink, for which the file is only a
+        fallback"""
+        if self._sink_options['sink'] != 'file':
+            return None
+        return self.logfile
+
+    def _local_sink(self):
+        """Returns the sink that writes to logdir"""
+        sink = self.sink
+        while getattr(sink, 'fallback', None) is not None:
+            sink = sink.fallback
+        return sink
+
+    def isWritable(self, path):
+        if not os.path.isdir(path):
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        # Files are created as the effective user, like ansible runs as
+        if os.access in getattr(os, 'supports_effective_ids', ()):
+            return os.access(path, os.W_OK | os.X_OK, effective_ids=True)
+        return os.access(path, os.W_OK | os.X_OK)
+
+    def blob(self, value):
+        """Returns a blob reference for value, if blobs are enabled"""
+        if self.blobs is None:
+            return value
+        return self.blobs.ref(value)
+
+    @property
+    def dropped(self):
+        """Number of entries discarded because the writer queue was full"""
+        return self.writer.dropped if self.writer else 0
+
+    @property
+    def queue_depth(self):
+        """Number of entries waiting for the background writer"""
+        return self.writer.depth if self.writer else 0
+
+    def log(self, event_id, log_entry=None):
+        if log_entry is None:
+            log_entry = {}
+        timestamp = datetime.datetime.now().isoformat()
+        if self.failed:
+            return timestamp
+        self.events += 1
+
+        if os.getpid() != self._pid:
+            self._log_from_worker(event_id, timestamp, log_entry)
+            return timestamp
+
+        if self.writer is None:
+            self.append(event_id, timestamp, log_entry)
+            return timestamp
+
+        try:
+            self.writer.put(event_id, timestamp, log_entry)
+        except AuditLogWriterError as e:
+            self._writer_failed(e)
+        return timestamp
+
+    def _log_from_worker(self, event_id, timestamp, log_entry):
+        """Writes an entry logged by a forked process right away.
+
+        Forked processes exit without flushing buffers or running atexit
+        handlers, and the thread of the background writer does not exist in
+        them, so the entry is written unbuffered. The lines the process
+        inherited in the buffers of the sink are left to the parent.
+        """
+        if self._worker_sink is None:
+            logfile = self.logfile
+            local = self._local_sink()
+            if isinstance(local, FileSink):
+                # Appends to the current file of a rotated log
+                logfile = local.current_path
+            self._worker_sink = self._open_sink(logfile, 0)
+        self._worker_sink.append(
+            self.serialize(event_id, timestamp, log_entry))
+
+    def serialize(self, event_id, timestamp, log_entry):
+        return self.encoder.encode(event_id, timestamp, log_entry)
+
+    def append(self, event_id, timestamp, log_entry):
+        """Serializes an entry into the sink"""
+        self.append_line(self.serialize(event_id, timestamp, log_entry))
+
+    def append_line(self, data):
+        self.bytes += len(data)
+        self.sink.append(data)
+
+    def write_buffer(self):
+        """Writes lines buffered by the sink"""
+        self.sink.flush()
+
+    def flush(self):
+        """Writes everything logged so far to the sink"""
+        if os.getpid() != self._pid or self.failed:
+            # Entries of forked processes are not buffered
+            return
+        if self.writer is None:
+            self.write_buffer()
+            return
+
+        try:
+            self.writer.flush()
+        except AuditLogWriterError as e:
+            self._writer_failed(e)
+
+    def close(self):
+        """Flushes buffered lines and closes the sink"""
+        if os.getpid() != self._pid:
+            return
+        if self.writer is not None:
+            writer, self.writer = self.writer, None
+            try:
+                writer.close()
+            except AuditLogWriterError as e:
+                self._writer_failed(e)
+                return
+        self.sink.close()
+
+    def _writer_failed(self, e):
+        # Nothing more can be written, so later entries are discarded
+        # instead of piling up behind the failed writer. The flag is checked
+        # by log() and flush(), which callers may hold bound references to.
+        self.failed = True
+        self.writer = None
+        self.sink.discard()
+        if self.error_handler is None:
+            raise e
+        self.error_handler(e)
+
+
+class TaskAggregator(object):
+    """Collapses the runner events of a task into task_summary entries.
+
+    Events are grouped by everything they log except the host, and only the
+    number of hosts is kept for ok outcomes. For all other outcomes the hosts
+    are listed, so changes and failures stay attributable to hosts. The
+    summary is logged when the next task starts or the playbook ends. If a
+    task lists more than max_hosts hosts, the outcomes so far are logged as a
+    partial summary to bound memory use.
+    """
+
+    OK_EVENTS = ('runner_on_ok', 'runner_on_async_ok', 'runner_on_skipped',
+                 'runner_item_on_ok', 'runner_item_on_skipped')
+
+    def __init__(self, logger, max_hosts=10000):
+        self.logger = logger
+        self.max_hosts = max_hosts
+        self.task = None
+        self._outcomes = []
+        self._groups = {}
+        self._listed = 0
+
+    def start(self, task):
+        """Logs the summary of the previous task and starts a new one"""
+        self.flush()
+        self.task = task
+
+    def add(self, event_id, log_entry):
+        host = log_entry.pop('inventory_host', None)
+        latency = log_entry.pop('latency', None)
+        items = sorted(log_entry.items())
+        try:
+            key = (event_id, tuple(items))
+            outcome = self._groups.get(key)
+        except TypeError:
+            # Unhashable values, e.g. a structured msg
+            key = (event_id, repr(items))
+            outcome = self._groups.get(key)
+
+        if outcome is None:
+            outcome = {'event': event_id}
+            outcome.update(log_entry)
+            outcome['count'] = 0
+            if (event_id not in self.OK_EVENTS or
+                    log_entry.get('status', 'ok') != 'ok'):
+                outcome['hosts'] = []
+            self._groups[key] = outcome
+            self._outcomes.append(outcome)
+
+        outcome['count'] += 1
+        if 'hosts' in outcome:
+            outcome['hosts'].append(host)
+            if latency is not None:
+                outcome.setdefault('latencies', []).append(latency)
+            self._listed += 1
+            if self._listed >= self.max_hosts:
+                self._log(partial=True)
+
+    def flush(self, timing=None):
+        """Logs the outcomes collected since the last summary"""
+        if self._outcomes or timing is not None:
+            self._log(partial=False, timing=timing)
+
+    def _log(self, partial, timing=None):
+        outcomes = self._outcomes
+        self._outcomes = []
+        self._groups = {}
+        self._listed = 0
+        log_entry = {
+            'task': self.task,
+            'partial': partial,
+            'outcomes': outcomes,
+        }
+        if timing is not None:
+            log_entry['timing'] = timing
+        self.logger.log('task_summary', log_entry)
+
+
+class LatencyHistogram(object):
+    """Counts latencies in fixed buckets to estimate their percentiles.
+
+    Bucket bounds grow by a factor of 2 ** 0.25 from 1ms, so a percentile is
+    reported at most 19% above the true value, and memory use does not grow
+    with the number of samples. Percentiles never exceed the largest sample.
+    """
+
+    BOUNDS = [0.001 * 2 ** (i / 4.0) for i in range(100)]
+    PERCENTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        rank = max(1, int(math.ceil(p * self.count)))
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                break
+        if i < len(self.BOUNDS):
+            return min(self.BOUNDS[i], self.max)
+        return self.max
+
+    def summary(self):
+        summary = {'count': self.count}
+        for name, p in self.PERCENTILES:
+            summary[name] = (round(self.percentile(p), 3) if self.count
+                             else None)
+        summary['max'] = round(self.max, 3) if self.count else None
+        return summary
+
+
+class RunTimer(object):
+    """Times tasks and the results of their hosts with a monotonic clock.
+
+    Times are seconds, relative to the start of the run for task starts and
+    to the start of the task for host results.
+    """
+
+    def __init__(self):
+        self.started = monotonic()
+        self.latency = LatencyHistogram()
+        self._task_started = None
+        self._task_latency = None
+
+    def start_task(self):
+        self._task_started = monotonic()
+        self._task_latency = LatencyHistogram()
+
+    def result(self):
+        """Records a host result and returns its latency"""
+        if self._task_started is None:
+            return None
+        latency = monotonic() - self._task_started
+        self._task_latency.add(latency)
+        self.latency.add(latency)
+        return round(latency, 3)
+
+    def end_task(self):
+        """Returns the timing of the running task, if any, and ends it"""
+        if self._task_started is None:
+            return None
+        timing = {
+            'start': round(self._task_started - self.started, 3),
+            'duration': round(monotonic() - self._task_started, 3),
+            'latency': self._task_latency.summary(),
+        }
+        self._task_started = None
+        return timing
+
+    def summary(self):
+        """Returns the duration of the run and its latency percentiles"""
+        return {
+            'duration': round(monotonic() - self.started, 3),
+            'latency': self.latency.summary(),
+        }
+
+
+# time.process_time is not available on Python 2, where time.clock is the
+# CPU time of the process
+process_time = getattr(time, 'process_time', None) or time.clock
+
+
+class CallbackProfiler(object):
+    """Measures how much time the callback spends on a run.
+
+    Hooks are timed by wall clock and CPU time of the process. Serializing
+    entries and passing them to the sink are timed by wall clock only, as
+    they run in the writer thread with ANSIBLE_AUDITLOG_ASYNC.
+    """
+
+    HOOK_PREFIXES = ('runner_on_', 'playbook_on_', 'v2_')
+
+    def __init__(self):
+        self.hooks = {}
+        self.serialize = [0, 0.0]
+        self.io = [0, 0.0]
+        self.bytes = 0
+        self.flushes = 0
+        self.sinks = []
+
+    def instrument(self, callback, logger):
+        """Replaces the hooks of callback and the logger's I/O with timed
+        versions"""
+        for name, attr in vars(type(callback)).items():
+            if name.startswith(self.HOOK_PREFIXES) and callable(attr):
+                setattr(callback, name,
+                        self._timed_hook(name, getattr(callback, name)))
+
+        serialize = logger.serialize
+        append_line = logger.append_line
+        write_buffer = logger.write_buffer
+
+        def timed_serialize(*args):
+            start = monotonic()
+            data = serialize(*args)
+            self.serialize[0] += 1
+            self.serialize[1] += monotonic() - start
+            return data
+
+        def timed_append_line(data):
+            start = monotonic()
+            append_line(data)
+            self.io[0] += 1
+            self.io[1] += monotonic() - start
+            self.bytes += len(data)
+
+        def timed_write_buffer():
+            start = monotonic()
+            write_buffer()
+            self.io[0] += 1
+            self.io[1] += monotonic() - start
+            self.flushes += 1
+
+        logger.serialize = timed_serialize
+        logger.append_line = timed_append_line
+        logger.write_buffer = timed_write_buffer
+
+        self.sinks = [logger.sink]
+        fallback = getattr(logger.sink, 'fallback', None)
+        if fallback is not None:
+            self.sinks.append(fallback)
+
+    def _timed_hook(self, name, hook):
+        stats = self.hooks[name] = [0, 0.0, 0.0]
+
+        def timed(*args, **kwargs):
+            wall = monotonic()
+            cpu = process_time()
+            try:
+                return hook(*args, **kwargs)
+            finally:
+                stats[0] += 1
+                stats[1] += monotonic() - wall
+                stats[2] += process_time() - cpu
+        return timed
+
+    def report(self):
+        """Returns the callback_overhead entry for everything so far"""
+        hooks = {}
+        total = [0, 0.0, 0.0]
+        for name, (calls, wall, cpu) in self.hooks.items():
+            if not calls:
+                continue
+            hooks[name] = {'calls': calls, 'wall': round(wall, 6),
+                           'cpu': round(cpu, 6)}
+            total[0] += calls
+            total[1] += wall
+            total[2] += cpu
+
+        return {
+            'hooks': hooks,
+            'total': {'calls': total[0], 'wall': round(total[1], 6),
+                      'cpu': round(total[2], 6)},
+            'serialize': {'calls': self.serialize[0],
+                          'wall': round(self.serialize[1], 6)},
+            'io': {'calls': self.io[0], 'wall': round(self.io[1], 6)},
+            'bytes': self.bytes,
+            'flushes': self.flushes,
+            'writes': sum(getattr(sink, 'writes', 0) for sink in self.sinks),
+        }
+
+
+def escape_label(value):
+    """Escapes a label value of the Prometheus text format"""
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+class RunMetrics(object):
+    """Counts the progress of a run and exports it as a Prometheus textfile.
+
+    The counters are updated in constant time per event. A background thread
+    rewrites the file every interval seconds, atomically by renaming a
+    temporary file over it, so the hooks never wait for it. finish() writes
+    the final snapshot.
+    """
+
+    # The status of the results of runner events that do not log one
+    STATUSES = {
+        'runner_on_failed': 'failed',
+        'runner_on_async_failed': 'failed',
+        'runner_on_error': 'failed',
+        'runner_on_unreachable': 'unreachable',
+        'runner_on_skipped': 'skipped',
+    }
+    OK_EVENTS = ('runner_on_ok', 'runner_on_async_ok')
+
+    def __init__(self, path, logger, interval=5.0):
+        self.path = path
+        self.logger = logger
+        self.interval = interval
+        self.playbook = ''
+        self.started = time.time()
+        self.finished = False
+        # (status, module name) -> number of results
+        self.results = {}
+        self.unreachable = set()
+        self.tasks_completed = 0
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='auditlog-metrics')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def result(self, event_id, log_entry):
+        """Counts the result of a runner event"""
+        status = self.STATUSES.get(event_id)
+        if status is None:
+            # Item events are counted by the event of the whole loop
+            if event_id not in self.OK_EVENTS:
+                return
+            status = log_entry.get('status', 'ok')
+        elif log_entry.get('ignore_errors'):
+            status = 'ignored'
+        key = (status, log_entry.get('module_name') or '')
+        self.results[key] = self.results.get(key, 0) + 1
+        if status == 'unreachable':
+            self.unreachable.add(log_entry.get('inventory_host'))
+
+    def finish(self):
+        """Writes the final snapshot"""
+        self.close()
+        self.finished = True
+        self.write()
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except EnvironmentError:
+                # The next snapshot or the final one will tell
+                pass
+
+    def write(self):
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.rename(tmp, self.path)
+
+    def render(self):
+        """Returns the metrics in the Prometheus text format"""
+        lines = [
+            '# HELP ansible_auditlog_run_info The run the metrics are of',
+            '# TYPE ansible_auditlog_run_info gauge',
+            'ansible_auditlog_run_info{{uuid="{}",controlhost="{}",'
+            'playbook="{}"}} 1'.format(
+                self.logger.uuid, escape_label(self.logger.hostname),
+                escape_label(self.playbook)),
+            '# HELP ansible_auditlog_run_start_seconds When the run started',
+            '# TYPE ansible_auditlog_run_start_seconds gauge',
+            'ansible_auditlog_run_start_seconds {}'.format(
+                round(self.started, 3)),
+            '# HELP ansible_auditlog_run_finished Whether the run has ended',
+            '# TYPE ansible_auditlog_run_finished gauge',
+            'ansible_auditlog_run_finished {}'.format(int(self.finished)),
+            '# HELP ansible_auditlog_results_total Results of tasks on hosts',
+            '# TYPE ansible_auditlog_results_total counter',
+        ]
+        # Copied at once, as the hooks keep counting
+        for (status, module), count in sorted(list(self.results.items())):
+            lines.append('ansible_auditlog_results_total{{status="{}",'
+                         'module="{}"}} {}'.format(
+                             status, escape_label(module), count))
+        lines.extend([
+            '# HELP ansible_auditlog_unreachable_hosts Hosts that were '
+            'unreachable',
+            '# TYPE ansible_auditlog_unreachable_hosts gauge',
+            'ansible_auditlog_unreachable_hosts {}'.format(
+                len(self.unreachable)),
+            '# HELP ansible_auditlog_tasks_completed_total Tasks that have '
+            'ended',
+            '# TYPE ansible_auditlog_tasks_completed_total counter',
+            'ansible_auditlog_tasks_completed_total {}'.format(
+                self.tasks_completed),
+            '# HELP ansible_auditlog_events_total Entries logged',
+            '# TYPE ansible_auditlog_events_total counter',
+            'ansible_auditlog_events_total {}'.format(self.logger.events),
+            '# HELP ansible_auditlog_dropped_events_total Entries dropped '
+            'because the writer queue was full',
+            '# TYPE ansible_auditlog_dropped_events_total counter',
+            'ansible_auditlog_dropped_events_total {}'.format(
+                self.logger.dropped),
+            '# HELP ansible_auditlog_written_bytes_total Bytes of entries '
+            'written, before compression',
+            '# TYPE ansible_auditlog_written_bytes_total counter',
+            'ansible_auditlog_written_bytes_total {}'.format(
+                self.logger.bytes),
+            '# HELP ansible_auditlog_queue_depth Entries waiting for the '
+            'background writer',
+            '# TYPE ansible_auditlog_queue_depth gauge',
+            'ansible_auditlog_queue_depth {}'.format(
+                self.logger.queue_depth),
+        ])
+        return '\n'.join(lines) + '\n'
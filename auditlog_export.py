@@ -0,0 +1,562 @@
+#!/usr/bin/env python
+# Exports the audit logs written by the auditlog callback plugins to a
+# columnar store of NumPy arrays, for analytics over the audit history.
+#
+#   auditlog_export.py --output /var/lib/ansible-audit
+#   auditlog_export.py --output /var/lib/ansible-audit --summary module,host
+#
+# Every export appends the runs that ended since the last one, so it can be
+# run from cron; concurrent exports to one store wait for each other. The
+# logs of runs that were exported already are not read again, and their
+# lines in segments are skipped without decoding them. Every entry becomes a
+# row, and every host of a task_summary outcome a row of its own, with the
+# columns:
+#
+#   time      int64  microseconds since the epoch of the entry's timestamp,
+#                    in the local time of the control host it was logged in
+#   run       int32  run uuid
+#   playbook  int32  playbook of the run
+#   event     int16  event, or the event of the task_summary outcome
+#   host      int32  inventory host, -1 for entries without one
+#   module    int32  module name, -1 for entries without one
+#   status    int8   index into STATUSES, 0 for entries that are no result
+#   count     int32  results the row stands for, more than 1 for outcomes
+#                    of ok results, which are summarized without hosts
+#
+# The columns other than time, status and count hold codes into the
+# dictionaries of manifest.json, which only ever grow. Entries without a
+# timestamp have no rows; their number is kept as "untimed" in the manifest.
+# Runs are written in chunks of about --chunk-rows rows as soon as all their
+# logs are read. Each chunk is a directory of <column>.npy files, which are
+# loaded memory-mapped, so aggregates are computed as vectorized group-bys,
+# e.g.:
+#
+#   manifest, columns = load(output, ('module', 'status', 'count'))
+#
+# Needs numpy. For available options, see auditlog_export.py --help
+
+import os
+import sys
+import json
+import fcntl
+import argparse
+import datetime
+import multiprocessing
+
+from collections import OrderedDict
+
+from auditlog_query import (UUID, BlobReader, find_logfiles, read_entries,
+                            run_of, split_file)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+MANIFEST = 'manifest.json'
+VERSION = 1
+
+COLUMNS = OrderedDict([
+    ('time', 'int64'),
+    ('run', 'int32'),
+    ('playbook', 'int32'),
+    ('event', 'int16'),
+    ('host', 'int32'),
+    ('module', 'int32'),
+    ('status', 'int8'),
+    ('count', 'int32'),
+])
+DICTIONARIES = ('run', 'playbook', 'event', 'host', 'module')
+
+STATUSES = ('none', 'ok', 'changed', 'failed', 'ignored', 'skipped',
+            'unreachable')
+# The status of the results of runner events that do not log one
+RESULT_STATUSES = {
+    'runner_on_failed': 'failed',
+    'runner_on_async_failed': 'failed',
+    'runner_on_error': 'failed',
+    'runner_item_on_failed': 'failed',
+    'runner_on_unreachable': 'unreachable',
+    'runner_on_skipped': 'skipped',
+    'runner_item_on_skipped': 'skipped',
+}
+OK_EVENTS = ('runner_on_ok', 'runner_on_async_ok', 'runner_item_on_ok')
+# The results of the items of a loop are also logged for the whole loop
+ITEM_EVENTS = ('runner_item_on_ok', 'runner_item_on_failed',
+               'runner_item_on_skipped')
+
+SUMMARY_FIELDS = ('run', 'playbook', 'event', 'host', 'module', 'status',
+                  'day')
+
+
+def result_status(event, entry):
+    """Returns the status of a result, or 'none' for other entries"""
+    status = RESULT_STATUSES.get(event)
+    if status is None:
+        if event not in OK_EVENTS:
+            return 'none'
+        status = entry.get('status') or 'ok'
+    elif status == 'failed' and entry.get('ignore_errors'):
+        status = 'ignored'
+    return status
+
+
+def entry_rows(entry):
+    """Returns the (timestamp, event, host, module, status, count) rows of
+    an entry"""
+    timestamp = entry.get('timestamp')
+    event = entry.get('event')
+    if event != 'task_summary':
+        return [(timestamp, event, entry.get('inventory_host'),
+                 entry.get('module_name'), result_status(event, entry), 1)]
+
+    rows = []
+    for outcome in entry.get('outcomes') or ():
+        event = outcome.get('event')
+        module = outcome.get('module_name')
+        status = result_status(event, outcome)
+        hosts = outcome.get('hosts')
+        if hosts is None:
+            rows.append((timestamp, event, None, module, status,
+                         outcome.get('count', 1)))
+        else:
+            rows.extend((timestamp, event, host, module, status, 1)
+                        for host in hosts)
+    return rows
+
+
+_exported = None
+
+
+def _init_worker(exported):
+    global _exported
+    _exported = exported
+
+
+def scan_export(task):
+    """Returns the rows of the runs in a byte range that were not exported
+    yet, as {uuid: {'playbook', 'ended', 'rows'}}"""
+    path, start, end = task
+    blobs = BlobReader(os.path.join(os.path.dirname(path), 'blobs'))
+    runs = {}
+    for line in read_entries(path, start, end):
+        # Lines of exported runs in segments are skipped before decoding
+        m = UUID.search(line)
+        if m and m.group(1).decode('utf-8') in _exported:
+            continue
+        try:
+            entry = json.loads(line.decode('utf-8'))
+        except ValueError:
+            continue
+        run_uuid = entry.get('uuid')
+        if run_uuid in _exported:
+            continue
+        run = runs.get(run_uuid)
+        if run is None:
+            run = runs[run_uuid] = {'playbook': None, 'ended': False,
+                                    'rows': [], 'untimed': 0}
+        event = entry.get('event')
+        if event == 'playbook_on_start':
+            run['playbook'] = entry.get('playbook')
+        elif event == 'playbook_on_stats':
+            run['ended'] = True
+        elif event == 'task_summary':
+            entry['outcomes'] = blobs.inflate(entry.get('outcomes'))
+        if not entry.get('timestamp'):
+            run['untimed'] += 1
+            continue
+        run['rows'].extend(entry_rows(entry))
+    return runs
+
+
+def merge_runs(runs, found, skip=()):
+    for run_uuid, part in found.items():
+        if run_uuid in skip:
+            continue
+        run = runs.get(run_uuid)
+        if run is None:
+            runs[run_uuid] = part
+            continue
+        run['playbook'] = run['playbook'] or part['playbook']
+        run['ended'] = run['ended'] or part['ended']
+        run['rows'].extend(part['rows'])
+        run['untimed'] += part['untimed']
+
+
+def load_manifest(output):
+    path = os.path.join(output, MANIFEST)
+    if not os.path.exists(path):
+        return {
+            'version': VERSION,
+            'columns': COLUMNS,
+            'statuses': STATUSES,
+            'dictionaries': dict((name, []) for name in DICTIONARIES),
+            'chunks': [],
+            'untimed': 0,
+        }
+    with open(path) as f:
+        manifest = json.load(f, object_pairs_hook=OrderedDict)
+    if manifest.get('version') != VERSION:
+        raise ValueError("Unsupported manifest version in {}: {}".format(
+            path, manifest.get('version')))
+    return manifest
+
+
+def save_manifest(output, manifest):
+    """Replaces the manifest atomically, so readers never see chunks it
+    does not list yet"""
+    path = os.path.join(output, MANIFEST)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.rename(tmp, path)
+
+
+class Encoder(object):
+    """Encodes values as codes into the growing dictionaries of a manifest"""
+
+    def __init__(self, dictionaries):
+        self.dictionaries = dictionaries
+        self._codes = dict(
+            (name, dict((v, i) for i, v in enumerate(values)))
+            for name, values in dictionaries.items())
+
+    def code(self, name, value):
+        if value is None:
+            return -1
+        codes = self._codes[name]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(codes)
+            self.dictionaries[name].append(value)
+        return code
+
+
+def write_chunk(output, name, rows, encoder):
+    """Writes rows of (run, playbook, timestamp, event, host, module, status,
+    count) as the column files of a chunk and returns its manifest entry"""
+    statuses = dict((s, i) for i, s in enumerate(STATUSES))
+    code = encoder.code
+    times = numpy.array([r[2] for r in rows], dtype='datetime64[us]')
+    # Rows without a timestamp are left out when scanning, and should they
+    # still get here, they do not stretch the time range of the chunk
+    valid = times[~numpy.isnat(times)].astype('int64')
+    columns = {
+        'time': times.astype('int64'),
+        'run': [code('run', r[0]) for r in rows],
+        'playbook': [code('playbook', r[1]) for r in rows],
+        'event': [code('event', r[3]) for r in rows],
+        'host': [code('host', r[4]) for r in rows],
+        'module': [code('module', r[5]) for r in rows],
+        'status': [statuses.get(r[6], 0) for r in rows],
+        'count': [r[7] for r in rows],
+    }
+
+    path = os.path.join(output, name)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for column, dtype in COLUMNS.items():
+        numpy.save(os.path.join(path, column + '.npy'),
+                   numpy.asarray(columns[column], dtype=dtype))
+
+    return OrderedDict([
+        ('name', name),
+        ('rows', len(rows)),
+        ('min_time', int(valid.min()) if len(valid) else None),
+        ('max_time', int(valid.max()) if len(valid) else None),
+    ])
+
+
+def export(output, paths, jobs=None, chunk_rows=1000000, unfinished=False,
+           chunk_size=64 * 1024 * 1024):
+    """Appends the runs in paths that were not exported yet to the store.
+
+    Runs are exported once they logged playbook_on_stats, or right away
+    with unfinished set, after which later entries of theirs are ignored.
+    The runs of per-run logs are written as soon as all their logs are
+    read, and those of segments once all logs are read, so only the runs
+    still being read or waiting for their chunk are kept in memory.
+    Returns the number of exported runs.
+    """
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    # Held until the export is done, as exports append to the same chunks
+    # and dictionaries
+    lock = os.open(output, os.O_RDONLY)
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return _export(output, paths, jobs, chunk_rows, unfinished,
+                       chunk_size)
+    finally:
+        os.close(lock)
+
+
+def _export(output, paths, jobs, chunk_rows, unfinished, chunk_size):
+    manifest = load_manifest(output)
+    exported = frozenset(manifest['dictionaries']['run'])
+
+    # The per-run logs of exported runs need not be read at all
+    paths = [p for p in paths if run_of(p) not in exported]
+    tasks = [t for p in paths for t in split_file(p, chunk_size)]
+    jobs = jobs or multiprocessing.cpu_count()
+
+    # Number of tasks still to read of the runs of per-run logs
+    tasks_left = {}
+    for path, start, end in tasks:
+        run_uuid = run_of(path)
+        if run_uuid is not None:
+            tasks_left[run_uuid] = tasks_left.get(run_uuid, 0) + 1
+
+    encoder = Encoder(manifest['dictionaries'])
+    runs = OrderedDict()
+    # Complete runs waiting for their chunk, and the runs written
+    pending = []
+    written = set()
+    state = {'rows': 0}
+
+    def write_pending():
+        # Ordered by start, so the chunks are roughly in time order
+        pending.sort(key=lambda r: min(row[0] for row in r[1]['rows']))
+        rows = [(run_uuid, run['playbook']) + row
+                for run_uuid, run in pending for row in run['rows']]
+        name = '{:06d}'.format(len(manifest['chunks']) + 1)
+        manifest['chunks'].append(write_chunk(output, name, rows, encoder))
+        manifest['untimed'] = manifest.get('untimed', 0) + sum(
+            run['untimed'] for run_uuid, run in pending)
+        save_manifest(output, manifest)
+        written.update(run_uuid for run_uuid, run in pending)
+        del pending[:]
+        state['rows'] = 0
+
+    def complete(run_uuid):
+        run = runs.pop(run_uuid, None)
+        if (run is None or run_uuid is None or not run['rows'] or
+                not (run['ended'] or unfinished)):
+            return
+        pending.append((run_uuid, run))
+        state['rows'] += len(run['rows'])
+        if state['rows'] >= chunk_rows:
+            write_pending()
+
+    def scanned(task, found):
+        merge_runs(runs, found, skip=written)
+        run_uuid = run_of(task[0])
+        if run_uuid is not None:
+            tasks_left[run_uuid] -= 1
+            if not tasks_left[run_uuid]:
+                complete(run_uuid)
+
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(jobs, _init_worker, (exported,))
+        try:
+            for task, found in zip(tasks, pool.imap(scan_export, tasks)):
+                scanned(task, found)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        _init_worker(exported)
+        for task in tasks:
+            scanned(task, scan_export(task))
+
+    # The runs of segments, which any segment may have lines of
+    for run_uuid in list(runs):
+        complete(run_uuid)
+    if pending:
+        write_pending()
+    # Runs without rows of their own are never exported
+    return len(written)
+
+
+def load(output, columns=None, since=None, until=None):
+    """Returns the manifest and the given columns of all chunks.
+
+    Columns of a single chunk are memory-mapped, those of several chunks
+    concatenated. since and until are times like the time column, and
+    leave out the chunks outside of them; rows still have to be masked.
+    """
+    manifest = load_manifest(output)
+    columns = list(columns or manifest['columns'])
+    chunks = [c for c in manifest['chunks']
+              if c['min_time'] is not None and
+              (since is None or c['max_time'] >= since) and
+              (until is None or c['min_time'] < until)]
+    parts = dict((c, []) for c in columns)
+    for chunk in chunks:
+        for column in columns:
+            parts[column].append(numpy.load(
+                os.path.join(output, chunk['name'], column + '.npy'),
+                mmap_mode='r'))
+
+    result = {}
+    for column in columns:
+        if len(parts[column]) == 1:
+            result[column] = parts[column][0]
+        elif parts[column]:
+            result[column] = numpy.concatenate(parts[column])
+        else:
+            result[column] = numpy.zeros(0, dtype=manifest['columns'][column])
+    return manifest, result
+
+
+def epoch_us(timestamp):
+    return int(numpy.datetime64(timestamp, 'us').astype('int64'))
+
+
+def summarize(output, fields, since=None, until=None, events=None):
+    """Returns (group values, results, changed, failed, unreachable) rows
+    for the results grouped by fields, most results first.
+
+    Item events are left out unless asked for, as the results of a loop
+    are also logged for the loop as a whole.
+    """
+    since = epoch_us(since) if since else None
+    until = epoch_us(until) if until else None
+    keys = [f for f in fields if f != 'day']
+    manifest, columns = load(output, set(keys + ['time', 'event', 'status',
+                                                 'count']),
+                             since=since, until=until)
+
+    dictionaries = manifest['dictionaries']
+    event_codes = dict((e, i) for i, e in enumerate(dictionaries['event']))
+    if events:
+        wanted = [event_codes[e] for e in events if e in event_codes]
+        mask = numpy.isin(columns['event'], wanted)
+    else:
+        skip = [event_codes[e] for e in ITEM_EVENTS if e in event_codes]
+        mask = ~numpy.isin(columns['event'], skip)
+    mask &= columns['status'] != 0
+    if since is not None:
+        mask &= columns['time'] >= since
+    if until is not None:
+        mask &= columns['time'] < until
+
+    if not mask.any():
+        return []
+
+    # Rows of the group columns, with -1 for no host or module kept as is
+    values = []
+    for field in fields:
+        if field == 'day':
+            values.append(columns['time'][mask] // 86400000000)
+        else:
+            values.append(columns[field][mask].astype('int64'))
+    groups, inverse = numpy.unique(numpy.stack(values, axis=1), axis=0,
+                                   return_inverse=True)
+    inverse = inverse.reshape(-1)
+    count = columns['count'][mask]
+    status = columns['status'][mask]
+
+    def total(selected=None):
+        weights = count if selected is None else count * selected
+        return numpy.bincount(inverse, weights=weights,
+                              minlength=len(groups))
+
+    results = total()
+    changed = total(status == STATUSES.index('changed'))
+    failed = total(status == STATUSES.index('failed'))
+    unreachable = total(status == STATUSES.index('unreachable'))
+
+    rows = []
+    for i in numpy.argsort(-results, kind='stable'):
+        group = []
+        for field, value in zip(fields, groups[i].tolist()):
+            if field == 'day':
+                value = str(datetime.date(1970, 1, 1) +
+                            datetime.timedelta(days=value))
+            elif field == 'status':
+                value = STATUSES[value]
+            else:
+                value = dictionaries[field][value] if value >= 0 else ''
+            group.append(value)
+        rows.append((tuple(group), int(results[i]), int(changed[i]),
+                     int(failed[i]), int(unreachable[i])))
+    return rows
+
+
+def print_summary(fields, rows, out):
+    columns = [f.upper() for f in fields] + ['RESULTS', 'CHANGED', 'FAILED',
+                                             'UNREACHABLE', 'FAILURE_RATE']
+    table = [columns]
+    for values, results, changed, failed, unreachable in rows:
+        rate = float(failed + unreachable) / results if results else 0.0
+        table.append([v or '-' for v in values] +
+                     [str(results), str(changed), str(failed),
+                      str(unreachable), '{:.4f}'.format(rate)])
+
+    widths = [max(len(r[i]) for r in table) for i in range(len(columns))]
+    for r in table:
+        out.write('  '.join(v.ljust(w) for v, w in zip(r, widths)).rstrip())
+        out.write('\n')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Export the audit logs written by the auditlog callback '
+                    'plugins to NumPy arrays.')
+    parser.add_argument('paths', nargs='*',
+                        help='log files to export (default: all logs in '
+                             '--logdir)')
+    parser.add_argument('--logdir',
+                        default=os.getenv('ANSIBLE_AUDITLOG_LOGDIR',
+                                          '/var/log/ansible'),
+                        help='log directory (default: $ANSIBLE_AUDITLOG_LOGDIR'
+                             ' or /var/log/ansible)')
+    parser.add_argument('-o', '--output',
+                        help='directory of the store (default: columnar in '
+                             '--logdir)')
+    parser.add_argument('--chunk-rows', type=int, default=1000000,
+                        help='rows after which a new chunk is started '
+                             '(default: 1000000)')
+    parser.add_argument('--unfinished', action='store_true',
+                        help='also export runs that did not end, e.g. '
+                             'because ansible was killed')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes (default: CPUs)')
+    parser.add_argument('--summary', metavar='FIELDS',
+                        help='print the results grouped by these comma '
+                             'separated fields (' + ', '.join(SUMMARY_FIELDS) +
+                             ') instead of exporting')
+    parser.add_argument('--event', action='append', dest='events',
+                        help='summarize the results of this event')
+    parser.add_argument('--since', help='summarize results at or after this '
+                                        'ISO 8601 timestamp')
+    parser.add_argument('--until', help='summarize results before this ISO '
+                                        '8601 timestamp')
+    args = parser.parse_args(argv)
+    if args.summary is not None:
+        args.summary = [f.strip() for f in args.summary.split(',')
+                        if f.strip()]
+        unknown = [f for f in args.summary if f not in SUMMARY_FIELDS]
+        if unknown or not args.summary:
+            parser.error('--summary takes fields of: ' +
+                         ', '.join(SUMMARY_FIELDS))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if numpy is None:
+        sys.stderr.write('auditlog_export.py needs numpy\n')
+        return 1
+
+    output = args.output or os.path.join(args.logdir, 'columnar')
+    if args.summary:
+        if not os.path.exists(os.path.join(output, MANIFEST)):
+            sys.stderr.write('Nothing exported to {}\n'.format(output))
+            return 1
+        rows = summarize(output, args.summary, since=args.since,
+                         until=args.until, events=args.events)
+        print_summary(args.summary, rows, sys.stdout)
+        return 0
+
+    paths = args.paths or find_logfiles(args.logdir)
+    runs = export(output, paths, jobs=args.jobs, chunk_rows=args.chunk_rows,
+                  unfinished=args.unfinished)
+    sys.stderr.write('Exported {} runs to {}\n'.format(runs, output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1136 @@
+#!/usr/bin/env python
+# Searches the audit logs written by the auditlog callback plugins.
+#
+#   auditlog_query.py --host web01 --since 2026-09-01
+#   auditlog_query.py --user alice --playbook site.yml --format table
+#
+# Log files are memory-mapped and scanned by a pool of worker processes.
+# Lines that cannot match are rejected with plain substring searches, so
+# only candidate lines are ever JSON-decoded. Values the plugins stored as
+# blobs are inflated again in the output.
+#
+# Logs in the msgpack format are printed as the JSON lines the json format
+# would have written with ANSIBLE_AUDITLOG_COMPACT_JSON, so without filters
+# this converts them to JSON lines:
+#
+#   auditlog_query.py /var/log/ansible/<uuid>.log > <uuid>.jsonl
+#
+# Compressed logs (.log.gz, .log.zst) are decompressed as a stream, one
+# worker per file, instead of being memory-mapped. Reading .zst files needs
+# the zstandard module.
+#
+# With ANSIBLE_AUDITLOG_CATALOG=true, the plugins keep a row per run in
+# catalog.db in the log directory. The logs of cataloged runs that cannot
+# match the host, user, playbook, run and time filters are then skipped,
+# which is decided with index lookups. Runs that did not end yet are only
+# skipped by their start time, users and playbook. The catalog of existing
+# logs is rebuilt in parallel with:
+#
+#   auditlog_query.py --rebuild-catalog
+#
+# For available options, see auditlog_query.py --help
+
+import os
+import sys
+import errno
+import re
+import json
+import sqlite3
+import struct
+import glob
+import mmap
+import argparse
+import multiprocessing
+
+from collections import OrderedDict
+from contextlib import closing
+from itertools import chain
+
+
+USER_FIELDS = ('USER', 'SUDO_USER', 'realuser', 'logname')
+
+TIMESTAMP = re.compile(br'"timestamp": ?"([^"]*)"')
+UUID = re.compile(br'"uuid": ?"([^"]*)"')
+HOST_RANGE = re.compile(r'^(.*)\[(\d+):(\d+)\](.*)$')
+
+MSGPACK_MAGIC = b'ALOGMP\x01\n'
+MSGPACK_RECORD = struct.Struct('>cI')
+
+LOG_PATTERNS = ('*.log', '*.log.gz', '*.log.zst')
+BLOCK_SIZE = 16 * 1024 * 1024
+
+# Segments are segment-<bucket>.log, with a sidecar index segment-<bucket>.idx
+# of (run uuid, offset, length) records, one per write, see SegmentSink
+SEGMENT = re.compile(r'^segment-\w+\.log$')
+SEGMENT_INDEX_RECORD = struct.Struct('<16sQI')
+
+# Per-run logs are <uuid>.log, and <uuid>.<n>.log once rotated, or
+# <uuid>.auditlogd.log when written by auditlogd.py
+RUN_LOG = re.compile(r'^([0-9a-f]{8}(?:-[0-9a-f]{4}){3}-[0-9a-f]{12})\.')
+
+CATALOG = 'catalog.db'
+# The run catalog as the plugins create it, see RunCatalog
+CATALOG_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS runs ('
+    ' uuid TEXT PRIMARY KEY, controlhost TEXT, logfile TEXT,'
+    ' playbook TEXT, start_time TEXT, end_time TEXT, user TEXT,'
+    ' sudo_user TEXT, realuser TEXT, logname TEXT,'
+    ' automation_on_behalf_of TEXT, check_mode INTEGER,'
+    ' ok INTEGER, changed INTEGER, failures INTEGER,'
+    ' unreachable INTEGER, skipped INTEGER)',
+    'CREATE INDEX IF NOT EXISTS runs_start_time ON runs (start_time)',
+    'CREATE INDEX IF NOT EXISTS runs_user ON runs (user)',
+    'CREATE INDEX IF NOT EXISTS runs_sudo_user ON runs (sudo_user)',
+    'CREATE INDEX IF NOT EXISTS runs_realuser ON runs (realuser)',
+    'CREATE INDEX IF NOT EXISTS runs_logname ON runs (logname)',
+    'CREATE TABLE IF NOT EXISTS run_hosts ('
+    ' host TEXT, uuid TEXT, PRIMARY KEY (host, uuid)) WITHOUT ROWID',
+)
+CATALOG_USER_COLUMNS = ('user', 'sudo_user', 'realuser', 'logname')
+# The fields of playbook_on_start entries the catalog columns hold
+CATALOG_RUN_FIELDS = ('uuid', 'playbook', 'USER', 'SUDO_USER', 'realuser',
+                      'logname')
+# Events the catalog is rebuilt from. The stats are followed by the
+# counters of the hosts and the callback overhead, which end the run.
+CATALOG_EVENTS = ('playbook_on_start', 'playbook_on_stats',
+                  'playbook_on_stats_hosts', 'callback_overhead')
+# Counters of the stats summary, and the stats details they come from
+STATS_COUNTERS = (
+    ('failures', 'failures'),
+    ('ok', 'ok'),
+    ('unreachable', 'dark'),
+    ('changed', 'changed'),
+    ('skipped', 'skipped'),
+)
+MSGPACK_EXT_BIGINT = 1
+
+
+def json_needles(value, quoted=True):
+    """Returns the byte strings value can appear as inside a JSON line"""
+    needles = []
+    for ensure_ascii in (True, False):
+        needle = json.dumps(value, ensure_ascii=ensure_ascii)
+        if not quoted:
+            needle = needle[1:-1]
+        needle = needle.encode('utf-8')
+        if needle not in needles:
+            needles.append(needle)
+    return needles
+
+
+def host_in_patterns(host, patterns):
+    """Checks if host is one of the range patterns of a hosts summary"""
+    for pattern in patterns:
+        if pattern == host:
+            return True
+        m = HOST_RANGE.match(pattern)
+        if not m:
+            continue
+        prefix, start, end, suffix = m.groups()
+        number = host[len(prefix):len(host) - len(suffix)]
+        if (host.startswith(prefix) and host.endswith(suffix) and
+                number.isdigit() and len(number) == len(start) and
+                int(start) <= int(number) <= int(end)):
+            return True
+    return False
+
+
+def expand_patterns(patterns):
+    """Returns the host names of the range patterns of a hosts summary"""
+    hosts = []
+    for pattern in patterns:
+        m = HOST_RANGE.match(pattern)
+        if not m:
+            hosts.append(pattern)
+            continue
+        prefix, start, end, suffix = m.groups()
+        hosts.extend('{}{:0{w}d}{}'.format(prefix, n, suffix, w=len(start))
+                     for n in range(int(start), int(end) + 1))
+    return hosts
+
+
+class BlobReader(object):
+    """Loads the blobs referenced by {"$blob": "sha256:..."} values"""
+
+    def __init__(self, path):
+        self.path = path
+        self._cache = {}
+
+    def load(self, ref):
+        if ref not in self._cache:
+            digest = ref.split(':', 1)[-1]
+            path = os.path.join(self.path, digest[:2], digest + '.json')
+            try:
+                with open(path) as f:
+                    self._cache[ref] = json.load(f)
+            except (IOError, ValueError):
+                self._cache[ref] = None
+        return self._cache[ref]
+
+    def inflate(self, value):
+        """Returns value with every blob reference replaced by the blob.
+
+        References to blobs that cannot be read are left as they are.
+        """
+        if isinstance(value, dict):
+            if len(value) == 1 and '$blob' in value:
+                blob = self.load(value['$blob'])
+                return value if blob is None else blob
+            return dict((k, self.inflate(v)) for k, v in value.items())
+        if isinstance(value, list):
+            return [self.inflate(v) for v in value]
+        return value
+
+
+def msgpack_unpack(data, pos, keys):
+    """Decodes the MessagePack value at pos, returns it and the next pos.
+
+    Map keys are numbers in the key dictionary keys.
+    """
+    b = ord(data[pos:pos + 1])
+    pos += 1
+
+    if b < 0x80:
+        return b, pos
+    if b >= 0xe0:
+        return b - 0x100, pos
+    if b < 0x90:
+        return _unpack_map(data, pos, b & 0x0f, keys)
+    if b < 0xa0:
+        return _unpack_array(data, pos, b & 0x0f, keys)
+    if b < 0xc0:
+        n = b & 0x1f
+        return data[pos:pos + n].decode('utf-8'), pos + n
+    if b == 0xc0:
+        return None, pos
+    if b == 0xc2:
+        return False, pos
+    if b == 0xc3:
+        return True, pos
+    if b == 0xcb:
+        return struct.unpack_from('>d', data, pos)[0], pos + 8
+    if b == 0xcf:
+        return struct.unpack_from('>Q', data, pos)[0], pos + 8
+    if b == 0xd3:
+        return struct.unpack_from('>q', data, pos)[0], pos + 8
+    if b in (0xd9, 0xda, 0xdb):
+        fmt = {0xd9: '>B', 0xda: '>H', 0xdb: '>I'}[b]
+        n = struct.unpack_from(fmt, data, pos)[0]
+        pos += struct.calcsize(fmt)
+        return data[pos:pos + n].decode('utf-8'), pos + n
+    if b in (0xdc, 0xdd):
+        fmt = '>H' if b == 0xdc else '>I'
+        n = struct.unpack_from(fmt, data, pos)[0]
+        return _unpack_array(data, pos + struct.calcsize(fmt), n, keys)
+    if b in (0xde, 0xdf):
+        fmt = '>H' if b == 0xde else '>I'
+        n = struct.unpack_from(fmt, data, pos)[0]
+        return _unpack_map(data, pos + struct.calcsize(fmt), n, keys)
+    if b in (0xc7, 0xc8):
+        fmt = '>Bb' if b == 0xc7 else '>Hb'
+        n, ext = struct.unpack_from(fmt, data, pos)
+        pos += struct.calcsize(fmt)
+        if ext == MSGPACK_EXT_BIGINT:
+            return int(data[pos:pos + n]), pos + n
+    raise ValueError("Unsupported MessagePack type 0x{:02x}".format(b))
+
+
+def _unpack_array(data, pos, n, keys):
+    items = []
+    for _ in range(n):
+        item, pos = msgpack_unpack(data, pos, keys)
+        items.append(item)
+    return items, pos
+
+
+def _unpack_map(data, pos, n, keys):
+    items = []
+    for _ in range(n):
+        key, pos = msgpack_unpack(data, pos, keys)
+        value, pos = msgpack_unpack(data, pos, keys)
+        items.append((keys[key], value))
+    # Keys stay in the order they were written, which is the order of the
+    # JSON line
+    return OrderedDict(items), pos
+
+
+def is_msgpack(data):
+    return data[:len(MSGPACK_MAGIC)] == MSGPACK_MAGIC
+
+
+def iter_msgpack(blocks):
+    """Yields (payload, keys) for the entries of a msgpack log.
+
+    blocks are the consecutive pieces the log is read in, which records may
+    span. Only the payloads of K records are decoded, to build the key
+    dictionary. A torn record at the end is ignored.
+    """
+    keys = []
+    rest = b''
+    pos = len(MSGPACK_MAGIC)
+    for block in blocks:
+        data = rest + block if rest else block
+        while pos + MSGPACK_RECORD.size <= len(data):
+            kind, length = MSGPACK_RECORD.unpack_from(data, pos)
+            payload = pos + MSGPACK_RECORD.size
+            end = payload + length
+            if end > len(data):
+                break
+            if kind == b'K':
+                keys.extend(msgpack_unpack(data[payload:end], 0, keys)[0])
+            elif kind == b'E':
+                yield data[payload:end], keys
+            pos = end
+        rest = data[pos:]
+        pos = 0
+
+
+def msgpack_to_json(payload, keys):
+    """Returns the compact JSON line the json format would have written"""
+    entry = msgpack_unpack(payload, 0, keys)[0]
+    return json.dumps(entry, separators=(',', ':'),
+                      ensure_ascii=False).encode('utf-8')
+
+
+def msgpack_lines(entries, raw_needles=None):
+    """Yields the JSON lines of msgpack entries.
+
+    Entries are only decoded if they contain one of the raw_needles of every
+    group.
+    """
+    for payload, keys in entries:
+        if raw_needles and not all(any(n in payload for n in group)
+                                   for group in raw_needles):
+            continue
+        yield msgpack_to_json(payload, keys)
+
+
+def iter_entries(mm, start, end, anchors=None, raw_needles=None):
+    """Yields the JSON lines of a byte range of a log in either format"""
+    if not is_msgpack(mm):
+        for line in iter_lines(mm, start, end, anchors):
+            yield line
+        return
+
+    if start > 0:
+        # msgpack logs are always scanned as a whole
+        return
+    for line in msgpack_lines(iter_msgpack([mm]), raw_needles):
+        yield line
+
+
+def is_compressed(path):
+    return path.endswith(('.gz', '.zst'))
+
+
+def open_log(path):
+    """Opens a compressed log for reading its decompressed content"""
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, 'rb')
+
+    import zstandard
+    f = open(path, 'rb')
+    # Every flush of the plugins is a frame of its own
+    return zstandard.ZstdDecompressor().stream_reader(
+        f, read_across_frames=True, closefd=True)
+
+
+def truncation_errors():
+    """Returns the errors raised when a compressed log ends in the middle of
+    a gzip member or zstd frame, as it does after a crash"""
+    errors = (EOFError,)
+    zstandard = sys.modules.get('zstandard')
+    if zstandard is not None:
+        errors += (zstandard.ZstdError,)
+    return errors
+
+
+def read_blocks(f, block_size=BLOCK_SIZE):
+    """Yields the content of a stream in blocks of block_size bytes.
+
+    A truncated compressed stream ends with what could be decompressed,
+    followed by an empty block.
+    """
+    truncated = truncation_errors()
+    # read() loses what it decompressed before an error, read1() returns
+    # it, and the error comes with the next call
+    read = getattr(f, 'read1', f.read)
+    while True:
+        block = b''
+        try:
+            block = read(block_size)
+            # Decompressors may return less than asked for before the end
+            while block and len(block) < block_size:
+                more = read(block_size - len(block))
+                if not more:
+                    break
+                block += more
+        except truncated:
+            if block:
+                yield block
+            yield b''
+            return
+        if not block:
+            return
+        yield block
+
+
+def iter_stream(f, anchors=None, raw_needles=None):
+    """Yields the JSON lines of a log in either format read as a stream"""
+    blocks = read_blocks(f)
+    first = next(blocks, b'')
+    if is_msgpack(first):
+        for line in msgpack_lines(iter_msgpack(chain([first], blocks)),
+                                  raw_needles):
+            yield line
+        return
+
+    rest = b''
+    for block in chain([first], blocks):
+        if not block:
+            # Truncated in the middle of a line, which is left out
+            rest = b''
+            break
+        data = rest + block if rest else block
+        # Only whole lines are scanned, the rest is kept for the next block
+        cut = data.rfind(b'\n') + 1
+        for line in iter_lines(data, 0, cut, anchors):
+            yield line
+        rest = data[cut:]
+    for line in iter_lines(rest, 0, len(rest), anchors):
+        yield line
+
+
+def read_entries(path, start, end, anchors=None, raw_needles=None):
+    """Yields the JSON lines of a byte range of a log file.
+
+    Compressed logs are read as a whole, and only for the range at 0.
+    """
+    if is_compressed(path):
+        if start > 0:
+            return
+        with closing(open_log(path)) as f:
+            for line in iter_stream(f, anchors, raw_needles):
+                yield line
+        return
+
+    with mapped(path) as mm:
+        for line in iter_entries(mm, start, end, anchors, raw_needles):
+            yield line
+
+
+def find_logfiles(logdir):
+    """Returns the per-run logs and segments in logdir, compressed or not"""
+    paths = []
+    for pattern in LOG_PATTERNS:
+        paths.extend(glob.glob(os.path.join(logdir, pattern)))
+    return sorted(paths)
+
+
+class Query(object):
+    """Decides which log lines match the given filters.
+
+    Filters on hosts, events and time are checked against every line. The
+    playbook, user and run filters describe a run, and are checked against
+    its playbook_on_start line; the other lines of a run match if the run
+    does.
+    """
+
+    def __init__(self, hosts=None, events=None, playbooks=None, users=None,
+                 runs=None, since=None, until=None, inflate=True):
+        self.hosts = set(hosts or [])
+        self.events = set(events or [])
+        self.playbooks = set(playbooks or [])
+        self.users = set(users or [])
+        self.runs = set(runs or [])
+        self.since = since
+        self.until = until
+        self.inflate = inflate
+
+        # Each group of needles must have at least one member in a line.
+        # Hosts can also be logged as range patterns in a hosts summary, or
+        # be stored in a blob.
+        self.needles = []
+        if self.hosts:
+            self.needles.append(
+                [n for v in self.hosts for n in json_needles(v)] +
+                [b'"patterns"', b'"$blob"'])
+        if self.events:
+            self.needles.append(
+                [n for v in self.events for n in json_needles(v)])
+
+        # Every matching line contains one of the needles of the first group,
+        # so they are used to jump straight to candidate lines instead of
+        # visiting every line
+        self.anchors = self.needles[0] if self.needles else None
+
+        # The same needles for msgpack records, where strings are raw UTF-8
+        self.raw_needles = []
+        if self.hosts:
+            self.raw_needles.append(
+                [h.encode('utf-8') for h in self.hosts] +
+                [b'patterns', b'$blob'])
+        if self.events:
+            self.raw_needles.append([e.encode('utf-8') for e in self.events])
+
+    @property
+    def filters_runs(self):
+        return bool(self.playbooks or self.users or self.runs)
+
+    def match_run(self, run):
+        if self.runs and run['uuid'] not in self.runs:
+            return False
+        if self.playbooks:
+            playbook = run.get('playbook') or ''
+            if (playbook not in self.playbooks and
+                    os.path.basename(playbook) not in self.playbooks):
+                return False
+        if self.users:
+            if not any(run.get(f) in self.users for f in USER_FIELDS):
+                return False
+        return True
+
+    def match_line(self, line, runs=None, blobs=None):
+        """Returns the decoded entry if line matches, else None"""
+        for group in self.needles:
+            if not any(n in line for n in group):
+                return None
+
+        if self.since or self.until:
+            m = TIMESTAMP.search(line)
+            if not m:
+                return None
+            timestamp = m.group(1).decode('utf-8')
+            if self.since and timestamp < self.since:
+                return None
+            if self.until and timestamp >= self.until:
+                return None
+
+        if runs is not None:
+            m = UUID.search(line)
+            if not m or m.group(1).decode('utf-8') not in runs:
+                return None
+
+        try:
+            entry = json.loads(line.decode('utf-8'))
+        except ValueError:
+            return None
+
+        if blobs is not None and b'"$blob"' in line:
+            if self.hosts or self.inflate:
+                entry = blobs.inflate(entry)
+
+        if self.hosts and not self._match_host(entry):
+            return None
+        if self.events and entry.get('event') not in self.events:
+            return None
+        return entry
+
+    def _match_host(self, entry):
+        if entry.get('inventory_host') in self.hosts:
+            return True
+        # task_summary entries list the hosts of each outcome
+        if any(self._match_host(outcome)
+               for outcome in entry.get('outcomes') or ()):
+            return True
+        hosts = entry.get('hosts')
+        if isinstance(hosts, list):
+            return not self.hosts.isdisjoint(hosts)
+        if isinstance(hosts, dict) and 'patterns' in hosts:
+            return any(host_in_patterns(h, hosts['patterns'])
+                       for h in self.hosts)
+        if isinstance(hosts, dict):
+            # Chunked playbook_on_stats_hosts entries, keyed by host
+            return not self.hosts.isdisjoint(hosts)
+        return False
+
+
+def split_file(path, chunk_size):
+    """Splits a file into byte ranges that can be scanned independently"""
+    size = os.path.getsize(path)
+    if is_compressed(path):
+        return [(path, 0, size)]
+    with open(path, 'rb') as f:
+        if is_msgpack(f.read(len(MSGPACK_MAGIC))):
+            return [(path, 0, size)]
+    return [(path, start, min(start + chunk_size, size))
+            for start in range(0, size, chunk_size)]
+
+
+def segment_extents(path, runs, gap=BLOCK_SIZE, chunk_size=BLOCK_SIZE):
+    """Returns the byte ranges of a segment the writes of runs are in.
+
+    The ranges are read from the segment's index. Writes less than gap bytes
+    apart are scanned as one range of at most chunk_size bytes; the lines of
+    other runs in it are left out by the run filter. Returns None if the
+    segment has no index.
+    """
+    import uuid
+    run_ids = set()
+    for run in runs:
+        try:
+            run_ids.add(uuid.UUID(run).bytes)
+        except ValueError:
+            # Not a run uuid, so no run matches it
+            pass
+    record = SEGMENT_INDEX_RECORD
+    try:
+        f = open(path[:-len('.log')] + '.idx', 'rb')
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+    extents = []
+    with f:
+        for chunk in iter(lambda: f.read(record.size * 4096), b''):
+            for pos in range(0, len(chunk) - record.size + 1, record.size):
+                run_id, offset, length = record.unpack_from(chunk, pos)
+                if run_id in run_ids:
+                    extents.append((offset, offset + length))
+
+    # Concurrent runs may index their writes in another order than they
+    # were appended in
+    ranges = []
+    for start, end in sorted(extents):
+        if (ranges and start - ranges[-1][1] < gap and
+                end - ranges[-1][0] <= chunk_size):
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    return [(path, start, end) for start, end in ranges]
+
+
+def query_tasks(query, paths, chunk_size):
+    """Returns the byte ranges of paths the query has to scan.
+
+    With a run filter, only the writes of those runs are scanned in indexed
+    segments, and the per-run logs of other runs are left out.
+    """
+    tasks = []
+    for path in paths:
+        if query.runs:
+            run = run_of(path)
+            if run is not None and run not in query.runs:
+                continue
+            if SEGMENT.match(os.path.basename(path)):
+                extents = segment_extents(path, query.runs,
+                                          chunk_size=chunk_size)
+                if extents is not None:
+                    tasks.extend(extents)
+                    continue
+        tasks.extend(split_file(path, chunk_size))
+    return tasks
+
+
+def iter_lines(mm, start, end, anchors=None):
+    """Yields the lines that start inside [start, end) of a mapped file.
+
+    A line belongs to the range its first byte is in, so ranges of the same
+    file can be scanned by different workers without seeing a line twice.
+    With anchors only the lines containing one of them are yielded.
+    """
+    if start > 0:
+        start = mm.find(b'\n', start - 1)
+        if start == -1:
+            return
+        start += 1
+
+    # Next position of each anchor, only searched again once passed
+    hits = dict((a, -1) for a in anchors or ())
+
+    pos = start
+    while pos < end:
+        if anchors:
+            for anchor, hit in hits.items():
+                if hit is not None and hit < pos:
+                    hit = mm.find(anchor, pos)
+                    hits[anchor] = hit if hit != -1 else None
+            found = [h for h in hits.values() if h is not None]
+            if not found:
+                return
+            hit = min(found)
+            line_start = mm.rfind(b'\n', 0, hit) + 1
+            if line_start >= end:
+                return
+            line_start = max(line_start, pos)
+        else:
+            line_start = pos
+
+        line_end = mm.find(b'\n', line_start)
+        if line_end == -1:
+            line_end = len(mm)
+        yield mm[line_start:line_end]
+        pos = line_end + 1
+
+
+class mapped(object):
+    """Memory-maps a file read-only, as a context manager"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self._f = open(self.path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            self._mm = b''
+        return self._mm
+
+    def __exit__(self, *args):
+        if not isinstance(self._mm, bytes):
+            self._mm.close()
+        self._f.close()
+
+
+_query = None
+_runs = None
+
+
+def _init_worker(query, runs):
+    global _query, _runs
+    _query = query
+    _runs = runs
+
+
+def scan_runs(task):
+    """Returns the playbook_on_start entries in a byte range by run uuid"""
+    path, start, end = task
+    runs = {}
+    for line in read_entries(path, start, end, [b'"playbook_on_start"'],
+                             [[b'playbook_on_start']]):
+        try:
+            entry = json.loads(line.decode('utf-8'))
+        except ValueError:
+            continue
+        if entry.get('event') == 'playbook_on_start':
+            runs[entry.get('uuid')] = entry
+    return runs
+
+
+def scan_lines(task):
+    """Returns the matching lines in a byte range"""
+    path, start, end = task
+    blobs = BlobReader(os.path.join(os.path.dirname(path), 'blobs'))
+    matches = []
+    for line in read_entries(path, start, end, _query.anchors,
+                             _query.raw_needles):
+        entry = _query.match_line(line, _runs, blobs)
+        if entry is None:
+            continue
+        if _query.inflate and b'"$blob"' in line:
+            # Encoded like compact lines of the plugins, keeping the order
+            # of the keys
+            line = json.dumps(entry, separators=(',', ':'),
+                              ensure_ascii=False).encode('utf-8')
+        matches.append((line, entry))
+    return matches
+
+
+def run_query(query, paths, jobs=None, chunk_size=64 * 1024 * 1024,
+              need_runs=False):
+    """Yields (runs, line, entry) for every matching line.
+
+    runs maps run uuids to their playbook_on_start entries, and is only
+    collected when the query filters on runs or need_runs is set.
+    """
+    tasks = query_tasks(query, paths, chunk_size)
+    jobs = jobs or multiprocessing.cpu_count()
+
+    pool = None
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(jobs)
+        imap = pool.imap
+    else:
+        imap = map
+
+    try:
+        runs = {}
+        allowed = None
+        if query.filters_runs or need_runs:
+            for found in imap(scan_runs, tasks):
+                runs.update(found)
+        if query.filters_runs:
+            allowed = set(u for u, run in runs.items()
+                          if query.match_run(dict(run, uuid=u)))
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+            pool = multiprocessing.Pool(jobs, _init_worker, (query, allowed))
+            imap = pool.imap
+        else:
+            _init_worker(query, allowed)
+
+        for matches in imap(scan_lines, tasks):
+            for line, entry in matches:
+                yield runs, line, entry
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def run_of(path):
+    """Returns the uuid of the run of a per-run log, or None"""
+    m = RUN_LOG.match(os.path.basename(path))
+    return m.group(1) if m else None
+
+
+def connect_catalog(path):
+    db = sqlite3.connect(path, timeout=30, isolation_level=None)
+    db.execute('PRAGMA journal_mode=WAL')
+    for sql in CATALOG_SCHEMA:
+        db.execute(sql)
+    return db
+
+
+def catalog_candidates(db, query):
+    """Returns the uuids of the cataloged runs the query may match.
+
+    Runs that did not end yet can still log entries for any host at any
+    time, so only their start time, users and playbook rule them out.
+    """
+    clauses = []
+    params = []
+
+    def among(column, values):
+        params.extend(sorted(values))
+        return '{} IN ({})'.format(column, ', '.join('?' * len(values)))
+
+    if query.runs:
+        clauses.append(among('uuid', query.runs))
+    if query.users:
+        clauses.append('({})'.format(' OR '.join(
+            among(c, query.users) for c in CATALOG_USER_COLUMNS)))
+    if query.until:
+        clauses.append('start_time < ?')
+        params.append(query.until)
+    if query.since:
+        clauses.append('(end_time IS NULL OR end_time >= ?)')
+        params.append(query.since)
+    if query.hosts:
+        clauses.append('(end_time IS NULL OR uuid IN (SELECT uuid FROM '
+                       'run_hosts WHERE {}))'.format(
+                           among('host', query.hosts)))
+
+    sql = 'SELECT uuid, playbook, user, sudo_user, realuser, logname FROM runs'
+    if clauses:
+        sql += ' WHERE ' + ' AND '.join(clauses)
+    # The playbook is matched like in the logs, by path or file name
+    return set(row[0] for row in db.execute(sql, params)
+               if query.match_run(dict(zip(CATALOG_RUN_FIELDS, row))))
+
+
+def skip_cataloged(query, paths, catalog):
+    """Leaves out the per-run logs of cataloged runs that cannot match.
+
+    The logs of runs that are not in the catalog are always kept.
+    """
+    if not (query.hosts or query.users or query.playbooks or query.runs or
+            query.since or query.until):
+        return paths
+
+    db = connect_catalog(catalog)
+    try:
+        candidates = catalog_candidates(db, query)
+        others = sorted(set(run_of(p) for p in paths) - candidates -
+                        set([None]))
+        cataloged = set()
+        # Looked up in batches below SQLite's limit of bound parameters
+        for start in range(0, len(others), 500):
+            batch = others[start:start + 500]
+            cataloged.update(row[0] for row in db.execute(
+                'SELECT uuid FROM runs WHERE uuid IN ({})'.format(
+                    ', '.join('?' * len(batch))), batch))
+    finally:
+        db.close()
+    return [p for p in paths if run_of(p) not in cataloged]
+
+
+def scan_catalog(task):
+    """Returns the catalog rows of the runs in a byte range, by run uuid.
+
+    Rows are partial when the entries of a run span several ranges, and
+    are merged with merge_catalog_rows.
+    """
+    path, start, end = task
+    blobs = BlobReader(os.path.join(os.path.dirname(path), 'blobs'))
+    rows = {}
+    anchors = [b'"' + e.encode('ascii') + b'"' for e in CATALOG_EVENTS]
+    raw_needles = [[e.encode('ascii') for e in CATALOG_EVENTS]]
+    for line in read_entries(path, start, end, anchors, raw_needles):
+        try:
+            entry = json.loads(line.decode('utf-8'))
+        except ValueError:
+            continue
+        event = entry.get('event')
+        if event not in CATALOG_EVENTS:
+            continue
+        row = rows.setdefault(entry.get('uuid'), {'hosts': set()})
+
+        if event == 'playbook_on_start':
+            # Ansible 1 logs the check mode, 2 the options it came from
+            check_mode = entry.get('check_mode')
+            if check_mode is None:
+                options = blobs.inflate(entry.get('options')) or {}
+                check_mode = options.get('check')
+            # The hosts of the inventory, like the plugins catalog them
+            hosts = blobs.inflate(entry.get('hosts'))
+            if isinstance(hosts, dict):
+                hosts = expand_patterns(hosts.get('patterns') or ())
+            if isinstance(hosts, list):
+                row['hosts'].update(hosts)
+            row.update({
+                'controlhost': entry.get('controlhost'),
+                'logfile': os.path.abspath(path) if run_of(path) else None,
+                'playbook': entry.get('playbook'),
+                'start_time': entry.get('timestamp'),
+                'user': entry.get('USER'),
+                'sudo_user': entry.get('SUDO_USER'),
+                'realuser': entry.get('realuser'),
+                'logname': entry.get('logname'),
+                'automation_on_behalf_of': entry.get(
+                    'automation_on_behalf_of'),
+                'check_mode': None if check_mode is None else
+                bool(check_mode),
+            })
+            continue
+
+        row['end_time'] = max(row.get('end_time') or '',
+                              entry.get('timestamp') or '')
+        if event == 'playbook_on_stats':
+            stats = entry.get('stats') or {}
+            details = blobs.inflate(stats.get('details')) or {}
+            summary = stats.get('summary')
+            if summary is None:
+                # Logged before the stats had a summary
+                summary = dict((name, sum(details.get(key, {}).values()))
+                               for name, key in STATS_COUNTERS)
+            row['summary'] = summary
+            row['hosts'].update(details.get('processed') or ())
+        elif event == 'playbook_on_stats_hosts':
+            row['hosts'].update(entry.get('hosts') or ())
+    return rows
+
+
+def merge_catalog_rows(rows, found):
+    for run_uuid, part in found.items():
+        row = rows.setdefault(run_uuid, {'hosts': set()})
+        row['hosts'].update(part.pop('hosts'))
+        end_time = max(row.get('end_time') or '', part.get('end_time') or '')
+        row.update(part)
+        row['end_time'] = end_time or None
+
+
+def rebuild_catalog(catalog, paths, jobs=None, chunk_size=64 * 1024 * 1024):
+    """Replaces the contents of the catalog with the runs in paths.
+
+    Returns the number of cataloged runs. Runs without a playbook_on_start
+    entry are left out, like the plugins do.
+    """
+    tasks = [t for p in paths for t in split_file(p, chunk_size)]
+    jobs = jobs or multiprocessing.cpu_count()
+
+    rows = {}
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            for found in pool.imap_unordered(scan_catalog, tasks):
+                merge_catalog_rows(rows, found)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for found in map(scan_catalog, tasks):
+            merge_catalog_rows(rows, found)
+
+    runs = []
+    hosts = []
+    for run_uuid, row in rows.items():
+        if 'start_time' not in row:
+            continue
+        summary = row.get('summary') or {}
+        runs.append((run_uuid, row['controlhost'], row['logfile'],
+                     row['playbook'], row['start_time'], row['end_time'],
+                     row['user'], row['sudo_user'], row['realuser'],
+                     row['logname'], row['automation_on_behalf_of'],
+                     row['check_mode']) +
+                    tuple(summary.get(name) for name, key in STATS_COUNTERS))
+        hosts.extend((host, run_uuid) for host in row['hosts'])
+
+    db = connect_catalog(catalog)
+    try:
+        # One transaction, so readers see the old or the new catalog
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM runs')
+            db.execute('DELETE FROM run_hosts')
+            db.executemany(
+                'INSERT INTO runs (uuid, controlhost, logfile, playbook,'
+                ' start_time, end_time, user, sudo_user, realuser, logname,'
+                ' automation_on_behalf_of, check_mode, failures, ok,'
+                ' unreachable, changed, skipped)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                runs)
+            db.executemany('INSERT OR IGNORE INTO run_hosts (host, uuid)'
+                           ' VALUES (?, ?)', hosts)
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+    finally:
+        db.close()
+    return len(runs)
+
+
+def result_column(event, status):
+    """Returns the column of print_table a runner event is counted in"""
+    if event == 'runner_on_ok':
+        return status or 'ok'
+    if event in ('runner_on_failed', 'runner_on_async_failed'):
+        return 'failed'
+    if event == 'runner_on_unreachable':
+        return 'unreachable'
+    return None
+
+
+def print_table(results, out, hosts=None):
+    """Prints one row per run with the number of matching entries.
+
+    The results of task_summary entries are counted by the number of hosts
+    of each outcome, or only the given hosts if the query is for hosts.
+    """
+    rows = {}
+    for runs, line, entry in results:
+        run_id = entry.get('uuid')
+        row = rows.get(run_id)
+        if row is None:
+            run = runs.get(run_id, {})
+            user = next((run[f] for f in ('realuser', 'logname', 'USER')
+                         if run.get(f)), '')
+            row = rows[run_id] = {
+                'start': run.get('timestamp', entry.get('timestamp', '')),
+                'uuid': run_id,
+                'user': user,
+                'playbook': run.get('playbook', ''),
+                'entries': 0, 'ok': 0, 'changed': 0, 'failed': 0,
+                'unreachable': 0,
+            }
+        row['entries'] += 1
+        event = entry.get('event', '')
+        if event != 'task_summary':
+            column = result_column(event, entry.get('status'))
+            if column is not None:
+                row[column] += 1
+            continue
+
+        for outcome in entry.get('outcomes') or ():
+            column = result_column(outcome.get('event'),
+                                   outcome.get('status'))
+            if column is None:
+                continue
+            if hosts:
+                # Hosts of ok outcomes are not listed, so not counted
+                row[column] += len(hosts.intersection(
+                    outcome.get('hosts') or ()))
+            else:
+                row[column] += outcome.get('count', 0)
+
+    columns = ('start', 'uuid', 'user', 'playbook', 'entries', 'ok',
+               'changed', 'failed', 'unreachable')
+    table = [[c.upper() for c in columns]]
+    for row in sorted(rows.values(), key=lambda r: r['start']):
+        table.append([str(row[c]) for c in columns])
+
+    widths = [max(len(r[i]) for r in table) for i in range(len(columns))]
+    for r in table:
+        out.write('  '.join(v.ljust(w) for v, w in zip(r, widths)).rstrip())
+        out.write('\n')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Search the audit logs written by the auditlog '
+                    'callback plugins.')
+    parser.add_argument('paths', nargs='*',
+                        help='log files to search (default: all logs in '
+                             '--logdir)')
+    parser.add_argument('--logdir',
+                        default=os.getenv('ANSIBLE_AUDITLOG_LOGDIR',
+                                          '/var/log/ansible'),
+                        help='log directory (default: $ANSIBLE_AUDITLOG_LOGDIR'
+                             ' or /var/log/ansible)')
+    parser.add_argument('--host', action='append', dest='hosts',
+                        help='entries for this inventory host')
+    parser.add_argument('--event', action='append', dest='events',
+                        help='entries of this event, e.g. runner_on_failed')
+    parser.add_argument('--playbook', action='append', dest='playbooks',
+                        help='runs of this playbook (path or file name)')
+    parser.add_argument('--user', action='append', dest='users',
+                        help='runs by this user (' + ', '.join(USER_FIELDS) +
+                             ')')
+    parser.add_argument('--run', action='append', dest='runs',
+                        help='entries of the run with this uuid')
+    parser.add_argument('--since', help='entries at or after this ISO 8601 '
+                                        'timestamp')
+    parser.add_argument('--until', help='entries before this ISO 8601 '
+                                        'timestamp')
+    parser.add_argument('--no-inflate', dest='inflate', action='store_false',
+                        help='print blob references instead of the values '
+                             'stored in blobs')
+    parser.add_argument('--format', choices=('jsonl', 'table'),
+                        default='jsonl',
+                        help='print matching entries, or a summary per run')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes (default: CPUs)')
+    parser.add_argument('--catalog',
+                        help='run catalog (default: catalog.db in --logdir)')
+    parser.add_argument('--no-catalog', dest='use_catalog',
+                        action='store_false',
+                        help='search every log, without skipping the logs of '
+                             'runs the catalog rules out')
+    parser.add_argument('--rebuild-catalog', action='store_true',
+                        help='rebuild the run catalog from the logs and exit')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    query = Query(hosts=args.hosts, events=args.events,
+                  playbooks=args.playbooks, users=args.users, runs=args.runs,
+                  since=args.since, until=args.until, inflate=args.inflate)
+    paths = args.paths or find_logfiles(args.logdir)
+    catalog = args.catalog or os.path.join(args.logdir, CATALOG)
+    if args.rebuild_catalog:
+        runs = rebuild_catalog(catalog, paths, jobs=args.jobs)
+        sys.stderr.write('Cataloged {} runs in {}\n'.format(runs, catalog))
+        return 0
+    if args.use_catalog and not args.paths and os.path.exists(catalog):
+        paths = skip_cataloged(query, paths, catalog)
+
+    results = run_query(query, paths, jobs=args.jobs,
+                        need_runs=args.format == 'table')
+
+    if args.format == 'table':
+        print_table(results, sys.stdout, hosts=query.hosts)
+        return 0
+
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    try:
+        for runs, line, entry in results:
+            out.write(line + b'\n')
+        out.flush()
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+        # The reader went away, e.g. `| head`. Stop quietly.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
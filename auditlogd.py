@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+# Collects the audit logs of many concurrent ansible runs on a local Unix
+# socket and writes them through a single writer.
+#
+#   auditlogd.py --socket /run/auditlogd.sock --logdir /var/log/ansible
+#   ANSIBLE_AUDITLOG_SINK=unix:///run/auditlogd.sock ansible-playbook ...
+#
+# The callback plugins send their lines over a stream connection (unix://)
+# or as datagrams (unixgram://, with --datagram-socket). Lines are collected
+# per run and written run by run every --flush-interval milliseconds, when
+# --buffer-size bytes are pending, and when a run ends. They are written to
+# <uuid>.auditlogd.log files or segments in --logdir, or shipped to a single
+# remote --sink, which falls back to auditlogd.log in --logdir while it is
+# down. When auditlogd is not running, the plugins write their <uuid>.log
+# directly, so a run that loses auditlogd midway has both files, and
+# auditlog_query.py reads them as one run.
+#
+# The sinks of the plugins are used from auditlog_common, which has to be
+# next to auditlogd.py or on the PYTHONPATH. Ansible is not needed.
+#
+# For available options, see auditlogd.py --help
+
+import os
+import sys
+import errno
+import uuid
+import select
+import signal
+import socket
+import argparse
+
+from collections import OrderedDict
+
+from auditlog_common import (CollectorSink, FileSink, SegmentSink,
+                             SyncPolicy, COMPRESSION, DURABILITY, monotonic,
+                             open_sink)
+
+
+FRAME = CollectorSink.FRAME
+
+
+class Collector(object):
+    """Collects lines per run and writes them through one set of sinks.
+
+    Runs that have not sent anything for idle_timeout seconds have their
+    logfile closed. It is opened again if more lines arrive. Every sink
+    syncs its files on its own, as durability and sync_interval say.
+    """
+
+    def __init__(self, logdir, storage='file', segment_period='daily',
+                 sink='file', buffer_size=65536, buffer_lines=1000,
+                 durability='none', sync_interval=1.0, idle_timeout=60,
+                 compression='none', rotate_size=0, rotate_age=0):
+        if durability not in DURABILITY:
+            raise ValueError("Unknown durability: {}".format(durability))
+        if storage not in ('file', 'segmented'):
+            raise ValueError("Unknown storage mode: {}".format(storage))
+        if storage == 'segmented' and (compression != 'none' or
+                                       rotate_size or rotate_age):
+            raise ValueError("Compression and rotation need file storage")
+
+        self.logdir = logdir
+        self.storage = storage
+        self.segment_period = segment_period
+        self.buffer_size = buffer_size
+        self.buffer_lines = buffer_lines
+        self.durability = durability
+        self.sync_interval = sync_interval
+        self.idle_timeout = idle_timeout
+        self.compression = compression
+        self.rotate_size = rotate_size
+        self.rotate_age = rotate_age
+
+        self.remote = None
+        if sink != 'file':
+            fallback = self._file_sink('auditlogd.log')
+            self.remote = open_sink(sink, fallback, buffer_size=buffer_size,
+                                    buffer_lines=buffer_lines)
+
+        # run uuid -> lines not written yet, in the order they arrived
+        self._pending = OrderedDict()
+        self._pending_bytes = 0
+        # run uuid -> [local sink, time of the last lines]
+        self._runs = {}
+
+    def append(self, run_uuid, data):
+        self._pending.setdefault(run_uuid, []).append(data)
+        self._pending_bytes += len(data)
+        if self._pending_bytes >= self.buffer_size:
+            self.flush()
+
+    def end(self, run_uuid):
+        """Writes the remaining lines of a run and closes its logfile"""
+        self._write(run_uuid, self._pending.pop(run_uuid, []))
+        if self.remote is not None:
+            self.remote.flush()
+        run = self._runs.pop(run_uuid, None)
+        if run is not None:
+            run[0].close()
+
+    def flush(self):
+        """Writes the pending lines, each run's lines together"""
+        pending, self._pending = self._pending, OrderedDict()
+        self._pending_bytes = 0
+        for run_uuid, lines in pending.items():
+            self._write(run_uuid, lines)
+        if self.remote is not None:
+            self.remote.flush()
+
+    def expire(self):
+        """Closes the logfiles of idle runs"""
+        now = monotonic()
+        for run_uuid, run in list(self._runs.items()):
+            if now - run[1] >= self.idle_timeout and \
+                    run_uuid not in self._pending:
+                run[0].close()
+                del self._runs[run_uuid]
+
+    def close(self):
+        self.flush()
+        for local, last in self._runs.values():
+            local.close()
+        self._runs = {}
+        if self.remote is not None:
+            self.remote.close()
+
+    def _write(self, run_uuid, lines):
+        if not lines:
+            return
+        if self.remote is not None:
+            for line in lines:
+                self.remote.append(line)
+            return
+
+        run = self._runs.get(run_uuid)
+        if run is None:
+            run = self._runs[run_uuid] = [self._open(run_uuid), 0]
+        run[1] = monotonic()
+        for line in lines:
+            run[0].append(line)
+        run[0].flush()
+
+    def _open(self, run_uuid):
+        if self.storage == 'segmented':
+            return SegmentSink(self.logdir, run_uuid,
+                               period=self.segment_period,
+                               buffer_size=self.buffer_size,
+                               buffer_lines=self.buffer_lines,
+                               sync=self._sync())
+        # Not <uuid>.log, which the plugin writes while auditlogd is down
+        return self._file_sink('{}.auditlogd.log'.format(run_uuid))
+
+    def _sync(self):
+        return SyncPolicy(self.durability, interval=self.sync_interval)
+
+    def _file_sink(self, name):
+        path = os.path.join(self.logdir, name + COMPRESSION[self.compression])
+        return FileSink(path, buffer_size=self.buffer_size,
+                        buffer_lines=self.buffer_lines, sync=self._sync(),
+                        compression=self.compression,
+                        rotate_size=self.rotate_size,
+                        rotate_age=self.rotate_age)
+
+
+def parse_frames(buf):
+    """Removes the complete frames from buf and returns them.
+
+    Frames are (run uuid, lines) tuples, where empty lines end the run.
+    """
+    frames = []
+    pos = 0
+    while len(buf) - pos >= FRAME.size:
+        run_id, length = FRAME.unpack_from(buf, pos)
+        end = pos + FRAME.size + length
+        if end > len(buf):
+            break
+        frames.append((str(uuid.UUID(bytes=bytes(run_id))),
+                       bytes(buf[pos + FRAME.size:end])))
+        pos = end
+    del buf[:pos]
+    return frames
+
+
+def listen(path, socktype, mode):
+    """Binds a Unix socket at path, replacing a stale one"""
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    sock = socket.socket(socket.AF_UNIX, socktype)
+    sock.bind(path)
+    os.chmod(path, mode)
+    if socktype == socket.SOCK_STREAM:
+        sock.listen(128)
+    sock.setblocking(False)
+    return sock
+
+
+def serve(collector, stream_path=None, datagram_path=None, mode=0o660,
+          flush_interval=1.0):
+    """Receives frames until SIGTERM or SIGINT, then writes what is left"""
+    listeners = {}
+    if stream_path:
+        listeners[listen(stream_path, socket.SOCK_STREAM, mode)] = \
+            stream_path
+    if datagram_path:
+        listeners[listen(datagram_path, socket.SOCK_DGRAM, mode)] = \
+            datagram_path
+
+    # connection -> [receive buffer, runs sent over it]
+    connections = {}
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def received(buf, runs):
+        for run_uuid, data in parse_frames(buf):
+            if data:
+                runs.add(run_uuid)
+                collector.append(run_uuid, data)
+            else:
+                runs.discard(run_uuid)
+                collector.end(run_uuid)
+
+    flushed = monotonic()
+    try:
+        while True:
+            timeout = max(0, flushed + flush_interval - monotonic())
+            try:
+                readable = select.select(
+                    list(listeners) + list(connections), [], [], timeout)[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for sock in readable:
+                if sock in connections:
+                    try:
+                        data = sock.recv(1048576)
+                    except socket.error as e:
+                        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            continue
+                        data = b''
+                    buf, runs = connections[sock]
+                    if data:
+                        buf.extend(data)
+                        received(buf, runs)
+                        continue
+                    # The plugin went away. Its runs are over, and a partial
+                    # frame is dropped, as the plugin sends it again or
+                    # writes it to its fallback logfile.
+                    del connections[sock]
+                    sock.close()
+                    for run_uuid in runs:
+                        collector.end(run_uuid)
+                elif sock.type == socket.SOCK_STREAM:
+                    try:
+                        conn = sock.accept()[0]
+                    except socket.error:
+                        continue
+                    conn.setblocking(False)
+                    connections[conn] = [bytearray(), set()]
+                else:
+                    while True:
+                        try:
+                            data = sock.recv(CollectorSink.MAX_DATAGRAM +
+                                             FRAME.size)
+                        except socket.error as e:
+                            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                                break
+                            raise
+                        # Datagrams are whole frames, and runs sent as
+                        # datagrams end with an empty frame or when idle
+                        received(bytearray(data), set())
+
+            if monotonic() - flushed >= flush_interval:
+                collector.flush()
+                collector.expire()
+                flushed = monotonic()
+    finally:
+        for conn in connections:
+            conn.close()
+        for sock, path in listeners.items():
+            sock.close()
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        collector.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Collect the audit logs of many ansible runs on a local '
+                    'Unix socket.')
+    parser.add_argument('--socket',
+                        help='path of the stream socket, for '
+                             'ANSIBLE_AUDITLOG_SINK=unix://<path>')
+    parser.add_argument('--datagram-socket',
+                        help='path of the datagram socket, for '
+                             'ANSIBLE_AUDITLOG_SINK=unixgram://<path>')
+    parser.add_argument('--socket-mode', default='660',
+                        help='permissions of the sockets, in octal '
+                             '(default: 660)')
+    parser.add_argument('--logdir',
+                        default=os.getenv('ANSIBLE_AUDITLOG_LOGDIR',
+                                          '/var/log/ansible'),
+                        help='log directory (default: $ANSIBLE_AUDITLOG_LOGDIR'
+                             ' or /var/log/ansible)')
+    parser.add_argument('--storage', choices=('file', 'segmented'),
+                        default='file',
+                        help='write <uuid>.log files or shared segments '
+                             '(default: file)')
+    parser.add_argument('--segment-period', choices=('hourly', 'daily'),
+                        default='daily',
+                        help='how often a new segment is started '
+                             '(default: daily)')
+    parser.add_argument('--sink', default='file',
+                        help='ship the lines to this remote sink instead, '
+                             'see ANSIBLE_AUDITLOG_SINK (default: file)')
+    parser.add_argument('--compression', choices=sorted(COMPRESSION),
+                        default='none',
+                        help='compress the logfiles, see '
+                             'ANSIBLE_AUDITLOG_COMPRESSION (default: none)')
+    parser.add_argument('--rotate-size', type=int, default=0,
+                        help='bytes after which a new logfile is started, '
+                             '0 never (default: 0)')
+    parser.add_argument('--rotate-age', type=int, default=0,
+                        help='seconds after which a new logfile is started, '
+                             '0 never (default: 0)')
+    parser.add_argument('--durability', choices=DURABILITY, default='none',
+                        help='when written lines are synced to disk, see '
+                             'ANSIBLE_AUDITLOG_DURABILITY (default: none)')
+    parser.add_argument('--buffer-size', type=int, default=65536,
+                        help='bytes to collect before writing '
+                             '(default: 65536)')
+    parser.add_argument('--flush-interval', type=int, default=1000,
+                        help='milliseconds between writes (default: 1000)')
+    parser.add_argument('--idle-timeout', type=int, default=60,
+                        help='seconds after which the logfile of a run that '
+                             'sends nothing is closed (default: 60)')
+    args = parser.parse_args(argv)
+    if not args.socket and not args.datagram_socket:
+        parser.error('--socket or --datagram-socket is required')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    interval = args.flush_interval / 1000.0
+    collector = Collector(args.logdir, storage=args.storage,
+                          segment_period=args.segment_period,
+                          sink=args.sink, buffer_size=args.buffer_size,
+                          durability=args.durability,
+                          sync_interval=interval,
+                          idle_timeout=args.idle_timeout,
+                          compression=args.compression,
+                          rotate_size=args.rotate_size,
+                          rotate_age=args.rotate_age)
+    serve(collector, stream_path=args.socket,
+          datagram_path=args.datagram_socket,
+          mode=int(args.socket_mode, 8), flush_interval=interval)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+# Measures the cost of the auditlog callback plugins on synthetic runs.
+#
+#   benchmark.py --hosts 1000 --tasks 20
+#   benchmark.py --module auditlog2 -e ANSIBLE_AUDITLOG_ASYNC=true
+#   benchmark.py --vary ANSIBLE_AUDITLOG_DURABILITY=none,interval,group,always
+#
+# Fake playbook, play, task, inventory, result and stats objects drive
+# CallbackModule through a run of N hosts x M tasks with a mix of ok,
+# changed, failed and unreachable results. Each module runs in its own
+# process, so peak RSS is per module. No ansible target or network is
+# needed, and if ansible is not installed, the few ansible modules the
+# plugins import are replaced by minimal stand-ins.
+#
+# Settings are passed to the plugins as ANSIBLE_AUDITLOG_* environment
+# variables, with -e or from the environment of the benchmark. With --vary,
+# the benchmark is repeated for each value of a setting.
+#
+# For available options, see benchmark.py --help
+
+import os
+import sys
+import json
+import time
+import types
+import random
+import shutil
+import tempfile
+import argparse
+import multiprocessing
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+MODULES = ('auditlog', 'auditlog2')
+
+# time.perf_counter is not available on Python 2
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def install_ansible_shim():
+    """Provides the ansible modules the plugins import, if ansible is missing.
+
+    Returns True if the stand-ins were installed.
+    """
+    try:
+        import ansible  # noqa: F401
+        return False
+    except ImportError:
+        pass
+
+    def module(name, **attrs):
+        mod = types.ModuleType(name)
+        mod.__dict__.update(attrs)
+        sys.modules[name] = mod
+        return mod
+
+    class Display(object):
+        def warning(self, msg):
+            sys.stderr.write('[WARNING]: {}\n'.format(msg))
+
+        def display(self, msg, **kwargs):
+            sys.stderr.write('{}\n'.format(msg))
+
+    class CallbackBase(object):
+        # Ansible 2.x passes v2 events on to the v1 hooks like this
+        def __init__(self, display=None):
+            pass
+
+        def v2_runner_on_ok(self, result):
+            self.runner_on_ok(result._host.get_name(), result._result)
+
+        def v2_runner_on_failed(self, result, ignore_errors=False):
+            self.runner_on_failed(result._host.get_name(), result._result,
+                                  ignore_errors)
+
+        def v2_runner_on_unreachable(self, result):
+            self.runner_on_unreachable(result._host.get_name(),
+                                       result._result)
+
+        def v2_playbook_on_stats(self, stats):
+            self.playbook_on_stats(stats)
+
+    def warning(msg):
+        Display().warning(msg)
+
+    def combine_vars(a, b):
+        result = dict(a)
+        result.update(b)
+        return result
+
+    ansible = module('ansible')
+    ansible.utils = module('ansible.utils', warning=warning,
+                           combine_vars=combine_vars)
+    ansible.utils.display = module('ansible.utils.display', Display=Display)
+    ansible.plugins = module('ansible.plugins')
+    ansible.plugins.callback = module('ansible.plugins.callback',
+                                      CallbackBase=CallbackBase)
+    return True
+
+
+class Host(object):
+    def __init__(self, name):
+        self.name = name
+
+    def get_name(self):
+        return self.name
+
+
+class Inventory(object):
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.host_list = '/etc/ansible/hosts'
+
+    def list_hosts(self, pattern='all'):
+        # Ansible 1.x returns names, 2.x returns host objects
+        return list(self.hosts)
+
+
+class VariableManager(object):
+    def __init__(self, inventory, extra_vars):
+        self._inventory = inventory
+        self.extra_vars = extra_vars
+
+    def get_vars(self, loader=None, play=None, **kwargs):
+        variables = {'ansible_version': {'full': '2.9.0'}}
+        variables.update(play.vars)
+        variables.update(self.extra_vars)
+        return variables
+
+
+class Play(object):
+    def __init__(self, name, hosts, variable_manager):
+        self.name = name
+        self.hosts = hosts
+        self.vars = {'app_version': '1.2.3'}
+        self.remote_user = 'deploy'
+        self.serial = 0
+        self.max_fail_pct = self.max_fail_percentage = None
+        self._uuid = name
+        self._variable_manager = variable_manager
+
+    def get_variable_manager(self):
+        return self._variable_manager
+
+    def get_loader(self):
+        return None
+
+
+class Playbook(object):
+    def __init__(self, plays, inventory, extra_vars):
+        self._file_name = self.filename = 'site.yml'
+        self.plays = plays
+        self.inventory = inventory
+        self.global_vars = {}
+        self.extra_vars = extra_vars
+        self.only_tags = ['all']
+        self.skip_tags = []
+        self.check = False
+        self.remote_user = 'deploy'
+
+    def get_plays(self):
+        return self.plays
+
+
+class Task(object):
+    def __init__(self, name):
+        self.name = name
+        self.action = 'command'
+        self._uuid = name
+
+    def get_name(self):
+        return self.name
+
+
+class Result(object):
+    def __init__(self, host, task, result):
+        self._host = host
+        self._task = task
+        self._result = result
+
+
+class PlayContext(object):
+    remote_user = 'deploy'
+    become = True
+    become_method = 'sudo'
+    become_user = 'root'
+
+
+class Stats(object):
+    def __init__(self):
+        self.processed = {}
+        self.failures = {}
+        self.ok = {}
+        self.dark = {}
+        self.changed = {}
+        self.skipped = {}
+
+    def increment(self, what, host):
+        self.processed[host] = 1
+        counts = getattr(self, what)
+        counts[host] = counts.get(host, 0) + 1
+
+    def summarize(self, host):
+        return {
+            'ok': self.ok.get(host, 0),
+            'failures': self.failures.get(host, 0),
+            'unreachable': self.dark.get(host, 0),
+            'changed': self.changed.get(host, 0),
+            'skipped': self.skipped.get(host, 0),
+        }
+
+
+class Scenario(object):
+    """The results of a synthetic run, the same for every module"""
+
+    def __init__(self, hosts=1000, tasks=20, changed=0.2, failed=0.02,
+                 unreachable=0.01, msg_size=4096, seed=0):
+        rng = random.Random(seed)
+        self.hosts = ['host{:05d}.example.com'.format(i) for i in range(hosts)]
+        self.tasks = ['task {}'.format(i) for i in range(tasks)]
+        self.results = []
+        for task in self.tasks:
+            outcomes = []
+            for host in self.hosts:
+                r = rng.random()
+                if r < unreachable:
+                    outcomes.append('unreachable')
+                elif r < unreachable + failed:
+                    outcomes.append('failed')
+                elif r < unreachable + failed + changed:
+                    outcomes.append('changed')
+                else:
+                    outcomes.append('ok')
+            self.results.append(outcomes)
+
+        line = 'Traceback (most recent call last): command failed. '
+        self.msg = (line * (msg_size // len(line) + 1))[:msg_size]
+
+    def result(self, outcome):
+        result = {
+            'changed': outcome == 'changed',
+            'invocation': {'module_name': 'command',
+                           'module_args': 'uptime'},
+        }
+        if outcome == 'failed':
+            result['msg'] = self.msg
+        elif outcome == 'unreachable':
+            result['msg'] = 'Failed to connect to the host via ssh'
+        return result
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process in bytes"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def disk_usage(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def run_benchmark(module_name, scenario, env):
+    """Drives one plugin through the scenario and returns its measurements.
+
+    Meant to run in a fresh process, as it imports the plugin and changes the
+    environment.
+    """
+    os.environ.update(env)
+    install_ansible_shim()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    plugin = __import__(module_name)
+
+    hosts = [Host(h) for h in scenario.hosts]
+    inventory = Inventory(scenario.hosts if module_name == 'auditlog'
+                          else hosts)
+    extra_vars = {'automation_on_behalf_of': 'benchmark'}
+    vm = VariableManager(inventory, extra_vars)
+    play = Play('benchmark', 'all', vm)
+    playbook = Playbook([play], inventory, extra_vars)
+    stats = Stats()
+    stat_names = {'ok': 'ok', 'changed': 'changed', 'failed': 'failures',
+                  'unreachable': 'dark'}
+
+    latencies = []
+
+    def timed(hook, *args):
+        start = clock()
+        hook(*args)
+        latencies.append(clock() - start)
+
+    started = clock()
+    callback = plugin.CallbackModule()
+    if callback.disabled:
+        raise RuntimeError('{} is disabled, see the warnings above'.format(
+            module_name))
+
+    if module_name == 'auditlog':
+        callback.playbook = playbook
+        timed(callback.playbook_on_start)
+        callback.play = play
+        timed(callback.playbook_on_play_start, play.name)
+    else:
+        callback.set_play_context(PlayContext())
+        timed(callback.v2_playbook_on_start, playbook)
+        timed(callback.v2_playbook_on_play_start, play)
+
+    for name, outcomes in zip(scenario.tasks, scenario.results):
+        task = Task(name)
+        if module_name == 'auditlog':
+            timed(callback.playbook_on_task_start, name, False)
+        else:
+            timed(callback.v2_playbook_on_task_start, task, False)
+
+        for host, outcome in zip(hosts, outcomes):
+            stats.increment(stat_names[outcome], host.name)
+            if outcome == 'changed':
+                stats.increment('ok', host.name)
+            result = scenario.result(outcome)
+
+            if module_name == 'auditlog':
+                if outcome == 'failed':
+                    timed(callback.runner_on_failed, host.name, result)
+                elif outcome == 'unreachable':
+                    timed(callback.runner_on_unreachable, host.name, result)
+                else:
+                    timed(callback.runner_on_ok, host.name, result)
+            else:
+                result = Result(host, task, result)
+                if outcome == 'failed':
+                    timed(callback.v2_runner_on_failed, result)
+                elif outcome == 'unreachable':
+                    timed(callback.v2_runner_on_unreachable, result)
+                else:
+                    timed(callback.v2_runner_on_ok, result)
+
+    if module_name == 'auditlog':
+        timed(callback.playbook_on_stats, stats)
+    else:
+        timed(callback.v2_playbook_on_stats, stats)
+    callback.logger.close()
+    elapsed = clock() - started
+
+    latencies.sort()
+    return {
+        'module': module_name,
+        'events': len(latencies),
+        'seconds': round(elapsed, 3),
+        'events_per_sec': int(len(latencies) / elapsed),
+        'p50_us': round(percentile(latencies, 0.5) * 1e6, 1),
+        'p90_us': round(percentile(latencies, 0.9) * 1e6, 1),
+        'p99_us': round(percentile(latencies, 0.99) * 1e6, 1),
+        'max_us': round(latencies[-1] * 1e6, 1),
+        'peak_rss_mb': round(peak_rss() / 1048576.0, 1) if resource else None,
+        'bytes': disk_usage(env['ANSIBLE_AUDITLOG_LOGDIR']),
+    }
+
+
+def run_isolated(module_name, scenario, env):
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        return pool.apply(run_benchmark, (module_name, scenario, env))
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def print_table(results, out):
+    columns = ('module', 'events', 'seconds', 'events_per_sec', 'p50_us',
+               'p90_us', 'p99_us', 'max_us', 'peak_rss_mb', 'bytes')
+    if any('setting' in result for result in results):
+        columns = ('setting',) + columns
+    table = [[c.upper() for c in columns]]
+    for result in results:
+        table.append([str(result[c]) for c in columns])
+
+    widths = [max(len(r[i]) for r in table) for i in range(len(columns))]
+    for r in table:
+        out.write('  '.join(v.ljust(w) for v, w in zip(r, widths)).rstrip())
+        out.write('\n')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the auditlog callback plugins on synthetic '
+                    'runs.')
+    parser.add_argument('--module', action='append', dest='modules',
+                        choices=MODULES,
+                        help='plugin to benchmark (default: both)')
+    parser.add_argument('--hosts', type=int, default=1000,
+                        help='number of hosts (default: 1000)')
+    parser.add_argument('--tasks', type=int, default=20,
+                        help='number of tasks (default: 20)')
+    parser.add_argument('--changed', type=float, default=0.2,
+                        help='share of changed results (default: 0.2)')
+    parser.add_argument('--failed', type=float, default=0.02,
+                        help='share of failed results (default: 0.02)')
+    parser.add_argument('--unreachable', type=float, default=0.01,
+                        help='share of unreachable results (default: 0.01)')
+    parser.add_argument('--msg-size', type=int, default=4096,
+                        help='bytes in the msg of failed results '
+                             '(default: 4096)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the results (default: 0)')
+    parser.add_argument('-e', '--env', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='setting for the plugins, e.g. '
+                             'ANSIBLE_AUDITLOG_ASYNC=true')
+    parser.add_argument('--vary', metavar='NAME=VALUE,...',
+                        help='repeat the benchmark for each value of this '
+                             'setting, e.g. '
+                             'ANSIBLE_AUDITLOG_DURABILITY=none,group')
+    parser.add_argument('--logdir',
+                        help='keep the logs in a directory per module in '
+                             'LOGDIR (default: a temporary directory, '
+                             'removed afterwards)')
+    parser.add_argument('--format', choices=('table', 'json'),
+                        default='table',
+                        help='print a table, or one JSON object per module')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    scenario = Scenario(hosts=args.hosts, tasks=args.tasks,
+                        changed=args.changed, failed=args.failed,
+                        unreachable=args.unreachable,
+                        msg_size=args.msg_size, seed=args.seed)
+
+    env = dict((k, v) for k, v in os.environ.items()
+               if k.startswith('ANSIBLE_AUDITLOG_'))
+    for setting in args.env:
+        name, sep, value = setting.partition('=')
+        if not sep:
+            sys.stderr.write('Invalid setting: {}\n'.format(setting))
+            return 2
+        env[name] = value
+    variants = [None]
+    if args.vary:
+        name, sep, values = args.vary.partition('=')
+        if not sep or not values:
+            sys.stderr.write('Invalid --vary: {}\n'.format(args.vary))
+            return 2
+        variants = [(name, value) for value in values.split(',')]
+
+    results = []
+    for variant in variants:
+        if variant is not None:
+            env[variant[0]] = variant[1]
+        for module_name in args.modules or MODULES:
+            if args.logdir:
+                logdir = os.path.join(args.logdir, module_name)
+                if variant is not None:
+                    logdir = os.path.join(logdir, variant[1])
+                if not os.path.isdir(logdir):
+                    os.makedirs(logdir)
+            else:
+                logdir = tempfile.mkdtemp(prefix='auditlog-bench-')
+            env['ANSIBLE_AUDITLOG_LOGDIR'] = logdir
+            try:
+                result = run_isolated(module_name, scenario, env)
+            finally:
+                if not args.logdir:
+                    shutil.rmtree(logdir, ignore_errors=True)
+            if variant is not None:
+                result['setting'] = '='.join(variant)
+            results.append(result)
+
+    if args.format == 'json':
+        for result in results:
+            sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+    else:
+        print_table(results, sys.stdout)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,343 @@
+import json
+import sqlite3
+
+import pytest
+
+pytest.importorskip('ansible.plugins.callback')
+
+import auditlog2  # noqa: E402
+import auditlog_common  # noqa: E402
+
+
+class Display(object):
+
+    def __init__(self):
+        self.warnings = []
+
+    def warning(self, msg):
+        self.warnings.append(msg)
+
+
+class Host(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def get_name(self):
+        return self.name
+
+
+class Task(object):
+
+    def __init__(self, name, action='command'):
+        self.name = name
+        self.action = action
+
+    def get_name(self):
+        return self.name
+
+
+class Result(object):
+
+    def __init__(self, host, task, result=None):
+        self._host = Host(host)
+        self._task = task
+        self._result = result or {}
+
+
+class Inventory(object):
+
+    def __init__(self, hosts):
+        self.hosts = hosts
+
+    def list_hosts(self, pattern='all'):
+        return [Host(h) for h in self.hosts]
+
+
+class VariableManager(object):
+
+    def __init__(self, hosts, extra_vars=None):
+        self._inventory = Inventory(hosts)
+        self.extra_vars = extra_vars or {}
+
+    def get_vars(self, loader=None, play=None, **kwargs):
+        return dict(play.vars, **self.extra_vars)
+
+
+class Play(object):
+
+    def __init__(self, name, hosts, variable_manager):
+        self.name = name
+        self.hosts = hosts
+        self.serial = 0
+        self.max_fail_percentage = None
+        self.vars = {}
+        self._variable_manager = variable_manager
+
+    def get_variable_manager(self):
+        return self._variable_manager
+
+    def get_loader(self):
+        return None
+
+
+class Playbook(object):
+
+    def __init__(self, plays):
+        self._file_name = 'site.yml'
+        self._plays = plays
+
+    def get_plays(self):
+        return self._plays
+
+
+class PlayContext(object):
+    remote_user = 'root'
+    become = False
+    become_method = 'sudo'
+    become_user = 'root'
+
+
+class Stats(object):
+
+    def __init__(self, **counters):
+        self.processed = {}
+        for attr in ('failures', 'ok', 'dark', 'changed', 'skipped'):
+            setattr(self, attr, counters.get(attr, {}))
+            self.processed.update((h, 1) for h in getattr(self, attr))
+
+
+def start_playbook(callback, hosts):
+    """Starts a playbook of one play on all hosts of the inventory"""
+    play = Play('deploy', ['all'], VariableManager(hosts))
+    callback.set_play_context(PlayContext())
+    callback.v2_playbook_on_start(Playbook([play]))
+    callback.v2_playbook_on_play_start(play)
+    return play
+
+
+@pytest.fixture
+def plugin(tmpdir, monkeypatch):
+    """Returns a function that creates the plugin with the given settings"""
+    def create(**settings):
+        monkeypatch.setenv('ANSIBLE_AUDITLOG_LOGDIR', str(tmpdir))
+        for name, value in settings.items():
+            monkeypatch.setenv('ANSIBLE_AUDITLOG_' + name, str(value))
+        callback = auditlog2.CallbackModule(display=Display())
+        created.append(callback)
+        return callback
+    created = []
+    yield create
+    for callback in created:
+        if not callback.disabled:
+            callback.logger.close()
+
+
+def logged(callback, event=None):
+    """Returns the entries written to the logfile, or those of one event"""
+    callback.logger.flush()
+    with open(callback.logger.logfile) as f:
+        entries = [json.loads(line) for line in f]
+    return [e for e in entries if event is None or e['event'] == event]
+
+
+def fail_writes(callback):
+    def append(data):
+        raise OSError('disk full')
+    callback.logger.sink.append = append
+
+
+def test_failed_writer_warns_once_and_discards_entries(plugin):
+    callback = plugin(ASYNC='true', FAILMODE='warn')
+    fail_writes(callback)
+    task = Task('install')
+
+    callback.v2_playbook_on_task_start(task, False)
+    callback.v2_runner_on_ok(Result('web01', task))
+    callback.logger.flush()
+    assert callback._display.warnings == [
+        'Audit logging failed: disk full']
+
+    # The hooks hold bound references to the logger's methods
+    callback.v2_runner_on_ok(Result('web02', task))
+    callback.v2_playbook_on_task_start(Task('restart'), False)
+    callback.logger.close()
+    assert len(callback._display.warnings) == 1
+
+
+def test_failed_writer_exits_in_fail_mode(plugin):
+    callback = plugin(ASYNC='true', FAILMODE='fail')
+    fail_writes(callback)
+    task = Task('install')
+
+    callback.v2_playbook_on_task_start(task, False)
+    callback.v2_runner_on_ok(Result('web01', task))
+    with pytest.raises(SystemExit):
+        callback.logger.flush()
+
+    # Only the first failure ends the run
+    callback.v2_runner_on_ok(Result('web02', task))
+    callback.logger.flush()
+
+
+@pytest.mark.parametrize('sink, logged_to_file', [
+    ('file', True), ('unix:///nonexistent/auditlogd.sock', False)])
+def test_catalog_maps_runs_to_their_inventory(plugin, tmpdir, sink,
+                                              logged_to_file):
+    callback = plugin(CATALOG='true', SINK=sink)
+    start_playbook(callback, ['web01', 'db01'])
+    callback.catalog.close()
+
+    db = sqlite3.connect(str(tmpdir.join('catalog.db')))
+    try:
+        logfile, = db.execute('SELECT logfile FROM runs').fetchone()
+        hosts = db.execute('SELECT host FROM run_hosts').fetchall()
+    finally:
+        db.close()
+    assert logfile == (callback.logger.logfile if logged_to_file else None)
+    assert sorted(hosts) == [('db01',), ('web01',)]
+
+
+def test_aggregated_task_summary_lists_hosts_except_for_ok(plugin):
+    callback = plugin(AGGREGATE='true')
+    start_playbook(callback, ['web01', 'web02', 'web03', 'db01', 'db02'])
+    task = Task('install')
+
+    callback.v2_playbook_on_task_start(task, False)
+    callback.v2_runner_on_ok(Result('web01', task))
+    callback.v2_runner_on_ok(Result('web02', task))
+    callback.v2_runner_on_ok(Result('web03', task, {'changed': True}))
+    callback.v2_runner_on_failed(Result('db01', task, {'msg': 'no space'}))
+    callback.v2_runner_on_unreachable(Result('db02', task))
+    callback.v2_playbook_on_task_start(Task('restart'), False)
+
+    assert logged(callback, 'runner_on_ok') == []
+    summary, = logged(callback, 'task_summary')
+    assert summary['task'] == 'install'
+    assert summary['partial'] is False
+    assert summary['outcomes'] == [
+        {'event': 'runner_on_ok', 'status': 'ok', 'module_name': 'command',
+         'count': 2},
+        {'event': 'runner_on_ok', 'status': 'changed',
+         'module_name': 'command', 'count': 1, 'hosts': ['web03']},
+        {'event': 'runner_on_failed', 'module_name': 'command',
+         'ignore_errors': False, 'msg': 'no space', 'count': 1,
+         'hosts': ['db01']},
+        {'event': 'runner_on_unreachable', 'count': 1, 'hosts': ['db02']},
+    ]
+
+
+def test_aggregated_task_summary_is_logged_in_parts_at_max_hosts(plugin):
+    callback = plugin(AGGREGATE='true', AGGREGATE_MAX_HOSTS=2)
+    start_playbook(callback, ['web01', 'web02', 'web03'])
+    task = Task('install')
+
+    callback.v2_playbook_on_task_start(task, False)
+    for host in ('web01', 'web02', 'web03'):
+        callback.v2_runner_on_ok(Result(host, task, {'changed': True}))
+    callback.v2_playbook_on_task_start(Task('restart'), False)
+
+    first, last = logged(callback, 'task_summary')
+    assert (first['task'], first['partial']) == ('install', True)
+    assert first['outcomes'][0]['count'] == 2
+    assert first['outcomes'][0]['hosts'] == ['web01', 'web02']
+    assert (last['task'], last['partial']) == ('install', False)
+    assert last['outcomes'][0]['count'] == 1
+    assert last['outcomes'][0]['hosts'] == ['web03']
+
+
+def test_suppressed_hooks_only_keep_track_of_tasks(plugin):
+    callback = plugin(AGGREGATE='true', EVENTS='runner_on_failed')
+    start_playbook(callback, ['web01', 'db01'])
+    install = Task('install')
+    restart = Task('restart')
+
+    callback.v2_playbook_on_task_start(install, False)
+    callback.v2_runner_on_ok(Result('web01', install))
+    callback.v2_runner_on_failed(Result('db01', install))
+    callback.v2_playbook_on_task_start(restart, False)
+    callback.v2_runner_on_failed(Result('web01', restart))
+    callback.playbook_on_stats(None)
+
+    # Suppressed runner events are not counted either
+    entries = logged(callback)
+    assert [e['event'] for e in entries] == ['task_summary', 'task_summary']
+    assert [e['task'] for e in entries] == ['install', 'restart']
+    assert [e['outcomes'][0]['hosts'] for e in entries] == [
+        ['db01'], ['web01']]
+
+
+STATS = Stats(ok={'web01': 2, 'web02': 1, 'db01': 1}, changed={'web01': 1},
+              failures={'db01': 1})
+
+
+@pytest.mark.parametrize('layout, chunks', [
+    ('chunked', [
+        {'db01': {'failures': 1, 'ok': 1}, 'web01': {'ok': 2, 'changed': 1}},
+        {'web02': {'ok': 1}},
+    ]),
+    ('columnar', [
+        {'hosts': ['db01', 'web01'], 'failures': [1, 0], 'ok': [1, 2],
+         'unreachable': [0, 0], 'changed': [0, 1], 'skipped': [0, 0]},
+        {'hosts': ['web02'], 'failures': [0], 'ok': [1],
+         'unreachable': [0], 'changed': [0], 'skipped': [0]},
+    ]),
+])
+def test_stats_are_logged_in_chunks_of_hosts(plugin, layout, chunks):
+    callback = plugin(STATS_LAYOUT=layout, STATS_CHUNK_HOSTS=2)
+    start_playbook(callback, ['web01', 'web02', 'db01'])
+    callback.playbook_on_stats(STATS)
+
+    stats, = logged(callback, 'playbook_on_stats')
+    assert 'details' not in stats['stats']
+    assert stats['stats']['summary'] == {
+        'failures': 1, 'ok': 4, 'unreachable': 0, 'changed': 1, 'skipped': 0}
+    assert (stats['stats']['layout'], stats['stats']['hosts'],
+            stats['stats']['chunks']) == (layout, 3, 2)
+
+    logged_chunks = logged(callback, 'playbook_on_stats_hosts')
+    assert [c['chunk'] for c in logged_chunks] == [0, 1]
+    assert [c['layout'] for c in logged_chunks] == [layout, layout]
+    if layout == 'chunked':
+        assert [c['hosts'] for c in logged_chunks] == chunks
+    else:
+        assert [dict((k, c[k]) for k in chunk)
+                for c, chunk in zip(logged_chunks, chunks)] == chunks
+
+
+class Clock(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_timing_logs_latency_percentiles(plugin, monkeypatch):
+    clock = Clock(100.0)
+    monkeypatch.setattr(auditlog_common, 'monotonic', clock)
+    callback = plugin(TIMING='true')
+    start_playbook(callback, ['web01', 'web02', 'web03', 'db01'])
+    task = Task('install')
+
+    clock.now = 101.0
+    callback.v2_playbook_on_task_start(task, False)
+    for host, latency in (('web01', 0.5), ('web02', 1.0), ('web03', 2.0),
+                          ('db01', 8.0)):
+        clock.now = 101.0 + latency
+        callback.v2_runner_on_ok(Result(host, task))
+    clock.now = 110.0
+    callback.playbook_on_stats(Stats(ok={'web01': 1}))
+
+    assert [e['latency'] for e in logged(callback, 'runner_on_ok')] == [
+        0.5, 1.0, 2.0, 8.0]
+    # Percentiles are the bound of their bucket, but never above the
+    # largest latency
+    latency = {'count': 4, 'p50': 1.024, 'p90': 8.0, 'p99': 8.0, 'max': 8.0}
+    task_end, = logged(callback, 'task_end')
+    assert task_end['task'] == 'install'
+    assert task_end['timing'] == {
+        'start': 1.0, 'duration': 9.0, 'latency': latency}
+    stats, = logged(callback, 'playbook_on_stats')
+    assert stats['timing'] == {'duration': 10.0, 'latency': latency}
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import os
+
+import pytest
+
+from auditlog_common import JsonEncoder
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data',
+                      'encoder_golden.jsonl')
+
+
+class Unsafe(str):
+    """Like the unsafe strings of ansible"""
+
+
+CORPUS = [
+    ('runner_on_ok', {'inventory_host': 'web01', 'status': 'changed',
+                      'module_name': 'command', 'latency': 0.25}),
+    ('playbook_on_task_start', {'name': u'Déployer l’app ✓ 日本 😀'}),
+    ('runner_on_failed', {'inventory_host': 'web02', 'ignore_errors': False,
+                          'msg': 'quote " backslash \\ tab \t nl \n \x00 '
+                                 u'  null 1e5'}),
+    ('task_end', {'timing': {'start': 0.0, 'duration': 1e-05,
+                             'latency': {'p50': 123456789.123, 'p99': 1e16,
+                                         'max': 1.5e300, 'min': -0.0}}}),
+    ('task_end', {'timing': {'duration': 0.00001234, 'start': 5e-324}}),
+    ('playbook_on_stats', {'audit_vars': {'version': None, 'flag': False,
+                                          'apps[*].version': [1, None]}}),
+    ('playbook_on_stats', {'audit_vars': {'ratio': float('nan')}}),
+    ('playbook_on_stats', {'audit_vars': {'limits': [float('inf'),
+                                                     float('-inf')]}}),
+    ('playbook_on_stats', {'audit_vars': {'big': 2 ** 70,
+                                          'small': -2 ** 63}}),
+    ('playbook_on_stats', {'audit_vars': {'ports': {80: 'http'}}}),
+    ('playbook_on_play_start', {'name': Unsafe('web'), 'hosts': ['a', 'b'],
+                                'serial': 0}),
+    ('playbook_on_play_start', {}),
+    ('playbook_on_stats', {'audit_vars': {
+        'when': datetime.datetime(2024, 1, 2, 3, 4, 5)}}),
+    ('playbook_on_stats', {'audit_vars': {
+        'dates': [datetime.date(2024, 1, 2)]}}),
+]
+
+
+def encoder(sort_keys, orjson, compact=True):
+    encoder = JsonEncoder('controller', '6f1c4bb4-9a53-4ad4-a7d9-4c1e0f0d1a2b',
+                          sort_keys=sort_keys, compact=compact)
+    if not orjson:
+        encoder._orjson = None
+    elif encoder._orjson is None:
+        pytest.skip('orjson is not installed')
+    return encoder
+
+
+def encode_corpus(sort_keys, orjson, compact=True):
+    enc = encoder(sort_keys, orjson, compact)
+    lines = []
+    for event_id, log_entry in CORPUS:
+        try:
+            lines.append(enc.encode(event_id, '2024-01-02T03:04:05.678901',
+                                    log_entry))
+        except TypeError:
+            lines.append(b'TypeError\n')
+    return lines
+
+
+def golden(sort_keys):
+    with open(GOLDEN, 'rb') as f:
+        lines = f.read().split(b'\n')[:-1]
+    half = len(lines) // 2
+    lines = lines[:half] if sort_keys else lines[half:]
+    return [line + b'\n' for line in lines]
+
+
+@pytest.mark.parametrize('sort_keys', [True, False])
+@pytest.mark.parametrize('orjson', [False, True])
+def test_matches_golden_file(sort_keys, orjson):
+    assert encode_corpus(sort_keys, orjson) == golden(sort_keys)
+
+
+@pytest.mark.parametrize('sort_keys', [True, False])
+def test_default_lines_are_written_like_older_versions(sort_keys):
+    lines = encode_corpus(sort_keys, orjson=False, compact=False)
+    for (event_id, log_entry), line in zip(CORPUS, lines):
+        entry = dict(log_entry, controlhost='controller', event=event_id,
+                     timestamp='2024-01-02T03:04:05.678901',
+                     uuid='6f1c4bb4-9a53-4ad4-a7d9-4c1e0f0d1a2b')
+        try:
+            expected = json.dumps(entry, sort_keys=True)
+        except TypeError:
+            assert line == b'TypeError\n'
+            continue
+        if sort_keys:
+            assert line == expected.encode('ascii') + b'\n'
+        else:
+            assert line.startswith(b'{"controlhost": "controller", "uuid": ')
+            assert json.loads(line.decode('ascii')) == json.loads(expected)
+
+
+if __name__ == '__main__':
+    # Rewrites the golden file from the json module
+    with open(GOLDEN, 'wb') as f:
+        for sort_keys in (True, False):
+            f.writelines(encode_corpus(sort_keys, False))
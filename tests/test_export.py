@@ -0,0 +1,124 @@
+import fcntl
+import json
+import os
+import threading
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+import auditlog_export  # noqa: E402
+
+RUNS = ['0901ca06-19d6-4262-af67-0dc46236005{}'.format(i) for i in range(4)]
+
+
+def write_run(logdir, run_uuid, hour, hosts=3, timestamps=True):
+    entries = [{'event': 'playbook_on_start', 'playbook': 'site.yml'}]
+    for i in range(hosts):
+        entries.append({'event': 'runner_on_ok', 'status': 'changed',
+                        'module_name': 'command',
+                        'inventory_host': 'web{:02d}'.format(i)})
+    entries.append({'event': 'playbook_on_stats'})
+    with open(os.path.join(logdir, run_uuid + '.log'), 'w') as f:
+        for minute, entry in enumerate(entries):
+            entry.update({'uuid': run_uuid, 'controlhost': 'ctl'})
+            if timestamps or entry['event'] != 'runner_on_ok':
+                entry['timestamp'] = '2024-01-02T{:02d}:{:02d}:00'.format(
+                    hour, minute)
+            f.write(json.dumps(entry) + '\n')
+
+
+def export(logdir, output, **kwargs):
+    paths = sorted(os.path.join(logdir, name) for name in os.listdir(logdir)
+                   if name.endswith('.log'))
+    return auditlog_export.export(output, paths, jobs=1, **kwargs)
+
+
+def manifest(output):
+    with open(os.path.join(output, auditlog_export.MANIFEST)) as f:
+        return json.load(f)
+
+
+def test_entries_without_timestamp_are_counted_not_exported(tmpdir):
+    logdir, output = str(tmpdir.mkdir('logs')), str(tmpdir.join('out'))
+    write_run(logdir, RUNS[0], 10)
+    write_run(logdir, RUNS[1], 11, timestamps=False)
+
+    assert export(logdir, output) == 2
+
+    found = manifest(output)
+    assert found['untimed'] == 3
+    chunk, = found['chunks']
+    assert chunk['rows'] == 5 + 2
+    assert chunk['min_time'] == auditlog_export.epoch_us('2024-01-02T10:00')
+    assert chunk['max_time'] == auditlog_export.epoch_us('2024-01-02T11:04')
+
+    _, columns = auditlog_export.load(output, ['time'])
+    assert columns['time'].min() == chunk['min_time']
+
+
+def test_runs_are_written_in_chunks_as_they_are_read(tmpdir):
+    logdir, output = str(tmpdir.mkdir('logs')), str(tmpdir.join('out'))
+    for hour, run_uuid in enumerate(RUNS):
+        write_run(logdir, run_uuid, hour)
+
+    assert export(logdir, output, chunk_rows=10) == 4
+
+    chunks = manifest(output)['chunks']
+    assert [c['rows'] for c in chunks] == [10, 10]
+    _, columns = auditlog_export.load(output, ['run', 'count'])
+    assert columns['count'].sum() == 20
+    assert sorted(set(columns['run'].tolist())) == [0, 1, 2, 3]
+
+    # Nothing is exported twice
+    assert export(logdir, output, chunk_rows=10) == 0
+    assert len(manifest(output)['chunks']) == 2
+
+
+def test_concurrent_exports_wait_for_each_other(tmpdir):
+    logdir, output = str(tmpdir.mkdir('logs')), str(tmpdir.mkdir('out'))
+    write_run(logdir, RUNS[0], 10)
+    exported = []
+
+    lock = os.open(output, os.O_RDONLY)
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        thread = threading.Thread(
+            target=lambda: exported.append(export(logdir, output)))
+        thread.start()
+        thread.join(0.3)
+        assert thread.is_alive()
+        assert not os.path.exists(os.path.join(output,
+                                               auditlog_export.MANIFEST))
+    finally:
+        os.close(lock)
+    thread.join(10)
+
+    assert exported == [1]
+
+
+def test_exported_runs_in_segments_are_not_decoded_again(tmpdir, monkeypatch):
+    logdir, output = str(tmpdir.mkdir('logs')), str(tmpdir.join('out'))
+    segment = os.path.join(logdir, 'segment-20240102.log')
+
+    def append_to_segment(run_uuid, hour):
+        write_run(logdir, run_uuid, hour)
+        run_log = os.path.join(logdir, run_uuid + '.log')
+        with open(run_log) as f, open(segment, 'a') as out:
+            out.write(f.read())
+        os.remove(run_log)
+
+    append_to_segment(RUNS[0], 10)
+    assert export(logdir, output) == 1
+
+    decoded = []
+    loads = json.loads
+    monkeypatch.setattr(auditlog_export.json, 'loads',
+                        lambda s, **kwargs: decoded.append(s) or
+                        loads(s, **kwargs))
+    append_to_segment(RUNS[1], 11)
+    assert export(logdir, output) == 1
+    # The manifest is decoded too
+    lines = [s for s in decoded if '"uuid"' in s]
+    assert len(lines) == 5
+    assert all(RUNS[1] in line for line in lines)
@@ -0,0 +1,67 @@
+import pytest
+
+from auditlog_common import JsonAuditLogger, RunMetrics
+
+parser = pytest.importorskip('prometheus_client.parser')
+
+
+@pytest.fixture
+def metrics(tmpdir):
+    logger = JsonAuditLogger(logdir=str(tmpdir))
+    metrics = RunMetrics(str(tmpdir.join('run.prom')), logger, interval=60)
+    metrics.playbook = 'deploy "web".yml'
+    yield metrics
+    metrics.close()
+    logger.close()
+
+
+def families(metrics):
+    with open(metrics.path) as f:
+        return dict((family.name, family) for family in
+                    parser.text_string_to_metric_families(f.read()))
+
+
+def test_textfile_parses(metrics):
+    metrics.result('runner_on_ok', {'status': 'changed',
+                                    'module_name': 'command'})
+    metrics.result('runner_on_ok', {'status': 'changed',
+                                    'module_name': 'command'})
+    metrics.result('runner_on_failed', {'module_name': 'shell',
+                                        'ignore_errors': True})
+    metrics.result('runner_on_unreachable', {'inventory_host': 'web01'})
+    metrics.tasks_completed = 3
+    metrics.finish()
+
+    found = families(metrics)
+
+    info = found['ansible_auditlog_run_info']
+    assert info.type == 'gauge'
+    assert info.samples[0].labels['playbook'] == 'deploy "web".yml'
+    assert info.samples[0].value == 1
+
+    results = found['ansible_auditlog_results']
+    assert results.type == 'counter'
+    counts = dict(((s.labels['status'], s.labels['module']), s.value)
+                  for s in results.samples if s.name.endswith('_total'))
+    assert counts == {('changed', 'command'): 2, ('ignored', 'shell'): 1,
+                      ('unreachable', ''): 1}
+
+    assert found['ansible_auditlog_tasks_completed'].samples[0].value == 3
+    assert found['ansible_auditlog_run_finished'].samples[0].value == 1
+    assert found['ansible_auditlog_unreachable_hosts'].samples[0].value == 1
+
+
+def test_every_sample_is_typed(metrics):
+    metrics.result('runner_on_ok', {'module_name': 'ping'})
+    metrics.finish()
+
+    for family in families(metrics).values():
+        assert family.type in ('counter', 'gauge'), family.name
+
+
+def test_no_openmetrics_only_lines(metrics):
+    text = metrics.render()
+
+    assert '# EOF' not in text
+    assert '# UNIT' not in text
+    assert ' info\n' not in text
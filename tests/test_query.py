@@ -0,0 +1,170 @@
+import json
+import os
+
+import pytest
+
+import auditlog_query
+from auditlog_common import FileSink, SegmentSink
+
+RUN = '0901ca06-19d6-4262-af67-0dc46236005f'
+OTHER = '5b3e8f21-7c4d-4a9e-b0f6-2d8c1e4a7f93'
+
+
+def entry(event, **fields):
+    fields.update({'event': event, 'uuid': RUN, 'controlhost': 'ctl',
+                   'timestamp': '2024-01-02T03:04:05.000000'})
+    return fields
+
+
+ENTRIES = [
+    entry('playbook_on_start', playbook='site.yml', USER='alice'),
+    entry('task_summary', task='install', partial=False, outcomes=[
+        {'event': 'runner_on_ok', 'status': 'ok', 'module_name': 'yum',
+         'count': 5},
+        {'event': 'runner_on_ok', 'status': 'changed', 'module_name': 'yum',
+         'count': 2, 'hosts': ['web01', 'web02']},
+        {'event': 'runner_on_failed', 'module_name': 'yum', 'count': 1,
+         'hosts': ['web03'], 'ignore_errors': False},
+        {'event': 'runner_on_unreachable', 'count': 1, 'hosts': ['web04']},
+    ]),
+    entry('runner_on_ok', inventory_host='web01', status='changed',
+          module_name='command'),
+]
+
+
+def write_log(tmpdir, entries):
+    path = tmpdir.join(RUN + '.log')
+    path.write('\n'.join(json.dumps(e) for e in entries) + '\n')
+    return str(path)
+
+
+def table(capsys, *args):
+    assert auditlog_query.main(list(args) + ['--format', 'table',
+                                             '--no-catalog', '-j', '1']) == 0
+    header, row = capsys.readouterr().out.splitlines()
+    return dict(zip(header.lower().split(), row.split()))
+
+
+def test_table_counts_task_summary_outcomes(tmpdir, capsys):
+    row = table(capsys, write_log(tmpdir, ENTRIES))
+
+    assert row['entries'] == '3'
+    assert (row['ok'], row['changed'], row['failed'],
+            row['unreachable']) == ('5', '3', '1', '1')
+
+
+def test_table_counts_only_the_hosts_queried(tmpdir, capsys):
+    row = table(capsys, write_log(tmpdir, ENTRIES), '--host', 'web01')
+
+    assert row['entries'] == '2'
+    assert (row['ok'], row['changed'], row['failed'],
+            row['unreachable']) == ('0', '2', '0', '0')
+
+
+def test_host_matches_hosts_of_outcomes():
+    query = auditlog_query.Query(hosts=['web03'])
+    summary = json.dumps(ENTRIES[1]).encode('utf-8')
+
+    assert query.match_line(summary) is not None
+    assert auditlog_query.Query(hosts=['web09']).match_line(summary) is None
+
+
+def test_rebuilt_catalog_has_absolute_logfiles(tmpdir):
+    path = write_log(tmpdir, ENTRIES)
+    catalog = str(tmpdir.join('catalog.db'))
+    with tmpdir.as_cwd():
+        assert auditlog_query.rebuild_catalog(
+            catalog, [RUN + '.log'], jobs=1) == 1
+
+    db = auditlog_query.connect_catalog(catalog)
+    try:
+        rows = db.execute('SELECT uuid, logfile FROM runs').fetchall()
+    finally:
+        db.close()
+    assert rows == [(RUN, path)]
+
+
+@pytest.mark.parametrize('trim', [7, 30])
+def test_truncated_gzip_log_is_read_up_to_the_last_whole_line(tmpdir,
+                                                              capsys, trim):
+    path = str(tmpdir.join(RUN + '.log.gz'))
+    sink = FileSink(path, buffer_size=0, compression='gzip')
+    for e in ENTRIES:
+        sink.append((json.dumps(e) + '\n').encode('utf-8'))
+    sink.close()
+    # As if the last write was cut short by a crash
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - trim)
+
+    assert auditlog_query.main(['--logdir', str(tmpdir), '--no-catalog',
+                                '-j', '1']) == 0
+    events = [json.loads(line)['event']
+              for line in capsys.readouterr().out.splitlines()]
+    # Every line is a gzip member of its own. Without its trailer the
+    # last one is still whole, a shorter one is left out.
+    assert events == [e['event'] for e in ENTRIES][:3 if trim == 7 else 2]
+
+
+def write_segment(tmpdir):
+    """Writes the entries of RUN and of another run to one segment"""
+    sinks = dict((run, SegmentSink(str(tmpdir), run, buffer_size=0))
+                 for run in (OTHER, RUN))
+    for e in ENTRIES:
+        for run, sink in sorted(sinks.items()):
+            sink.append((json.dumps(dict(e, uuid=run)) + '\n').encode(
+                'utf-8'))
+    for sink in sinks.values():
+        sink.close()
+    segment, = tmpdir.listdir('segment-*.log')
+    return str(segment)
+
+
+def test_run_filter_reads_the_writes_of_the_run_from_the_segment_index(
+        tmpdir):
+    segment = write_segment(tmpdir)
+    with open(segment, 'rb') as f:
+        lines = f.readlines()
+    ranges = [(start, end) for _, start, end in
+              auditlog_query.segment_extents(segment, [RUN], gap=1)]
+
+    assert [b''.join(lines)[start:end] for start, end in ranges] == [
+        line for line in lines if RUN.encode('ascii') in line]
+    # Writes close to each other are scanned as one range
+    tasks = auditlog_query.query_tasks(auditlog_query.Query(runs=[RUN]),
+                                       [segment], 1024 * 1024)
+    assert tasks == [(segment, ranges[0][0], ranges[-1][1])]
+    assert auditlog_query.segment_extents(segment, ['web01']) == []
+
+
+def test_run_query_of_a_segment(tmpdir, capsys):
+    write_segment(tmpdir)
+
+    assert auditlog_query.main(['--logdir', str(tmpdir), '--run', RUN,
+                                '--no-catalog', '-j', '1']) == 0
+    entries = [json.loads(line)
+               for line in capsys.readouterr().out.splitlines()]
+    assert [(e['uuid'], e['event']) for e in entries] == [
+        (RUN, e['event']) for e in ENTRIES]
+
+
+@pytest.mark.parametrize('hosts', [
+    ['web01', 'db01'], {'count': 2, 'patterns': ['db01', 'web01']}])
+def test_catalog_keeps_runs_of_inventory_hosts(tmpdir, capsys, hosts):
+    start = dict(ENTRIES[0], hosts=hosts)
+    write_log(tmpdir, [start] + ENTRIES[1:] + [
+        entry('playbook_on_stats', stats={'summary': {}, 'details': {
+            'processed': {'web01': 1, 'web02': 1, 'web03': 1,
+                          'web04': 1}}}),
+    ])
+    auditlog_query.rebuild_catalog(str(tmpdir.join('catalog.db')),
+                                   [str(tmpdir.join(RUN + '.log'))], jobs=1)
+
+    found = []
+    for catalog in ([], ['--no-catalog']):
+        assert auditlog_query.main(['--logdir', str(tmpdir), '--host',
+                                    'db01', '-j', '1'] + catalog) == 0
+        found.append(capsys.readouterr().out)
+    # db01 is in the inventory, but never processed
+    assert found[0] == found[1]
+    assert [json.loads(line)['event'] for line in found[0].splitlines()] == [
+        'playbook_on_start']
@@ -0,0 +1,328 @@
+import threading
+import time
+
+import pytest
+
+try:
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    import SocketServer as socketserver
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from auditlog_common import FileSink, NetworkSink, open_sink
+
+LINES = [b'{"event":"runner_on_ok","n":1}\n',
+         b'{"event":"runner_on_ok","n":2}\n']
+
+
+class Server(object):
+    """Runs a socketserver or http.server in a thread and keeps what it
+    received"""
+
+    def __init__(self, server_cls, handler_cls):
+        self.received = []
+        self.connections = 0
+        self.event = threading.Event()
+        handler_cls.owner = self
+        self.server = server_cls(('127.0.0.1', 0), handler_cls)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.01})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wait(self, n):
+        deadline = time.time() + 5
+        while len(self.received) < n and time.time() < deadline:
+            self.event.wait(0.01)
+        return self.received
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class StreamHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.owner.connections += 1
+        for line in self.rfile:
+            self.owner.received.append(line)
+            self.owner.event.set()
+
+
+class OneBatchHandler(socketserver.BaseRequestHandler):
+    """Reads one batch and closes the connection, like a collector that
+    drops idle connections"""
+
+    def handle(self):
+        self.owner.connections += 1
+        self.owner.received.append(self.request.recv(65536))
+        self.owner.event.set()
+
+
+class DatagramHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        self.owner.received.append(self.request[0])
+        self.owner.event.set()
+
+
+class HttpHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    status = 200
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.owner.received.append((self.path, self.headers['Content-Type'],
+                                    body))
+        self.send_response(self.status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        self.owner.event.set()
+
+    def log_message(self, *args):
+        pass
+
+
+class FailingHttpHandler(HttpHandler):
+    status = 503
+
+
+@pytest.fixture
+def fallback(tmpdir):
+    return FileSink(str(tmpdir.join('run.log')), buffer_size=0)
+
+
+def fallback_lines(fallback):
+    fallback.close()
+    try:
+        with open(fallback.path, 'rb') as f:
+            return f.readlines()
+    except IOError:
+        return []
+
+
+def unused_port():
+    server = socketserver.TCPServer(('127.0.0.1', 0),
+                                    socketserver.BaseRequestHandler)
+    port = server.server_address[1]
+    server.server_close()
+    return port
+
+
+def count_connects(sink):
+    connects = []
+    connect = sink.connect
+
+    def counted():
+        connects.append(1)
+        return connect()
+    sink.connect = counted
+    return connects
+
+
+def test_tcp_delivers_batches_over_one_connection(fallback):
+    server = Server(ThreadingTCPServer, StreamHandler)
+    try:
+        sink = open_sink('tcp://127.0.0.1:{}'.format(server.port), fallback)
+        sink.append(LINES[0])
+        sink.flush()
+        sink.append(LINES[1])
+        sink.close()
+
+        assert server.wait(2) == LINES
+        assert server.connections == 1
+        assert sink.writes == 2
+    finally:
+        server.close()
+    assert fallback_lines(fallback) == []
+
+
+def test_tcp_resends_on_new_connection_after_remote_closed_it(fallback):
+    server = Server(ThreadingTCPServer, OneBatchHandler)
+    try:
+        sink = open_sink('tcp://127.0.0.1:{}'.format(server.port), fallback)
+        for n, line in enumerate([LINES[0], LINES[1], LINES[1]]):
+            sink.append(line)
+            sink.flush()
+            server.wait(n + 1)
+            # Until the server has closed the connection, which the next
+            # batch notices before it is sent
+            time.sleep(0.1)
+        sink.close()
+    finally:
+        server.close()
+    assert server.received == [LINES[0], LINES[1], LINES[1]]
+    assert server.connections == 3
+    assert fallback_lines(fallback) == []
+
+
+def test_tcp_falls_back_after_first_failure(fallback):
+    sink = open_sink('tcp://127.0.0.1:{}'.format(unused_port()), fallback)
+    connects = count_connects(sink)
+
+    sink.append(LINES[0])
+    sink.flush()
+    sink.append(LINES[1])
+    sink.close()
+
+    # The second batch is not tried until RETRY_INTERVAL has passed
+    assert len(connects) == 1
+    assert sink.writes == 0
+    assert fallback_lines(fallback) == LINES
+
+
+def test_tcp_falls_back_after_timeout(fallback):
+    # Accepts connections, but never reads from them
+    server = socketserver.TCPServer(('127.0.0.1', 0),
+                                    socketserver.BaseRequestHandler)
+    try:
+        sink = open_sink('tcp://127.0.0.1:{}'.format(
+            server.server_address[1]), fallback)
+        sink.TIMEOUT = 0.2
+        connects = count_connects(sink)
+        # More than the socket buffers take without the peer reading
+        sink.append(b'x' * (64 * 1024 * 1024) + b'\n')
+        started = time.time()
+        sink.flush()
+        assert time.time() - started < 5
+        sink.append(LINES[0])
+        sink.flush()
+        assert len(connects) == 1
+    finally:
+        server.server_close()
+    assert fallback_lines(fallback)[-1] == LINES[0]
+
+
+def test_retries_after_retry_interval(fallback):
+    sink = open_sink('tcp://127.0.0.1:{}'.format(unused_port()), fallback)
+    sink.RETRY_INTERVAL = 0.1
+    sink.append(LINES[0])
+    sink.flush()
+
+    server = Server(ThreadingTCPServer, StreamHandler)
+    try:
+        # The collector comes up at another address
+        sink.address = ('127.0.0.1', server.port)
+        sink.append(LINES[1])
+        sink.flush()
+        assert server.received == []
+        time.sleep(0.2)
+        sink.append(LINES[1])
+        sink.close()
+        assert server.wait(1) == LINES[1:]
+    finally:
+        server.close()
+    assert fallback_lines(fallback) == LINES
+
+
+def test_tcp_syslog_frames_are_octet_counted(fallback):
+    server = Server(ThreadingTCPServer, OneBatchHandler)
+    try:
+        sink = open_sink('syslog+tcp://127.0.0.1:{}'.format(server.port),
+                         fallback)
+        sink.append(LINES[0])
+        sink.close()
+        data = server.wait(1)[0]
+    finally:
+        server.close()
+
+    length, msg = data.split(b' ', 1)
+    assert int(length) == len(msg)
+    assert msg.startswith(b'<134>1 ')
+    assert msg.endswith(b' ansible-auditlog ' + msg.split(b' ')[4] +
+                        b' - - ' + LINES[0].rstrip(b'\n'))
+
+
+def test_udp_syslog_sends_a_datagram_per_line(fallback):
+    server = Server(socketserver.UDPServer, DatagramHandler)
+    try:
+        sink = open_sink('syslog+udp://127.0.0.1:{}'.format(server.port),
+                         fallback)
+        for line in LINES:
+            sink.append(line)
+        sink.close()
+        received = server.wait(2)
+    finally:
+        server.close()
+
+    assert len(received) == 2
+    for datagram, line in zip(received, LINES):
+        assert datagram.startswith(b'<134>1 ')
+        assert datagram.endswith(b' - - ' + line.rstrip(b'\n'))
+
+
+def test_udp_syslog_falls_back_for_lines_too_large_for_a_datagram(fallback):
+    server = Server(socketserver.UDPServer, DatagramHandler)
+    big = b'{"msg":"' + b'x' * 70000 + b'"}\n'
+    try:
+        sink = open_sink('syslog+udp://127.0.0.1:{}'.format(server.port),
+                         fallback)
+        for line in [LINES[0], big, LINES[1]]:
+            sink.append(line)
+        sink.flush()
+        # The remote end is not taken to be down
+        sink.append(LINES[1])
+        sink.close()
+        received = server.wait(3)
+    finally:
+        server.close()
+
+    assert [d.split(b' - - ', 1)[1] for d in received] == [
+        line.rstrip(b'\n') for line in [LINES[0], LINES[1], LINES[1]]]
+    assert fallback_lines(fallback) == [big]
+
+
+def test_http_posts_batches(fallback):
+    server = Server(HTTPServer, HttpHandler)
+    try:
+        sink = open_sink('http://127.0.0.1:{}/ingest'.format(server.port),
+                         fallback)
+        sink.append(LINES[0])
+        sink.flush()
+        sink.append(LINES[1])
+        sink.close()
+        received = server.wait(2)
+    finally:
+        server.close()
+
+    assert received == [('/ingest', 'application/x-ndjson', LINES[0]),
+                        ('/ingest', 'application/x-ndjson', LINES[1])]
+    assert fallback_lines(fallback) == []
+
+
+def test_http_error_status_falls_back(fallback):
+    server = Server(HTTPServer, FailingHttpHandler)
+    try:
+        sink = open_sink('http://127.0.0.1:{}/'.format(server.port),
+                         fallback)
+        connects = count_connects(sink)
+        sink.append(LINES[0])
+        sink.flush()
+        sink.append(LINES[1])
+        sink.close()
+        assert len(server.wait(1)) == 1
+    finally:
+        server.close()
+
+    assert len(connects) == 1
+    assert fallback_lines(fallback) == LINES
+
+
+def test_http_errors_and_ports_are_class_attributes(fallback):
+    from auditlog_common import HttpSink
+
+    http = open_sink('http://example.com/', fallback)
+    https = open_sink('https://example.com/', fallback)
+
+    assert 'ERRORS' not in vars(http) and 'DEFAULT_PORT' not in vars(http)
+    assert HttpSink.ERRORS == NetworkSink.ERRORS
+    assert http.address == ('example.com', 80)
+    assert https.address == ('example.com', 443)